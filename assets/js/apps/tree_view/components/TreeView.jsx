@@ -26,8 +26,9 @@ const TreeView = ({ datasetId, modified, hsmEnabled }) => {
       + 'notified when dataset is available to download');
   const [recallButtonStatus, setRecallButtonStatus] = useState('all');
   const [showRecallDatasetButton, setShowRecallDatasetButton] = useState(false);
-  const fetchBaseDirs = (pageNum, resetData) => {
-    fetch(`/api/v1/dataset/${datasetId}/root-dir-nodes/?page=${pageNum}`, {
+  const fetchBaseDirs = (pageNum, resetData, cursor) => {
+    const cursorParam = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    fetch(`/api/v1/dataset/${datasetId}/root-dir-nodes/?page=${pageNum}${cursorParam}`, {
       method: 'get',
       headers: {
         'Accept': 'application/json', // eslint-disable-line quote-props
@@ -58,7 +59,7 @@ const TreeView = ({ datasetId, modified, hsmEnabled }) => {
   };
   const onSelect = (node) => {
     if (node.next_page) {
-      fetchBaseDirs(node.next_page_num);
+      fetchBaseDirs(node.next_page_num, false, node.cursor);
     }
     node.toggled = !node.toggled;
     if (node.selected) {
@@ -1,9 +1,17 @@
 """
 Google analyitics tracking
+
+Events are put on an in-process queue and sent to Google Analytics by a
+background thread, in batches of up to GA_BATCH_SIZE hits per request, so
+that tracking never delays the response.  If the queue is full, because
+Google Analytics can't be reached, further events are dropped.
 """
 
 import logging
+import queue
 import random
+import threading
+from urllib.parse import urlencode
 
 from django.conf import settings
 
@@ -11,9 +19,67 @@ import requests
 
 GA_ID = getattr(settings, "GOOGLE_ANALYTICS_ID", None)
 GA_USER_TRACKING = getattr(settings, "GOOGLE_ANALYTICS_USER_TRACKING", False)
+GA_QUEUE_SIZE = getattr(settings, "GOOGLE_ANALYTICS_QUEUE_SIZE", 10000)
+GA_TIMEOUT = getattr(settings, "GOOGLE_ANALYTICS_TIMEOUT", 10)
+
+GA_BATCH_URL = "https://www.google-analytics.com/batch"
+GA_BATCH_SIZE = 20
+"""The maximum number of hits in a batch request to the Measurement Protocol"""
 
 logger = logging.getLogger(__name__)
 
+_events = queue.Queue(maxsize=GA_QUEUE_SIZE)
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def _send_batch(batch):
+    try:
+        response = requests.post(
+            GA_BATCH_URL,
+            data="\n".join(urlencode(data) for data in batch),
+            timeout=GA_TIMEOUT,
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.debug(f"Google analytics error: {e}, {len(batch)} events dropped")
+
+
+def _next_batch():
+    """
+    Waits for an event, and returns it with the events queued after it, up
+    to GA_BATCH_SIZE events
+    """
+    batch = [_events.get()]
+    while len(batch) < GA_BATCH_SIZE:
+        try:
+            batch.append(_events.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _send_events():
+    """
+    Sends queued events for as long as the process runs
+    """
+    while True:
+        _send_batch(_next_batch())
+
+
+def _start_sender():
+    """
+    Starts the sender thread, if it isn't running in this process, e.g.
+    after a web server forked its workers
+    """
+    global _sender  # pylint: disable=W0603
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = threading.Thread(
+                target=_send_events, name="google-analytics", daemon=True
+            )
+            _sender.start()
+
 
 def _track_event(payload, cid=None, uid=None):
     """
@@ -42,12 +108,11 @@ def _track_event(payload, cid=None, uid=None):
     data.update(payload)
 
     try:
-        response = requests.post(
-            "http://www.google-analytics.com/collect", data=data, timeout=300
-        )
-        response.raise_for_status()
-    except (requests.ConnectionError, requests.HTTPError) as e:
-        logger.debug(f"Google analytics error: {e}, payload: {data}")
+        _events.put_nowait(data)
+    except queue.Full:
+        logger.debug(f"Google analytics queue full, payload: {data}")
+        return
+    _start_sender()
 
 
 def track_login(label, session_id, ip, user):
@@ -0,0 +1,57 @@
+import queue
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+from django.test import SimpleTestCase
+
+import requests
+
+from .. import ga
+
+
+@patch.object(ga, "GA_ID", "UA-TEST")
+class GoogleAnalyticsTestCase(SimpleTestCase):
+    def setUp(self):
+        events = queue.Queue(maxsize=30)
+        patcher = patch.object(ga, "_events", events)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = events
+
+    @patch.object(ga, "_start_sender")
+    def test_events_are_batched(self, start_sender):
+        for idx in range(1, 36):
+            ga._track_event({"t": "event", "ea": "download"}, cid=idx)
+        # events beyond the size of the queue are dropped
+        self.assertEqual(self.events.qsize(), 30)
+        self.assertEqual(start_sender.call_count, 30)
+        batches = [ga._next_batch(), ga._next_batch()]
+        self.assertEqual([len(batch) for batch in batches], [ga.GA_BATCH_SIZE, 10])
+        self.assertEqual(
+            [data["cid"] for batch in batches for data in batch], list(range(1, 31))
+        )
+
+    @patch("requests.post")
+    def test_send_batch(self, post):
+        batch = [{"v": "1", "tid": "UA-TEST", "cid": idx} for idx in range(3)]
+        ga._send_batch(batch)
+        self.assertEqual(post.call_args.args, (ga.GA_BATCH_URL,))
+        lines = post.call_args.kwargs["data"].split("\n")
+        self.assertEqual(
+            [parse_qs(line)["cid"] for line in lines], [["0"], ["1"], ["2"]]
+        )
+
+    @patch("requests.post")
+    def test_send_batch_errors(self, post):
+        # errors are logged, rather than stopping the sender thread
+        for error in (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.InvalidURL,
+            requests.TooManyRedirects,
+        ):
+            post.side_effect = error("failed")
+            ga._send_batch([{"v": "1", "tid": "UA-TEST", "cid": 1}])
+        post.side_effect = None
+        post.return_value.raise_for_status.side_effect = requests.HTTPError("500")
+        ga._send_batch([{"v": "1", "tid": "UA-TEST", "cid": 1}])
@@ -1,2 +1,11 @@
 ENABLE_EVENTLOG = False
 EVENTLOG_ACTIONS = []
+EVENTLOG_ASYNC = False
+"""
+Write events logged in bulk, e.g. for each file of an archive download, in a
+Celery task rather than before the response is sent
+"""
+EVENTLOG_BATCH_SIZE = 1000
+"""
+Number of events written by each insert when events are logged in bulk
+"""
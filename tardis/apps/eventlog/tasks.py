@@ -0,0 +1,8 @@
+from tardis.celery import tardis_app
+
+from .utils import create_logs
+
+
+@tardis_app.task(name="eventlog.log_many", ignore_result=True)
+def log_many_task(action, extras, user_id, request_data):
+    create_logs(action, extras, user_id, request_data)
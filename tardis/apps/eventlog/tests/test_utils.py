@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+
+from ..models import Action, Log
+from ..utils import log, log_many
+
+
+class LogTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="eventlog_user")
+        self.request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1")
+        self.request.user = self.user
+
+    def test_log_many(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            log(action="DOWNLOAD_DATAFILE", extra={"id": 0}, request=self.request)
+        # the action is looked up once, and all events are inserted together
+        with self.assertNumQueries(1):
+            events = log_many(
+                "DOWNLOAD_DATAFILE",
+                [{"id": idx, "type": "tar"} for idx in range(1, 6)],
+                request=self.request,
+            )
+        self.assertEqual(len(events), 5)
+        self.assertEqual(Action.objects.count(), 1)
+        self.assertEqual(
+            sorted(Log.objects.values_list("extra__id", flat=True)), list(range(6))
+        )
+        self.assertEqual(
+            Log.objects.filter(user=self.user, extra__ip="10.0.0.1").count(), 6
+        )
+
+    @override_settings(EVENTLOG_ACTIONS=["LOGIN"])
+    def test_disabled_action(self):
+        self.assertIsNone(log_many("DOWNLOAD_DATAFILE", [{}], request=self.request))
+        self.assertFalse(Log.objects.exists())
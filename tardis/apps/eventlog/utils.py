@@ -1,20 +1,52 @@
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 from .models import Action, Log
 from .signals import event_logged
 
+_action_ids = {}
 
-def log(action, user=None, obj=None, extra=None, request=None):
+
+def get_action_id(name):
+    """
+    Returns the id of the Action with the given name, creating it if needed.
+    The ids are cached in each process, once the Action is committed.
+    """
+    action_id = _action_ids.get(name)
+    if action_id is None:
+        action_id = Action.objects.get_or_create(name=name)[0].id
+        transaction.on_commit(lambda: _action_ids.setdefault(name, action_id))
+    return action_id
+
+
+@receiver(post_delete, sender=Action, dispatch_uid="eventlog_action_delete")
+def forget_action(sender, instance, **kwargs):
+    _action_ids.pop(instance.name, None)
+
+
+def _is_enabled(action):
     enabled_actions = getattr(settings, "EVENTLOG_ACTIONS", [])
-    if enabled_actions and action not in enabled_actions:
-        return None
+    return not enabled_actions or action in enabled_actions
 
+
+def _get_user(user, request):
     if user is None and request is not None:
         user = request.user
 
     if user is not None and not user.is_authenticated:
         user = None
+    return user
+
+
+def log(action, user=None, obj=None, extra=None, request=None):
+    if not _is_enabled(action):
+        return None
+
+    user = _get_user(user, request)
 
     if extra is None:
         extra = {}
@@ -29,7 +61,7 @@ def log(action, user=None, obj=None, extra=None, request=None):
         extra = {**extra, **get_request_data(request)}
 
     event = Log.objects.create(
-        action=Action.objects.get_or_create(name=action)[0],
+        action_id=get_action_id(action),
         user=user,
         content_type=content_type,
         object_id=object_id,
@@ -41,6 +73,59 @@ def log(action, user=None, obj=None, extra=None, request=None):
     return event
 
 
+def log_many(action, extras, user=None, request=None):
+    """
+    Logs an event for each of extras, e.g. for each file of a download, with
+    a single bulk insert.
+
+    If EVENTLOG_ASYNC is set, the events are written by a Celery task
+    instead, and None is returned.
+
+    :param str action: name of the action
+    :param list extras: extra data of each event
+    :param User user: the user, by default the user of the request
+    :param HttpRequest request: the request whose IP address and user agent
+        are added to each event
+    :returns: the logged events
+    :rtype: list
+    """
+    if not _is_enabled(action):
+        return None
+
+    user = _get_user(user, request)
+    request_data = get_request_data(request) if request is not None else {}
+    if getattr(settings, "EVENTLOG_ASYNC", False):
+        from .tasks import log_many_task
+
+        log_many_task.delay(
+            action, list(extras), user.id if user else None, request_data
+        )
+        return None
+    return _create_logs(action, extras, user, request_data)
+
+
+def _create_logs(action, extras, user, request_data):
+    action_id = get_action_id(action)
+    events = Log.objects.bulk_create(
+        (
+            Log(action_id=action_id, user=user, extra={**extra, **request_data})
+            for extra in extras
+        ),
+        batch_size=getattr(settings, "EVENTLOG_BATCH_SIZE", 1000),
+    )
+    for event in events:
+        event_logged.send(sender=Log, event=event)
+    return events
+
+
+def create_logs(action, extras, user_id, request_data):
+    """
+    Writes the events logged by :py:func:`log_many` in a Celery task
+    """
+    user = User.objects.filter(id=user_id).first() if user_id else None
+    return _create_logs(action, extras, user, request_data)
+
+
 def get_request_data(request):
     if x_forwarded_for := request.META.get("HTTP_X_FORWARDED_FOR"):
         user_ip = x_forwarded_for.split(",")[0]
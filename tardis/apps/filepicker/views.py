@@ -11,6 +11,7 @@ from django.http import HttpResponse
 from tardis.apps.filepicker import filepicker_settings
 from tardis.apps.filepicker.utils import FilepickerFile
 from tardis.tardis_portal.auth import decorators as authz
+from tardis.tardis_portal.auth.acl_resolver import datafile_acls_inherited
 from tardis.tardis_portal.models import DataFile, DatafileACL, Dataset
 from tardis.tardis_portal.shortcuts import render_response_index
 
@@ -67,7 +68,10 @@ def fpupload(request, dataset_id):
                         size=picked_file.size,
                     )
                     datafile.save()
-                    if not settings.ONLY_EXPERIMENT_ACLS:
+                    if (
+                        not settings.ONLY_EXPERIMENT_ACLS
+                        and not datafile_acls_inherited()
+                    ):
                         # add default ACL for DataFile
                         acl = DatafileACL(
                             user=request.user,
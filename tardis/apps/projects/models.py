@@ -5,7 +5,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.urls import reverse
 from django.utils.timezone import now as django_time_now
 
@@ -13,7 +13,11 @@ from taggit.managers import TaggableManager
 
 # from X.models import DataManagementPlan # Hook in place for future proofing
 from tardis.tardis_portal.managers import OracleSafeManager, SafeManager
-from tardis.tardis_portal.models.access_control import ACL, delete_if_all_false
+from tardis.tardis_portal.models.access_control import (
+    ACL,
+    delete_if_all_false,
+    invalidate_cached_acls,
+)
 
 # from tardis.tardis_portal.models.institution import Institution
 from tardis.tardis_portal.models.experiment import Experiment
@@ -274,5 +278,7 @@ def project_public_acls(instance, **kwargs):
 
 
 post_save.connect(delete_if_all_false, sender=ProjectACL)
+post_save.connect(invalidate_cached_acls, sender=ProjectACL)
+post_delete.connect(invalidate_cached_acls, sender=ProjectACL)
 
 post_save.connect(project_public_acls, sender=Project)
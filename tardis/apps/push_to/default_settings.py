@@ -0,0 +1,10 @@
+PUSH_TO_TRANSFER_STREAMS = 4
+"""
+Number of files pushed at once, each over its own SFTP channel of the SSH
+connection to the remote host.
+"""
+
+PUSH_TO_PROGRESS_BATCH_SIZE = 100
+"""
+Number of files whose push-to progress is saved at a time.
+"""
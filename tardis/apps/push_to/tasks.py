@@ -1,4 +1,9 @@
+import logging
 import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 from django.conf import settings
@@ -16,6 +21,10 @@ from tardis.tardis_portal.util import (
 
 from .models import Credential, Progress, RemoteHost, Request
 
+logger = logging.getLogger(__name__)
+
+CONNECTION_ERRORS = ("Socket is closed", "Server connection dropped")
+
 
 @tardis_app.task
 def requests_maintenance(**kwargs):
@@ -109,9 +118,18 @@ def push_datafile_to_host(
 
 @tardis_app.task(ignore_result=True)
 def process_request(request_id, idle=0):
+    """
+    Pushes the pending files of a request over PUSH_TO_TRANSFER_STREAMS SFTP
+    channels of a single SSH connection in parallel, and records their
+    progress in batches of PUSH_TO_PROGRESS_BATCH_SIZE
+    """
     req = Request.objects.get(pk=request_id)
-    files = Progress.objects.filter(request=req, status=0, retry__lt=10)
-    no_errors = True
+    files = (
+        Progress.objects.filter(request=req, status=0, retry__lt=10)
+        .select_related("datafile__dataset")
+        .prefetch_related("datafile__file_objects")
+    )
+    streams = max(1, getattr(settings, "PUSH_TO_TRANSFER_STREAMS", 4))
 
     try:
         ssh = req.credential.get_client_for_host(req.host)
@@ -120,7 +138,7 @@ def process_request(request_id, idle=0):
         transport.default_window_size = 2147483647
         transport.packetizer.REKEY_BYTES = pow(2, 40)
         transport.packetizer.REKEY_PACKETS = pow(2, 40)
-        sftp = ssh.open_sftp()
+        sftp_clients = [ssh.open_sftp() for _ in range(streams)]
     except Exception as err:
         # Authentication failed (expired?)
         req.message = "Can't connect: %s" % str(err)
@@ -137,49 +155,187 @@ def process_request(request_id, idle=0):
         experiment = Experiment.objects.get(pk=req.object_id)
         remote_base_dir.append(get_filesystem_safe_experiment_name(experiment))
 
-    make_dirs(sftp, remote_base_dir)
+    directories = RemoteDirectories()
+    directories.make(sftp_clients[0], remote_base_dir)
 
-    for file in files:
-        file.timestamp = timezone.now()
-        src_file = file.datafile.get_absolute_filepath()
-        if src_file is not None and os.path.exists(src_file):
-            try:
-                path = [get_filesystem_safe_dataset_name(file.datafile.dataset)]
-                if file.datafile.directory is not None:
-                    path += file.datafile.directory.split("/")
-                path = remote_base_dir + path
-                make_dirs(sftp, path)
-                path_str = "/".join(path + [file.datafile.filename])
-                sftp.putfo(file.datafile.get_file(), path_str, file.datafile.size)
-                file.status = 1
-            except Exception as e:
-                no_errors = False
-                file.retry += 1
-                file.message = str(e)
-        else:
-            no_errors = False
-            file.retry += 1
-            file.message = "Can't find source file."
-        file.save()
-        if (
-            not no_errors
-            and file.message is not None
-            and (
-                "Socket is closed" in file.message
-                or "Server connection dropped" in file.message
-            )
-        ):
-            break
+    transfer = ParallelTransfer(sftp_clients, directories)
+    no_errors = transfer.push(files, remote_base_dir)
 
-    sftp.close()
+    for sftp in sftp_clients:
+        sftp.close()
     ssh.close()
 
+    logger.info(
+        "Push-to request %s: pushed %s files, %s bytes in %.1f s (%.1f MB/s)",
+        req.id,
+        transfer.files_pushed,
+        transfer.bytes_pushed,
+        transfer.elapsed,
+        transfer.throughput / 1e6,
+    )
+
     if no_errors:
         complete_request(req.id)
     else:
         process_request.apply_async(args=[req.id, idle + 1], countdown=(idle + 1) * 60)
 
 
+class RemoteDirectories(object):
+    """
+    Creates remote directories, remembering the ones which exist so that
+    each one is only checked once.  It can be shared between threads.
+    """
+
+    def __init__(self):
+        self.existing = set()
+        self.lock = threading.Lock()
+
+    def make(self, sftp_client, dir_list):
+        with self.lock:
+            make_dirs(sftp_client, dir_list, self.existing)
+
+
+class ParallelTransfer(object):
+    """
+    Pushes files over several SFTP channels at once.
+
+    The files are opened, and their progress saved, in the calling thread,
+    so that only the transfers run in the worker threads, each of which
+    uses one of the channels at a time.
+
+    :param list sftp_clients: SFTPClients, one per stream
+    :param RemoteDirectories directories: the remote directories
+
+    :attribute files_pushed: number of files pushed
+    :attribute bytes_pushed: number of bytes pushed
+    :attribute elapsed: seconds spent pushing
+    """
+
+    def __init__(self, sftp_clients, directories):
+        self.sftp_clients = queue.Queue()
+        for sftp in sftp_clients:
+            self.sftp_clients.put(sftp)
+        self.streams = len(sftp_clients)
+        self.directories = directories
+        self.batch_size = getattr(settings, "PUSH_TO_PROGRESS_BATCH_SIZE", 100)
+        self.updated = []
+        self.pending = {}
+        self.connection_lost = False
+        self.files_pushed = 0
+        self.bytes_pushed = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Aggregate throughput of the streams, in bytes per second
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_pushed / self.elapsed
+
+    def _put(self, file_object, dir_list, path_str, size):
+        sftp = self.sftp_clients.get()
+        try:
+            self.directories.make(sftp, dir_list)
+            sftp.putfo(file_object, path_str, size)
+        finally:
+            self.sftp_clients.put(sftp)
+            file_object.close()
+
+    def _submit(self, executor, file, remote_base_dir):
+        """
+        Starts pushing a file, returns None if it can't be
+        """
+        src_file = file.datafile.get_absolute_filepath()
+        if src_file is None or not os.path.exists(src_file):
+            self._failed(file, "Can't find source file.")
+            return None
+        try:
+            path = [get_filesystem_safe_dataset_name(file.datafile.dataset)]
+            if file.datafile.directory is not None:
+                path += file.datafile.directory.split("/")
+            path = remote_base_dir + path
+            path_str = "/".join(path + [file.datafile.filename])
+            file_object = file.datafile.get_file()
+            if file_object is None:
+                self._failed(file, "Can't find source file.")
+                return None
+            return executor.submit(
+                self._put, file_object, path, path_str, file.datafile.size
+            )
+        except Exception as e:
+            self._failed(file, str(e))
+            return None
+
+    def _failed(self, file, message):
+        file.retry += 1
+        file.message = message[:100]
+        self._save(file)
+
+    def _save(self, file):
+        self.updated.append(file)
+        if len(self.updated) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        Progress.objects.bulk_update(
+            self.updated, ["status", "message", "retry", "timestamp"]
+        )
+        self.updated = []
+
+    def _finish(self, futures):
+        """
+        Records the results of finished transfers, returns False if any
+        failed
+        """
+        no_errors = True
+        for future in futures:
+            file = self.pending.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                no_errors = False
+                self._failed(file, str(e))
+                if any(error in file.message for error in CONNECTION_ERRORS):
+                    self.connection_lost = True
+            else:
+                file.status = 1
+                self.files_pushed += 1
+                self.bytes_pushed += file.datafile.size
+                self._save(file)
+        return no_errors
+
+    def push(self, files, remote_base_dir):
+        """
+        Pushes files, until the connection is lost
+
+        :param QuerySet files: Progress of the files to push
+        :param list remote_base_dir: remote directory to push them into
+        :returns: True if all of the files were pushed
+        :rtype: bool
+        """
+        no_errors = True
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.streams) as executor:
+            for file in files.iterator(chunk_size=self.batch_size):
+                if len(self.pending) >= self.streams:
+                    done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                    no_errors &= self._finish(done)
+                if self.connection_lost:
+                    break
+                file.timestamp = timezone.now()
+                future = self._submit(executor, file, remote_base_dir)
+                if future is None:
+                    no_errors = False
+                else:
+                    self.pending[future] = file
+            no_errors &= self._finish(wait(self.pending).done)
+        self.elapsed += time.monotonic() - started
+        self._flush()
+        return no_errors
+
+
 def complete_request(request_id):
     req = Request.objects.get(pk=request_id)
     total_files = Progress.objects.filter(request=req).count()
@@ -219,7 +375,17 @@ def complete_request(request_id):
         )
 
 
-def make_dirs(sftp_client, dir_list):
+def make_dirs(sftp_client, dir_list, existing=None):
+    """
+    Creates a remote directory and its parents if they don't exist
+
+    :param SFTPClient sftp_client: the SFTP client
+    :param list dir_list: the path elements of the directory
+    :param set existing: paths known to exist, which aren't checked, and to
+        which the paths checked or created are added
+    """
+    if existing is None:
+        existing = set()
     full_path = ""
     for directory in dir_list:
         if full_path:
@@ -229,7 +395,10 @@ def make_dirs(sftp_client, dir_list):
         else:
             full_path = "/"
 
+        if full_path in existing:
+            continue
         try:
             sftp_client.stat(full_path)
         except IOError:  # Raised when the directory doesn't exist
             sftp_client.mkdir(full_path)
+        existing.add(full_path)
@@ -0,0 +1,99 @@
+import hashlib
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from tardis.tardis_portal.models import Dataset, Experiment
+
+from ..models import Credential, Progress, RemoteHost, Request
+from ..tasks import process_request
+
+
+class FakeSFTPClient(object):
+    def __init__(self, remote):
+        self.remote = remote
+
+    def stat(self, path):
+        if path not in self.remote.directories:
+            raise IOError("No such file")
+
+    def mkdir(self, path):
+        self.remote.mkdirs.append(path)
+        self.remote.directories.add(path)
+
+    def putfo(self, file_object, path, size):
+        self.remote.files[path] = file_object.read()
+
+    def close(self):
+        pass
+
+
+class FakeRemote(object):
+    def __init__(self):
+        self.directories = {"/"}
+        self.mkdirs = []
+        self.files = {}
+
+
+class ProcessRequestTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            "aperson", email="abc@example.com", password="abc"
+        )
+        self.experiment = Experiment.objects.create(
+            title="push experiment", created_by=self.user
+        )
+        self.dataset = Dataset.objects.create(description="push_dataset")
+        self.dataset.experiments.add(self.experiment)
+        self.content = b"some data"
+        for i in range(10):
+            datafile = self.dataset.datafile_set.create(
+                filename="file%d.txt" % i,
+                size=len(self.content),
+                md5sum=hashlib.md5(self.content).hexdigest(),
+                directory="a/b" if i % 2 else None,
+            )
+            datafile.file_object = BytesIO(self.content)
+        remote_host = RemoteHost.objects.create(
+            nickname="dummy host", host_name="localhost", administrator=self.user
+        )
+        self.request = Request.objects.create(
+            user=self.user,
+            object_type="dataset",
+            object_id=self.dataset.id,
+            credential=Credential.generate_keypair_credential(
+                self.user, "remote_user", remote_hosts=[remote_host]
+            ),
+            host=remote_host,
+            base_dir="/base",
+        )
+        for datafile in self.dataset.datafile_set.all():
+            Progress.objects.create(request=self.request, datafile=datafile)
+
+    @override_settings(PUSH_TO_TRANSFER_STREAMS=3, PUSH_TO_PROGRESS_BATCH_SIZE=4)
+    def test_parallel_push(self):
+        remote = FakeRemote()
+        ssh = MagicMock()
+        ssh.open_sftp.side_effect = lambda: FakeSFTPClient(remote)
+        with patch.object(Credential, "get_client_for_host", return_value=ssh):
+            process_request(self.request.id)
+        self.assertEqual(ssh.open_sftp.call_count, 3)
+        self.assertFalse(Progress.objects.filter(status=0).exists())
+        self.assertEqual(len(remote.files), 10)
+        self.assertEqual(set(remote.files.values()), {self.content})
+        # each directory is created once
+        base = "/base/mytardis-%d/" % self.request.id
+        self.assertEqual(
+            sorted(remote.mkdirs),
+            sorted(
+                [
+                    "/base/",
+                    base,
+                    base + "push_dataset/",
+                    base + "push_dataset/a/",
+                    base + "push_dataset/a/b/",
+                ]
+            ),
+        )
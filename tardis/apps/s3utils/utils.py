@@ -54,23 +54,9 @@ def generate_presigned_url(dfo, expiry=None):
     )
 
 
-def calculate_checksums(dfo, compute_md5=True, compute_sha512=False):
-    """Calculates checksums for an S3 DataFileObject instance.
-    For files in S3, using the django-storages abstraction is
-    inefficient - we end up with a clash of chunking algorithms
-    between the download from S3 and MyTardis's Python-based checksum
-    calculation.  So for S3 files, we calculate checksums using external
-    binaries (md5sum and shasum) instead.
-
-    :param dfo : The DataFileObject instance
-    :type dfo: DataFileObject
-    :param compute_md5: whether to compute md5 default=True
-    :type compute_md5: bool
-    :param compute_sha512: whether to compute sha512, default=True
-    :type compute_sha512: bool
-
-    :return: the checksums as {'md5sum': result, 'sha512sum': result}
-    :rtype: dict
+def _get_bucket(dfo):
+    """
+    Returns the boto3 Bucket of an S3 DataFileObject's storage box
     """
     from botocore.client import Config
 
@@ -96,7 +82,28 @@ def calculate_checksums(dfo, compute_md5=True, compute_sha512=False):
             continue
         boto3_kwargs[key] = option.value
     s3resource = boto3.resource("s3", **boto3_kwargs)
-    bucket = s3resource.Bucket(options.get(key="bucket_name").value)
+    return s3resource.Bucket(options.get(key="bucket_name").value)
+
+
+def calculate_checksums(dfo, compute_md5=True, compute_sha512=False):
+    """Calculates checksums for an S3 DataFileObject instance.
+    For files in S3, using the django-storages abstraction is
+    inefficient - we end up with a clash of chunking algorithms
+    between the download from S3 and MyTardis's Python-based checksum
+    calculation.  So for S3 files, we calculate checksums using external
+    binaries (md5sum and shasum) instead.
+
+    :param dfo : The DataFileObject instance
+    :type dfo: DataFileObject
+    :param compute_md5: whether to compute md5 default=True
+    :type compute_md5: bool
+    :param compute_sha512: whether to compute sha512, default=True
+    :type compute_sha512: bool
+
+    :return: the checksums as {'md5sum': result, 'sha512sum': result}
+    :rtype: dict
+    """
+    bucket = _get_bucket(dfo)
 
     checksums = {}
 
@@ -121,3 +128,22 @@ def calculate_checksums(dfo, compute_md5=True, compute_sha512=False):
         checksums["sha512sum"] = re.match(b"\w+", stdout).group(0).decode("utf8")
 
     return checksums
+
+
+def get_fingerprint(dfo):
+    """Returns a fingerprint of an S3 DataFileObject, which changes whenever
+    the object is modified, from a single HEAD request rather than by reading
+    the object.
+
+    :param dfo : The DataFileObject instance
+    :type dfo: DataFileObject
+
+    :return: the size, modification time and ETag of the object
+    :rtype: str
+    """
+    s3object = _get_bucket(dfo).Object(dfo.uri)
+    return "%s:%s:%s" % (
+        s3object.content_length,
+        s3object.last_modified.isoformat(),
+        s3object.e_tag,
+    )
@@ -33,8 +33,6 @@ from .utils.api import (
     query_keywords_and_metadata,
     query_apply_filters,
     query_add_sorting,
-    cleaning_acls,
-    cleaning_ids,
     cleaning_preload,
     cleaning_parent_filter,
     cleaning_results,
@@ -328,6 +326,7 @@ class SearchAppResource(Resource):
                 "parameters.numerical.pn_id",
                 "parameters.datetime.pn_id",
                 "acls",
+                "aggregate",
             ]
             # "description" field is crucial for datasets, but too verbose for experiments
             if obj != "dataset":
@@ -357,37 +356,6 @@ class SearchAppResource(Resource):
         # Post-search cleaning
         # --------------------
 
-        # load in object IDs for all objects a user has sensitive access to
-        projects_sens = cleaning_acls(user, groups, "project", canSensitive=True)
-        experiments_sens = cleaning_acls(user, groups, "experiment", canSensitive=True)
-        datasets_sens = cleaning_acls(user, groups, "dataset", canSensitive=True)
-        datafiles_sens = cleaning_acls(user, groups, "datafile", canSensitive=True)
-
-        # load in datafile IDs for all datafiles a user has download access to
-        datafiles_dl = cleaning_acls(user, groups, "datafile", canDownload=True)
-
-        # re-structure into convenient dictionary
-        preloaded = {
-            "project": {"sens_list": projects_sens, "objects": {}},
-            "experiment": {"sens_list": experiments_sens, "objects": {}},
-            "dataset": {"sens_list": datasets_sens, "objects": {}},
-            "datafile": {"sens_list": datafiles_sens, "objects": {}},
-        }
-
-        # load in object IDs for all objects a user has read access to,
-        # and IDs for all of the object's nested-children - regardless of user
-        # access to these child objects (the access check come later)
-        projects = cleaning_ids(user, groups, "project")
-        experiments = cleaning_ids(user, groups, "experiment")
-        datasets = cleaning_ids(user, groups, "dataset")
-        datafiles = cleaning_ids(user, groups, "datafile")
-
-        # add data to preloaded["objects"] dictionary with ID as key
-        # and nested items as value - key/values.
-        preloaded = cleaning_preload(
-            preloaded, projects, experiments, datasets, datafiles
-        )
-
         # Create the result object which will be returned to the front-end
         result_dict = {k: [] for k in ["project", "experiment", "dataset", "datafile"]}
 
@@ -400,13 +368,17 @@ class SearchAppResource(Resource):
             index_list[idx]: len(type.hits.hits) for idx, type in enumerate(results)
         }
 
-        # Pagination done before final cleaning to reduce "clean_parent_ids" duration
+        # Pagination done before final cleaning, so only returned hits are cleaned
         # Default Pagination handled by response.get if key isn't specified
         for item in results:
             item.hits.hits = item.hits.hits[
                 request_offset : (request_offset + request_size)
             ]
 
+        # Load permissions, nested object counts and download rights for the
+        # page of hits only
+        preloaded, datafiles_dl = cleaning_preload(user, results)
+
         # Clean and prepare the results "hit" objects and append them to the results_dict
         result_dict = cleaning_results(results, result_dict, preloaded, datafiles_dl)
 
@@ -1,9 +1,15 @@
 import logging
+from itertools import islice
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Exists, OuterRef, prefetch_related_objects
 from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django_elasticsearch_dsl import Document, fields
+from django_elasticsearch_dsl.apps import DEDConfig
 from django_elasticsearch_dsl.registries import registry
 from elasticsearch_dsl import analyzer, token_filter
 
@@ -30,11 +36,23 @@ from tardis.apps.projects.models import (
     ProjectParameterSet,
     ProjectACL,
 )
+from tardis.tardis_portal.auth.acl_resolver import (
+    datafile_acls_inherited,
+    overriding_datafile_acls,
+)
+from tardis.tardis_portal.models.datafile import datafiles_created, datafiles_deleted
+from .models import ObjectAggregate
+from .signals import (
+    QueuedSignalProcessor,
+    _documents,
+    _related_documents,
+    queue_documents,
+)
 from .utils.documents import (
     generic_acl_structure,
+    generic_aggregate_structure,
     generic_parameter_structure,
-    prepare_generic_acls,
-    prepare_generic_parameters,
+    prepare_generic_bulk,
 )
 
 logger = logging.getLogger(__name__)
@@ -48,6 +66,9 @@ elasticsearch_index_settings = getattr(
 elasticsearch_parallel_index_settings = getattr(
     settings, "ELASTICSEARCH_PARALLEL_INDEX_SETTINGS", {}
 )
+elasticsearch_prepare_chunk_size = getattr(
+    settings, "ELASTICSEARCH_PREPARE_CHUNK_SIZE", 1000
+)
 
 # custom word_delimiter_graph filter to remove "split on numerics" behaviour
 # i.e. XL500XA2 will no longer be split into XL,500,XA,2
@@ -65,13 +86,56 @@ analyzer = analyzer(
 class MyTardisDocument(Document):
     """
     Generalised class for MyTardis objects
+
+    Documents are prepared in chunks of ELASTICSEARCH_PREPARE_CHUNK_SIZE
+    instances: the ACLs, parameters and aggregates of a chunk are loaded with
+    a few queries, and the relations listed in bulk_prefetch are prefetched,
+    before the actions of the chunk are passed on to (parallel_)bulk.
     """
 
+    bulk_prefetch = ["tags"]
+    _prepared_chunk = {}
+
     def parallel_bulk(self, actions, **kwargs):
         Document.parallel_bulk(
             self, actions=actions, **elasticsearch_parallel_index_settings
         )
 
+    def _get_actions(self, object_list, action):
+        object_list = iter(object_list)
+        while True:
+            chunk = list(islice(object_list, elasticsearch_prepare_chunk_size))
+            if not chunk:
+                return
+            if action != "delete":
+                prefetch_related_objects(chunk, *self.bulk_prefetch)
+                self._prepared_chunk = prepare_generic_bulk(
+                    self.django.model._meta.model_name,  # pylint: disable=W0212
+                    chunk,
+                )
+            yield from super()._get_actions(chunk, action)
+            self._prepared_chunk = {}
+
+    def prepare(self, instance):
+        if instance.pk not in self._prepared_chunk:
+            self._prepared_chunk = prepare_generic_bulk(
+                self.django.model._meta.model_name,  # pylint: disable=W0212
+                [instance],
+            )
+        return super().prepare(instance)
+
+    def prepare_public_access(self, instance):
+        return self._prepared_chunk[instance.pk]["public_access"]
+
+    def prepare_acls(self, instance):
+        return self._prepared_chunk[instance.pk]["acls"]
+
+    def prepare_parameters(self, instance):
+        return self._prepared_chunk[instance.pk]["parameters"]
+
+    def prepare_aggregate(self, instance):
+        return self._prepared_chunk[instance.pk]["aggregate"]
+
     id = fields.KeywordField()
     public_access = fields.IntegerField()
     acls = generic_acl_structure()
@@ -104,24 +168,9 @@ class ProjectDocument(MyTardisDocument):
             "fullname": fields.TextField(fields={"raw": fields.KeywordField()}),
         }
     )
+    aggregate = generic_aggregate_structure()
 
-    def prepare_public_access(self, instance):
-        if settings.ONLY_EXPERIMENT_ACLS:
-            flags = instance.experiments.all().values_list("public_access", flat=True)
-            if list(flags):
-                return max(list(flags))
-            return 1
-        return instance.public_access
-
-    def prepare_acls(self, instance):
-        return prepare_generic_acls(
-            "project",
-            instance.projectacl_set.all(),
-            INSTANCE_EXPS=instance.experiments.all(),
-        )
-
-    def prepare_parameters(self, instance):
-        return prepare_generic_parameters(instance, "project")
+    bulk_prefetch = ["tags", "institution", "principal_investigator"]
 
     def prepare_principal_investigator(self, instance):
         username = instance.principal_investigator.username
@@ -137,6 +186,7 @@ class ProjectDocument(MyTardisDocument):
         model = Project
         related_models = [
             User,
+            ObjectAggregate,
             ProjectParameterSet,
             ProjectParameter,
             ParameterName,
@@ -149,6 +199,8 @@ class ProjectDocument(MyTardisDocument):
     def get_instances_from_related(self, related_instance):
         if isinstance(related_instance, User):
             return related_instance.project_set.all()
+        if isinstance(related_instance, ObjectAggregate):
+            return related_instance.project
         if isinstance(related_instance, ProjectParameterSet):
             return related_instance.project
         if isinstance(related_instance, ProjectParameter):
@@ -190,17 +242,15 @@ class ExperimentDocument(MyTardisDocument):
     update_time = fields.DateField()
     institution_name = fields.KeywordField()
     created_by = fields.ObjectField(properties={"username": fields.KeywordField()})
+    aggregate = generic_aggregate_structure()
 
-    def prepare_acls(self, instance):
-        return prepare_generic_acls("experiment", instance.experimentacl_set.all())
-
-    def prepare_parameters(self, instance):
-        return prepare_generic_parameters(instance, "experiment")
+    bulk_prefetch = ["tags", "projects", "created_by"]
 
     class Django:
         model = Experiment
         related_models = [
             User,
+            ObjectAggregate,
             ExperimentACL,
             ExperimentParameterSet,
             ExperimentParameter,
@@ -210,6 +260,8 @@ class ExperimentDocument(MyTardisDocument):
     def get_instances_from_related(self, related_instance):
         if isinstance(related_instance, User):
             return related_instance.experiment_set.all()
+        if isinstance(related_instance, ObjectAggregate):
+            return related_instance.experiment
         if isinstance(related_instance, ExperimentACL):
             return related_instance.experiment
         if isinstance(related_instance, ExperimentParameterSet):
@@ -248,30 +300,16 @@ class DatasetDocument(MyTardisDocument):
     )
     created_time = fields.DateField()
     modified_time = fields.DateField()
+    aggregate = generic_aggregate_structure()
 
-    def prepare_public_access(self, instance):
-        if settings.ONLY_EXPERIMENT_ACLS:
-            flags = instance.experiments.all().values_list("public_access", flat=True)
-            if list(flags):
-                return max(list(flags))
-            return 1
-        return instance.public_access
-
-    def prepare_acls(self, instance):
-        return prepare_generic_acls(
-            "dataset",
-            instance.datasetacl_set.all(),
-            INSTANCE_EXPS=instance.experiments.all(),
-        )
-
-    def prepare_parameters(self, instance):
-        return prepare_generic_parameters(instance, "dataset")
+    bulk_prefetch = ["tags", "experiments", "instrument"]
 
     class Django:
         model = Dataset
         related_models = [
             Experiment,
             Instrument,
+            ObjectAggregate,
             DatasetParameterSet,
             DatasetParameter,
             ParameterName,
@@ -286,6 +324,8 @@ class DatasetDocument(MyTardisDocument):
             return related_instance.datasets.all()
         if isinstance(related_instance, Instrument):
             return related_instance.dataset_set.all()
+        if isinstance(related_instance, ObjectAggregate):
+            return related_instance.dataset
         if isinstance(related_instance, DatasetParameterSet):
             return related_instance.dataset
         if isinstance(related_instance, DatasetParameter):
@@ -329,6 +369,8 @@ class DataFileDocument(MyTardisDocument):
         }
     )
 
+    bulk_prefetch = ["tags", "dataset__experiments", "file_objects"]
+
     def prepare_file_extension(self, instance):
         """
         Retrieve file extensions from filename - File extension taken as the
@@ -345,26 +387,6 @@ class DataFileDocument(MyTardisDocument):
             extension = ""
         return extension
 
-    def prepare_public_access(self, instance):
-        if settings.ONLY_EXPERIMENT_ACLS:
-            flags = instance.dataset.experiments.all().values_list(
-                "public_access", flat=True
-            )
-            if list(flags):
-                return max(list(flags))
-            return 1
-        return instance.public_access
-
-    def prepare_acls(self, instance):
-        return prepare_generic_acls(
-            "datafile",
-            instance.datafileacl_set.all(),
-            INSTANCE_EXPS=instance.dataset.experiments.all(),
-        )
-
-    def prepare_parameters(self, instance):
-        return prepare_generic_parameters(instance, "datafile")
-
     class Django:
         model = DataFile
         related_models = [
@@ -380,6 +402,8 @@ class DataFileDocument(MyTardisDocument):
             related_models += [ExperimentACL]
         else:
             related_models += [DatafileACL]
+            if datafile_acls_inherited():
+                related_models += [DatasetACL]
 
     # def get_queryset(self):
     #    return super().get_queryset().select_related("dataset")
@@ -409,6 +433,17 @@ class DataFileDocument(MyTardisDocument):
         else:
             if isinstance(related_instance, DatafileACL):
                 return related_instance.datafile
+            if isinstance(related_instance, DatasetACL):
+                # only files without ACLs of their own inherit the dataset's
+                # ACLs, and never its public access
+                if (
+                    not datafile_acls_inherited()
+                    or related_instance.user_id == settings.PUBLIC_USER_ID
+                ):
+                    return None
+                return related_instance.dataset.datafile_set.exclude(
+                    Exists(overriding_datafile_acls().filter(datafile=OuterRef("pk")))
+                )
         return None
 
 
@@ -516,6 +551,57 @@ def update_es_relations(instance, **kwargs):
         doc_file.update(datafiles)"""
 
 
+@receiver(datafiles_created, sender=DataFile, dispatch_uid="datafiles_created_index")
+def index_created_datafiles(sender, datafiles, **kwargs):
+    """
+    Indexes DataFiles registered in bulk, which don't send post_save signals,
+    and re-indexes the related documents of their datasets once per dataset
+    """
+    if not DEDConfig.autosync_enabled():
+        return
+    # the related documents are the same for all files of a dataset
+    one_per_dataset = list({df.dataset_id: df for df in datafiles}.values())
+    processor = apps.get_app_config("django_elasticsearch_dsl").signal_processor
+    if isinstance(processor, QueuedSignalProcessor):
+        pairs = []
+        for datafile in datafiles:
+            pairs.extend(_documents(datafile))
+        for datafile in one_per_dataset:
+            pairs.extend(_related_documents(datafile))
+        queue_documents(pairs)
+        return
+
+    def update():
+        for doc in registry.get_documents([sender]):
+            if not doc.django.ignore_signals:
+                doc().update(datafiles)
+        for datafile in one_per_dataset:
+            registry.update_related(datafile)
+
+    # the ACLs of the files are inserted after them
+    transaction.on_commit(update)
+
+
+@receiver(datafiles_deleted, sender=DataFile, dispatch_uid="datafiles_deleted_index")
+def unindex_deleted_datafiles(sender, datafiles, **kwargs):
+    """
+    Queues the documents of DataFiles deleted in bulk, and the related
+    documents of their datasets once per dataset.  The real-time signal
+    processor still handles their deletes one by one.
+    """
+    if not DEDConfig.autosync_enabled():
+        return
+    processor = apps.get_app_config("django_elasticsearch_dsl").signal_processor
+    if not isinstance(processor, QueuedSignalProcessor):
+        return
+    pairs = []
+    for datafile in datafiles:
+        pairs.extend(_documents(datafile))
+    for datafile in {df.dataset_id: df for df in datafiles}.values():
+        pairs.extend(_related_documents(datafile))
+    queue_documents(pairs)
+
+
 def setup_sync_signals():
     # Only enable post_delete signals if ELASTICSEARCH_DSL_AUTOSYNC=True
     if hasattr(settings, "ELASTICSEARCH_DSL_AUTOSYNC"):
@@ -523,14 +609,15 @@ def setup_sync_signals():
         # and whether equal to CelerySignalProcessor
         check_for_celery_processor = False
         if hasattr(settings, "ELASTICSEARCH_DSL_SIGNAL_PROCESSOR"):
-            if (
-                settings.ELASTICSEARCH_DSL_SIGNAL_PROCESSOR
-                == "django_elasticsearch_dsl.signals.CelerySignalProcessor"
+            if settings.ELASTICSEARCH_DSL_SIGNAL_PROCESSOR in (
+                "django_elasticsearch_dsl.signals.CelerySignalProcessor",
+                "tardis.apps.search.signals.QueuedSignalProcessor",
             ):
                 check_for_celery_processor = True
 
         # Only enable post_delete signals if AUTOSYNC=True and
         # ELASTICSEARCH_DSL_SIGNAL_PROCESSOR not set to CelerySignalProcessor
+        # or QueuedSignalProcessor, which re-indexes after the delete anyway
         if settings.ELASTICSEARCH_DSL_AUTOSYNC and not check_for_celery_processor:
             post_delete.connect(update_es_relations, sender=Dataset)
             post_delete.connect(update_es_relations, sender=ProjectACL)
@@ -0,0 +1,134 @@
+# Generated by Django 4.2.10 on 2026-10-18 04:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+
+
+def build_aggregates(apps, schema_editor):
+    """
+    Computes the aggregates of existing projects, experiments and datasets
+    """
+    Project = apps.get_model("projects", "Project")
+    Experiment = apps.get_model("tardis_portal", "Experiment")
+    Dataset = apps.get_model("tardis_portal", "Dataset")
+    DataFile = apps.get_model("tardis_portal", "DataFile")
+    DataFileObject = apps.get_model("tardis_portal", "DataFileObject")
+    ObjectAggregate = apps.get_model("search", "ObjectAggregate")
+
+    verified = Exists(
+        DataFileObject.objects.filter(datafile=OuterRef("pk"), verified=True)
+    )
+    totals = {
+        "datafile_count": Count("id"),
+        "total_size": Sum("size"),
+        "verified_size": Sum("size", filter=Q(verified)),
+    }
+
+    def aggregate(row, **kwargs):
+        return ObjectAggregate(
+            **kwargs,
+            **{key: value or 0 for key, value in row.items()},
+        )
+
+    datafiles = DataFile.objects.order_by()
+    aggregates = {
+        ("dataset", pk): {} for pk in Dataset.objects.values_list("pk", flat=True)
+    }
+    for row in datafiles.values("dataset_id").annotate(**totals):
+        aggregates[("dataset", row.pop("dataset_id"))] = row
+    aggregates.update(
+        (("experiment", pk), {})
+        for pk in Experiment.objects.values_list("pk", flat=True)
+    )
+    for row in (
+        datafiles.filter(dataset__experiments__isnull=False)
+        .values("dataset__experiments")
+        .annotate(**totals)
+    ):
+        aggregates[("experiment", row.pop("dataset__experiments"))] = row
+    for exp_id, count in (
+        Dataset.objects.filter(experiments__isnull=False)
+        .order_by()
+        .values_list("experiments")
+        .annotate(count=Count("id"))
+    ):
+        aggregates[("experiment", exp_id)]["dataset_count"] = count
+    for project_id in Project.objects.values_list("pk", flat=True):
+        project_datasets = Dataset.objects.filter(
+            experiments__projects=project_id
+        ).values("id")
+        row = datafiles.filter(dataset__in=project_datasets).aggregate(**totals)
+        row["dataset_count"] = Dataset.objects.filter(id__in=project_datasets).count()
+        row["experiment_count"] = Experiment.objects.filter(projects=project_id).count()
+        aggregates[("project", project_id)] = row
+
+    ObjectAggregate.objects.bulk_create(
+        (
+            aggregate(row, **{object_type + "_id": object_id})
+            for (object_type, object_id), row in aggregates.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = [
+        ("tardis_portal", "0027_datasetdirectory"),
+        ("projects", "0004_alter_institution_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ObjectAggregate",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("experiment_count", models.BigIntegerField(default=0)),
+                ("dataset_count", models.BigIntegerField(default=0)),
+                ("datafile_count", models.BigIntegerField(default=0)),
+                ("total_size", models.BigIntegerField(default=0)),
+                ("verified_size", models.BigIntegerField(default=0)),
+                (
+                    "dataset",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="aggregate",
+                        to="tardis_portal.dataset",
+                    ),
+                ),
+                (
+                    "experiment",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="aggregate",
+                        to="tardis_portal.experiment",
+                    ),
+                ),
+                (
+                    "project",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="aggregate",
+                        to="projects.project",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(build_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.10 on 2026-10-18 04:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("search", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IndexQueueItem",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("index", models.CharField(max_length=100)),
+                ("object_id", models.BigIntegerField()),
+            ],
+            options={
+                "unique_together": {("index", "object_id")},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("search", "0002_indexqueueitem"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="indexqueueitem",
+            name="claimed",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,465 @@
+"""
+Denormalised counts and sizes of the objects nested in projects, experiments
+and datasets, used by the search app instead of counting them for every hit.
+
+The aggregates are updated incrementally as DataFiles are added, moved,
+resized, verified or deleted, and refreshed from the database when datasets
+or experiments are added to or removed from their parents.
+
+The index queue holds the Elasticsearch documents which are waiting to be
+re-indexed by the coalescing signal processor in signals.py.
+"""
+from django.db import models
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from tardis.apps.projects.models import Project
+from tardis.tardis_portal.models import DataFile, DataFileObject, Dataset, Experiment
+from tardis.tardis_portal.models.datafile import (
+    datafiles_created,
+    datafiles_deleted,
+    dfos_verified,
+)
+
+
+class ObjectAggregate(models.Model):
+    """Counts and sizes of the objects nested in a project, experiment or
+    dataset.  Exactly one of project, experiment and dataset is set.
+
+    :attribute experiment_count: number of experiments in a project
+    :attribute dataset_count: number of distinct datasets in a project or
+        experiment
+    :attribute datafile_count: number of distinct datafiles in a project,
+        experiment or dataset
+    :attribute total_size: total size of those datafiles
+    :attribute verified_size: total size of those datafiles which have at
+        least one verified DataFileObject
+    """
+
+    project = models.OneToOneField(
+        Project,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="aggregate",
+    )
+    experiment = models.OneToOneField(
+        Experiment,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="aggregate",
+    )
+    dataset = models.OneToOneField(
+        Dataset,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="aggregate",
+    )
+    experiment_count = models.BigIntegerField(default=0)
+    dataset_count = models.BigIntegerField(default=0)
+    datafile_count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+    verified_size = models.BigIntegerField(default=0)
+
+    class Meta:
+        app_label = "search"
+
+    def __str__(self):
+        return "%s: %d files, %d bytes" % (
+            self.project or self.experiment or self.dataset,
+            self.datafile_count,
+            self.total_size,
+        )
+
+    @classmethod
+    def add_files(cls, dataset_id, file_count, total_size, verified_size=0):
+        """
+        Adds file_count files of total_size bytes to the aggregates of a
+        dataset and of the experiments and projects it belongs to, or removes
+        them if the values are negative.  Each aggregate is updated once, even
+        if the dataset belongs to a project through several experiments.
+        """
+        if not (file_count or total_size or verified_size):
+            return
+        cls.objects.filter(
+            Q(dataset_id=dataset_id)
+            | Q(experiment__datasets=dataset_id)
+            | Q(project__experiments__datasets=dataset_id)
+        ).update(
+            datafile_count=F("datafile_count") + file_count,
+            total_size=F("total_size") + total_size,
+            verified_size=F("verified_size") + verified_size,
+        )
+
+    @classmethod
+    def refresh(cls, projects=(), experiments=(), datasets=()):
+        """
+        Recomputes the aggregates of the given project, experiment and dataset
+        ids from the database
+        """
+        verified = Exists(
+            DataFileObject.objects.filter(datafile=OuterRef("pk"), verified=True)
+        )
+        totals = {
+            "datafile_count": Count("id"),
+            "total_size": Sum("size"),
+            "verified_size": Sum("size", filter=Q(verified)),
+        }
+        values = {}
+        if datasets:
+            for row in (
+                DataFile.objects.filter(dataset_id__in=datasets)
+                .order_by()
+                .values("dataset_id")
+                .annotate(**totals)
+            ):
+                values[("dataset", row.pop("dataset_id"))] = row
+        if experiments:
+            # a datafile is in an experiment once, through its only dataset
+            for row in (
+                DataFile.objects.filter(dataset__experiments__in=experiments)
+                .order_by()
+                .values("dataset__experiments")
+                .annotate(**totals)
+            ):
+                values[("experiment", row.pop("dataset__experiments"))] = row
+            for exp_id, count in (
+                Dataset.objects.filter(experiments__in=experiments)
+                .order_by()
+                .values_list("experiments")
+                .annotate(count=Count("id"))
+            ):
+                values.setdefault(("experiment", exp_id), {})["dataset_count"] = count
+        for project_id in projects:
+            # datasets may be in a project through several experiments
+            project_datasets = Dataset.objects.filter(
+                experiments__projects=project_id
+            ).values("id")
+            row = DataFile.objects.filter(dataset__in=project_datasets).aggregate(
+                **totals
+            )
+            row["dataset_count"] = Dataset.objects.filter(
+                id__in=project_datasets
+            ).count()
+            row["experiment_count"] = Experiment.objects.filter(
+                projects=project_id
+            ).count()
+            values[("project", project_id)] = row
+
+        for object_type, object_ids in (
+            ("project", projects),
+            ("experiment", experiments),
+            ("dataset", datasets),
+        ):
+            for object_id in object_ids:
+                row = values.get((object_type, object_id), {})
+                cls.objects.update_or_create(
+                    **{object_type + "_id": object_id},
+                    defaults={
+                        field: row.get(field) or 0
+                        for field in (
+                            "experiment_count",
+                            "dataset_count",
+                            "datafile_count",
+                            "total_size",
+                            "verified_size",
+                        )
+                    }
+                )
+
+
+class IndexQueueItem(models.Model):
+    """An Elasticsearch document waiting to be re-indexed, or deleted if its
+    object no longer exists.  Each document is queued at most once, however
+    often its object changes before the queue is flushed.
+
+    :attribute index: name of the Elasticsearch index
+    :attribute object_id: primary key of the indexed object
+    :attribute claimed: whether a flush of the queue is indexing the
+        document, which removes it from the queue once it's indexed
+    """
+
+    index = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    claimed = models.BooleanField(default=False)
+
+    class Meta:
+        app_label = "search"
+        unique_together = ["index", "object_id"]
+
+    def __str__(self):
+        return "%s %s" % (self.index, self.object_id)
+
+
+def _parents(dataset_ids=(), experiment_ids=()):
+    """
+    Returns the ids of the experiments and projects which the given datasets
+    and experiments belong to
+    """
+    experiment_ids = set(experiment_ids) | set(
+        Experiment.objects.filter(datasets__in=dataset_ids).values_list("id", flat=True)
+    )
+    project_ids = set(
+        Project.objects.filter(experiments__in=experiment_ids).values_list(
+            "id", flat=True
+        )
+    )
+    return experiment_ids, project_ids
+
+
+@receiver(post_save, sender=Project, dispatch_uid="project_aggregate_create")
+@receiver(post_save, sender=Experiment, dispatch_uid="experiment_aggregate_create")
+@receiver(post_save, sender=Dataset, dispatch_uid="dataset_aggregate_create")
+def create_aggregate(sender, instance, created, raw=False, **kwargs):
+    """
+    Creates the empty aggregate of a new project, experiment or dataset
+    """
+    if created and not raw:
+        ObjectAggregate.objects.get_or_create(
+            **{sender._meta.model_name: instance}  # pylint: disable=W0212
+        )
+
+
+@receiver(post_save, sender=DataFile, dispatch_uid="datafile_aggregate_save")
+def aggregate_datafile(sender, instance, created, raw=False, **kwargs):
+    """
+    Adds a new DataFile to the aggregates, or moves an updated one if its
+    dataset or size changed.
+
+    The previous dataset and size are those kept by the DataFile pre_save
+    handler of the directory index.
+    """
+    if raw:
+        return
+    size = instance.size or 0
+    old = getattr(instance, "_moved_from", None)
+    if old is not None:
+        old_dataset_id, old_size = old[0], old[2] or 0
+        if (old_dataset_id, old_size) == (instance.dataset_id, size):
+            return
+        verified = instance.file_objects.filter(verified=True).exists()
+        ObjectAggregate.add_files(
+            old_dataset_id, -1, -old_size, -old_size if verified else 0
+        )
+        ObjectAggregate.add_files(instance.dataset_id, 1, size, size if verified else 0)
+    elif created:
+        # a new DataFile can't have any DataFileObjects yet
+        ObjectAggregate.add_files(instance.dataset_id, 1, size)
+
+
+@receiver(
+    datafiles_created, sender=DataFile, dispatch_uid="datafiles_aggregate_created"
+)
+def aggregate_created_datafiles(sender, datafiles, **kwargs):
+    """
+    Adds DataFiles registered in bulk to the aggregates, once per dataset
+    """
+    totals = {}
+    for datafile in datafiles:
+        dataset_totals = totals.setdefault(datafile.dataset_id, [0, 0])
+        dataset_totals[0] += 1
+        dataset_totals[1] += datafile.size or 0
+    for dataset_id, (file_count, total_size) in totals.items():
+        ObjectAggregate.add_files(dataset_id, file_count, total_size)
+
+
+@receiver(post_delete, sender=DataFile, dispatch_uid="datafile_aggregate_delete")
+def unaggregate_datafile(sender, instance, **kwargs):
+    """
+    Removes a deleted DataFile from the aggregates.  Its verified size has
+    been removed as its DataFileObjects were deleted.
+    """
+    if getattr(instance, "_bulk_deleted", False):
+        # removed by unaggregate_deleted_datafiles
+        return
+    ObjectAggregate.add_files(instance.dataset_id, -1, -(instance.size or 0))
+
+
+@receiver(
+    datafiles_deleted, sender=DataFile, dispatch_uid="datafiles_aggregate_deleted"
+)
+def unaggregate_deleted_datafiles(sender, datafiles, **kwargs):
+    """
+    Removes DataFiles deleted in bulk from the aggregates, once per dataset
+    """
+    totals = {}
+    for datafile in datafiles:
+        dataset_totals = totals.setdefault(datafile.dataset_id, [0, 0])
+        dataset_totals[0] += 1
+        dataset_totals[1] += datafile.size or 0
+    for dataset_id, (file_count, total_size) in totals.items():
+        ObjectAggregate.add_files(dataset_id, -file_count, -total_size)
+
+
+@receiver(pre_save, sender=DataFileObject, dispatch_uid="dfo_aggregate_pre_save")
+def remember_dfo_verified(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Keeps the stored verified flag of a DataFileObject which is about to be
+    updated
+    """
+    instance._aggregated_verified = False  # pylint: disable=W0212
+    if update_fields is not None and "verified" not in update_fields:
+        instance._aggregated_verified = None  # pylint: disable=W0212
+    elif not raw and instance.pk is not None and not instance._state.adding:
+        instance._aggregated_verified = (  # pylint: disable=W0212
+            DataFileObject.objects.filter(pk=instance.pk)
+            .values_list("verified", flat=True)
+            .first()
+        )
+
+
+def _verify_datafile(dfo, verified):
+    """
+    Adds or removes the size of the DataFile of a DataFileObject whose
+    verified flag changed to the verified sizes, if no other DataFileObject
+    of the DataFile is verified
+    """
+    if (
+        DataFileObject.objects.filter(datafile_id=dfo.datafile_id, verified=True)
+        .exclude(pk=dfo.pk)
+        .exists()
+    ):
+        return
+    datafile = (
+        DataFile.objects.filter(pk=dfo.datafile_id)
+        .values_list("dataset_id", "size")
+        .first()
+    )
+    if datafile is not None and datafile[1]:
+        ObjectAggregate.add_files(
+            datafile[0], 0, 0, datafile[1] if verified else -datafile[1]
+        )
+
+
+@receiver(post_save, sender=DataFileObject, dispatch_uid="dfo_aggregate_save")
+def aggregate_dfo(sender, instance, raw=False, **kwargs):
+    """
+    Updates the verified sizes if a DataFileObject's verified flag changed
+    """
+    old = getattr(instance, "_aggregated_verified", None)
+    if raw or old is None or bool(old) == instance.verified:
+        return
+    _verify_datafile(instance, instance.verified)
+
+
+@receiver(post_delete, sender=DataFileObject, dispatch_uid="dfo_aggregate_delete")
+def unaggregate_dfo(sender, instance, **kwargs):
+    """
+    Updates the verified sizes if a verified DataFileObject was deleted
+    """
+    if instance.verified:
+        _verify_datafile(instance, False)
+
+
+@receiver(dfos_verified, sender=DataFileObject, dispatch_uid="dfos_aggregate_verified")
+def aggregate_verified_dfos(sender, dfos, **kwargs):
+    """
+    Updates the verified sizes of the datasets whose DataFileObjects were
+    verified in bulk, once per dataset.  Like :py:func:`_verify_datafile`,
+    a DataFile's size only counts once, whichever of its DataFileObjects
+    are verified.
+    """
+    changed = {}
+    for dfo in dfos:
+        changed.setdefault(dfo.datafile_id, []).append(dfo)
+    others_verified = set(
+        DataFileObject.objects.filter(datafile_id__in=changed, verified=True)
+        .exclude(id__in=[dfo.id for dfo in dfos])
+        .values_list("datafile_id", flat=True)
+    )
+    verified_sizes = {}
+    for datafile_id, datafile_dfos in changed.items():
+        if datafile_id in others_verified:
+            continue
+        # the flags of the DataFileObjects changed, so their old values are
+        # the opposite of their new ones
+        was_verified = any(not dfo.verified for dfo in datafile_dfos)
+        is_verified = any(dfo.verified for dfo in datafile_dfos)
+        if was_verified == is_verified:
+            continue
+        datafile = datafile_dfos[0].datafile
+        size = datafile.size or 0
+        verified_sizes[datafile.dataset_id] = verified_sizes.get(
+            datafile.dataset_id, 0
+        ) + (size if is_verified else -size)
+    for dataset_id, verified_size in verified_sizes.items():
+        ObjectAggregate.add_files(dataset_id, 0, 0, verified_size)
+
+
+@receiver(
+    m2m_changed,
+    sender=Dataset.experiments.through,
+    dispatch_uid="dataset_experiments_aggregate",
+)
+@receiver(
+    m2m_changed,
+    sender=Project.experiments.through,
+    dispatch_uid="project_experiments_aggregate",
+)
+def aggregate_membership(
+    sender, instance, action, reverse, model, pk_set, **kwargs
+):  # pylint: disable=W0613
+    """
+    Refreshes the aggregates of experiments and projects whose datasets or
+    experiments changed
+    """
+    if action == "pre_clear":
+        # keep the related objects, which are unknown after clearing
+        instance._aggregated_clear = set(  # pylint: disable=W0212
+            sender.objects.filter(
+                **{instance._meta.model_name: instance.pk}  # pylint: disable=W0212
+            ).values_list(
+                model._meta.model_name + "_id", flat=True  # pylint: disable=W0212
+            )
+        )
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_aggregated_clear", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+    if not pk_set:
+        return
+    if isinstance(instance, Project):
+        ObjectAggregate.refresh(projects=[instance.pk])
+    elif model is Project:
+        ObjectAggregate.refresh(projects=pk_set)
+    else:
+        experiment_ids = pk_set if isinstance(instance, Dataset) else [instance.pk]
+        experiment_ids, project_ids = _parents(experiment_ids=experiment_ids)
+        ObjectAggregate.refresh(projects=project_ids, experiments=experiment_ids)
+
+
+@receiver(pre_delete, sender=Dataset, dispatch_uid="dataset_aggregate_pre_delete")
+@receiver(pre_delete, sender=Experiment, dispatch_uid="experiment_aggregate_pre_delete")
+def remember_aggregate_parents(sender, instance, **kwargs):
+    """
+    Keeps the experiments and projects of a dataset or experiment which is
+    about to be deleted
+    """
+    if isinstance(instance, Dataset):
+        parents = _parents(dataset_ids=[instance.pk])
+    else:
+        parents = set(), _parents(experiment_ids=[instance.pk])[1]
+    instance._aggregated_parents = parents  # pylint: disable=W0212
+
+
+@receiver(post_delete, sender=Dataset, dispatch_uid="dataset_aggregate_delete")
+@receiver(post_delete, sender=Experiment, dispatch_uid="experiment_aggregate_delete")
+def refresh_aggregate_parents(sender, instance, **kwargs):
+    """
+    Refreshes the aggregates of the experiments and projects of a deleted
+    dataset or experiment
+    """
+    experiment_ids, project_ids = getattr(
+        instance, "_aggregated_parents", (set(), set())
+    )
+    ObjectAggregate.refresh(projects=project_ids, experiments=experiment_ids)
@@ -0,0 +1,137 @@
+"""
+Asynchronous, coalescing Elasticsearch index updates
+
+The QueuedSignalProcessor replaces django_elasticsearch_dsl's real-time
+signal processor.  Rather than re-indexing documents on the request path, it
+records the (index, id) pairs of the documents affected by a change in the
+IndexQueueItem table, where repeated changes to the same object are merged,
+and schedules a Celery task which re-indexes all queued documents with bulk
+requests after ELASTICSEARCH_QUEUE_WINDOW seconds.  To use it:
+
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = (
+    "tardis.apps.search.signals.QueuedSignalProcessor"
+)
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, models, transaction
+from django_elasticsearch_dsl.apps import DEDConfig
+from django_elasticsearch_dsl.registries import registry
+from django_elasticsearch_dsl.signals import RealTimeSignalProcessor
+
+from .models import IndexQueueItem
+
+QUEUE_SCHEDULED_KEY = "search_index_queue_scheduled"
+
+
+def get_queue_cache():
+    return caches[getattr(settings, "ELASTICSEARCH_QUEUE_CACHE", "default")]
+
+
+def queue_documents(pairs):
+    """
+    Adds (index, object id) pairs to the index queue, and schedules a flush
+    of the queue unless one is already scheduled.  Documents which are
+    already queued are marked as unclaimed, so that a flush which is
+    indexing them doesn't remove them from the queue.
+
+    :param iterable pairs: (index name, object id) tuples
+    """
+    items = [
+        IndexQueueItem(index=index, object_id=object_id) for index, object_id in pairs
+    ]
+    if not items:
+        return
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ["index", "object_id"]
+    IndexQueueItem.objects.bulk_create(
+        items,
+        batch_size=1000,
+        update_conflicts=True,
+        update_fields=["claimed"],
+        unique_fields=unique_fields,
+    )
+    schedule_flush()
+
+
+def schedule_flush():
+    """
+    Schedules a flush of the index queue, unless one is already scheduled
+    """
+    window = getattr(settings, "ELASTICSEARCH_QUEUE_WINDOW", 5)
+    # the flag expires anyway, in case the scheduled task is lost
+    if get_queue_cache().add(QUEUE_SCHEDULED_KEY, True, window + 60):
+        from .tasks import flush_index_queue
+
+        transaction.on_commit(lambda: flush_index_queue.apply_async(countdown=window))
+
+
+def _documents(instance):
+    """
+    Returns the (index, object id) pairs of the documents of an instance
+    """
+    return [
+        (doc._index._name, instance.pk)  # pylint: disable=W0212
+        for doc in registry.get_documents([instance.__class__])
+        if not doc.django.ignore_signals
+    ]
+
+
+def _related_documents(instance):
+    """
+    Returns the (index, object id) pairs of the documents of the objects
+    related to an instance
+    """
+    pairs = []
+    for doc in registry._get_related_doc(instance):  # pylint: disable=W0212
+        try:
+            related = doc(
+                related_instance_to_ignore=instance
+            ).get_instances_from_related(instance)
+        except ObjectDoesNotExist:
+            related = None
+        if related is None:
+            continue
+        if isinstance(related, models.Model):
+            object_ids = [related.pk]
+        elif isinstance(related, models.QuerySet):
+            object_ids = related.values_list("pk", flat=True)
+        else:
+            object_ids = [obj.pk for obj in related]
+        index = doc._index._name  # pylint: disable=W0212
+        pairs.extend((index, object_id) for object_id in object_ids)
+    return pairs
+
+
+class QueuedSignalProcessor(RealTimeSignalProcessor):
+    """
+    Queues the documents affected by saves and deletes, to be re-indexed in
+    bulk by a Celery task.
+
+    The related documents of a deleted instance are looked up before it is
+    deleted, and re-indexed once it is gone; the document of the deleted
+    instance itself is deleted from the index when the queue is flushed.
+    """
+
+    def handle_save(self, sender, instance, **kwargs):
+        if not DEDConfig.autosync_enabled():
+            return
+        queue_documents(_documents(instance) + _related_documents(instance))
+
+    def handle_pre_delete(self, sender, instance, **kwargs):
+        if not DEDConfig.autosync_enabled() or getattr(
+            instance, "_bulk_deleted", False
+        ):
+            # files deleted in bulk are queued by unindex_deleted_datafiles
+            return
+        queue_documents(_related_documents(instance))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if not DEDConfig.autosync_enabled() or getattr(
+            instance, "_bulk_deleted", False
+        ):
+            # files deleted in bulk are queued by unindex_deleted_datafiles
+            return
+        queue_documents(_documents(instance))
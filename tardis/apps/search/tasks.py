@@ -0,0 +1,64 @@
+import logging
+
+from django.db import transaction
+from django_elasticsearch_dsl.registries import registry
+
+from tardis.celery import tardis_app
+
+from .models import IndexQueueItem
+from .signals import QUEUE_SCHEDULED_KEY, get_queue_cache, schedule_flush
+
+logger = logging.getLogger(__name__)
+
+
+@tardis_app.task(name="search.flush_index_queue", ignore_result=True)
+def flush_index_queue():
+    """
+    Re-indexes the documents in the index queue with one bulk request per
+    index, and deletes the documents of objects which no longer exist.
+
+    The queued documents are claimed, and only removed from the queue once
+    they are indexed, unless they have been queued again in the meantime, so
+    that they are indexed by a later flush if this one fails or is killed.
+    """
+    # changes queued from here on schedule another flush
+    get_queue_cache().delete(QUEUE_SCHEDULED_KEY)
+    with transaction.atomic():
+        items = list(
+            IndexQueueItem.objects.select_for_update().values_list(
+                "id", "index", "object_id"
+            )
+        )
+        for start in range(0, len(items), 1000):
+            IndexQueueItem.objects.filter(
+                id__in=[item[0] for item in items[start : start + 1000]]
+            ).update(claimed=True)
+    queued = {}
+    for dummy_id, index, object_id in items:
+        queued.setdefault(index, set()).add(object_id)
+
+    try:
+        for doc in registry.get_documents():
+            object_ids = queued.get(doc._index._name)  # pylint: disable=W0212
+            if not object_ids:
+                continue
+            doc_instance = doc()
+            instances = doc_instance.get_queryset().filter(pk__in=object_ids)
+            doc_instance.update(instances)
+            deleted = object_ids - set(instances.values_list("pk", flat=True))
+            if deleted:
+                doc_instance.update(
+                    [doc.django.model(pk=pk) for pk in deleted],
+                    action="delete",
+                    raise_on_error=False,
+                )
+    except Exception:
+        logger.exception("Failed to flush the search index queue")
+        # the documents are still queued, to be re-indexed by the next flush
+        schedule_flush()
+        raise
+
+    for start in range(0, len(items), 1000):
+        IndexQueueItem.objects.filter(
+            id__in=[item[0] for item in items[start : start + 1000]], claimed=True
+        ).delete()
@@ -0,0 +1,150 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from tardis.tardis_portal.models import (
+    DataFile,
+    DatafileACL,
+    DatafileParameter,
+    DatafileParameterSet,
+    Dataset,
+    DatasetACL,
+    Experiment,
+    ExperimentACL,
+    ParameterName,
+    Schema,
+)
+
+from ..documents import DataFileDocument
+
+
+class BulkPrepareTest(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="document_user")
+        self.experiment = Experiment.objects.create(
+            title="experiment", created_by=self.user, public_access=50
+        )
+        ExperimentACL.objects.create(
+            experiment=self.experiment, user=self.user, canRead=True, canDownload=True
+        )
+        self.dataset = Dataset.objects.create(description="dataset")
+        self.dataset.experiments.add(self.experiment)
+        self.schema = Schema.objects.create(
+            namespace="http://example.com/documents", type=Schema.DATAFILE
+        )
+        self.names = [
+            ParameterName.objects.create(
+                schema=self.schema, name="string", data_type=ParameterName.STRING
+            ),
+            ParameterName.objects.create(
+                schema=self.schema,
+                name="numeric",
+                data_type=ParameterName.NUMERIC,
+                sensitive=True,
+            ),
+        ]
+        self.add_datafiles(2)
+
+    def add_datafiles(self, count):
+        for idx in range(count):
+            datafile = DataFile.objects.create(
+                dataset=self.dataset,
+                filename="file%d.txt" % idx,
+                size=idx,
+                md5sum="bogus",
+            )
+            DatafileACL.objects.create(
+                datafile=datafile, user=self.user, canRead=True, canSensitive=True
+            )
+            paramset = DatafileParameterSet.objects.create(
+                schema=self.schema, datafile=datafile
+            )
+            DatafileParameter.objects.create(
+                parameterset=paramset, name=self.names[0], string_value="value"
+            )
+            DatafileParameter.objects.create(
+                parameterset=paramset, name=self.names[1], numerical_value=idx
+            )
+
+    def actions(self):
+        return list(DataFileDocument().get_actions(DataFile.objects.all(), "index"))
+
+    def test_prepare(self):
+        source = self.actions()[1]["_source"]
+        self.assertEqual(source["public_access"], 50)
+        self.assertEqual(
+            source["acls"],
+            [
+                {
+                    "pluginId": "django_user",
+                    "entityId": self.user.id,
+                    "canDownload": True,
+                    "canSensitive": False,
+                }
+            ],
+        )
+        self.assertEqual(
+            source["parameters"],
+            {
+                "string": [
+                    {
+                        "pn_id": str(self.names[0].id),
+                        "pn_name": self.names[0].full_name,
+                        "sensitive": False,
+                        "value": "value",
+                    }
+                ],
+                "numerical": [
+                    {
+                        "pn_id": str(self.names[1].id),
+                        "pn_name": self.names[1].full_name,
+                        "sensitive": True,
+                        "value": 1.0,
+                    }
+                ],
+                "datetime": [],
+                "schemas": [{"schema_id": self.schema.id}],
+            },
+        )
+        self.assertEqual(source["dataset"]["experiments"], [{"id": self.experiment.id}])
+
+    @override_settings(ONLY_EXPERIMENT_ACLS=False)
+    def test_prepare_micro_acls(self):
+        source = self.actions()[0]["_source"]
+        self.assertEqual(source["public_access"], DataFile.PUBLIC_ACCESS_NONE)
+        self.assertEqual(
+            source["acls"],
+            [
+                {
+                    "pluginId": "django_user",
+                    "entityId": self.user.id,
+                    "canDownload": False,
+                    "canSensitive": True,
+                }
+            ],
+        )
+
+    @override_settings(ONLY_EXPERIMENT_ACLS=False, DATAFILE_ACL_INHERITANCE=True)
+    def test_related_dataset_acls(self):
+        inheriting = DataFile.objects.create(
+            dataset=self.dataset, filename="inheriting.txt", size=0, md5sum="bogus"
+        )
+        # only files without ACLs of their own are re-indexed
+        acl = DatasetACL(dataset=self.dataset, user=self.user, canRead=True)
+        self.assertEqual(
+            list(DataFileDocument().get_instances_from_related(acl)), [inheriting]
+        )
+        # public access isn't inherited
+        acl.user = self.PUBLIC_USER
+        self.assertIsNone(DataFileDocument().get_instances_from_related(acl))
+
+    def test_queries_per_chunk(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.actions()
+        self.add_datafiles(5)
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(len(self.actions()), 7)
@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tardis.tardis_portal.models import (
+    DataFile,
+    DataFileObject,
+    Dataset,
+    Experiment,
+    StorageBox,
+)
+from tardis.apps.projects.models import Project
+
+from ..models import ObjectAggregate
+
+
+class ObjectAggregateTest(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="aggregate_user")
+        self.project = Project.objects.create(
+            name="project",
+            description="",
+            principal_investigator=self.user,
+            created_by=self.user,
+        )
+        self.experiments = [
+            Experiment.objects.create(title=title, created_by=self.user)
+            for title in ("exp1", "exp2")
+        ]
+        self.project.experiments.add(*self.experiments)
+        self.dataset = Dataset.objects.create(description="dataset")
+        self.dataset.experiments.add(*self.experiments)
+
+    def assertAggregate(self, obj, **expected):
+        aggregate = ObjectAggregate.objects.get(
+            **{obj._meta.model_name: obj}  # pylint: disable=W0212
+        )
+        self.assertEqual(
+            {field: getattr(aggregate, field) for field in expected}, expected
+        )
+
+    def test_datafile_changes(self):
+        datafile = DataFile.objects.create(
+            dataset=self.dataset, filename="file.txt", size=10, md5sum="bogus"
+        )
+        DataFile.objects.create(
+            dataset=self.dataset, filename="other.txt", size=5, md5sum="bogus"
+        )
+        # the dataset is in the project twice, but its files are counted once
+        for obj in (self.project, self.experiments[0], self.dataset):
+            self.assertAggregate(obj, datafile_count=2, total_size=15)
+        self.assertAggregate(self.project, experiment_count=2, dataset_count=1)
+
+        dfo = DataFileObject.objects.create(
+            datafile=datafile,
+            storage_box=StorageBox.get_default_storage(),
+            uri="file.txt",
+        )
+        dfo.verified = True
+        dfo.save(update_fields=["verified"])
+        self.assertAggregate(self.project, verified_size=10)
+
+        datafile.size = 20
+        datafile.save()
+        self.assertAggregate(self.dataset, total_size=25, verified_size=20)
+
+        datafile.delete()
+        for obj in (self.project, self.experiments[1], self.dataset):
+            self.assertAggregate(obj, datafile_count=1, total_size=5, verified_size=0)
+
+    def test_bulk_verification(self):
+        box = StorageBox.get_default_storage()
+        other_box = StorageBox.objects.create(name="other box", max_size=0)
+        dfos = []
+        for idx, size in enumerate((10, 100, 1000)):
+            datafile = DataFile.objects.create(
+                dataset=self.dataset,
+                filename="file%d.txt" % idx,
+                size=size,
+                md5sum="bogus",
+                mimetype="text/plain",
+            )
+            dfos += [
+                DataFileObject.objects.create(
+                    datafile=datafile, storage_box=storage_box, uri=datafile.filename
+                )
+                for storage_box in (box, other_box)
+            ]
+        # the last file already has a verified copy
+        dfos[5].verified = True
+        dfos[5].save(update_fields=["verified"])
+        self.assertAggregate(self.dataset, verified_size=1000)
+
+        # both copies of the first file are verified, but it's counted once
+        with self.captureOnCommitCallbacks(execute=True):
+            DataFileObject.save_verifications(
+                [(dfo, (True, {})) for dfo in dfos[:2] + dfos[4:5]]
+            )
+        for obj in (self.project, self.experiments[0], self.dataset):
+            self.assertAggregate(obj, verified_size=1010)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DataFileObject.save_verifications(
+                [(dfos[0], (False, {})), (dfos[5], (False, {}))]
+            )
+        self.assertAggregate(self.dataset, verified_size=1010)
+        with self.captureOnCommitCallbacks(execute=True):
+            DataFileObject.save_verifications([(dfos[1], (False, {}))])
+        self.assertAggregate(self.project, verified_size=1000)
+
+    def test_membership_changes(self):
+        DataFile.objects.create(
+            dataset=self.dataset, filename="file.txt", size=10, md5sum="bogus"
+        )
+        self.experiments[0].datasets.clear()
+        self.assertAggregate(self.experiments[0], dataset_count=0, datafile_count=0)
+        self.assertAggregate(self.project, dataset_count=1, datafile_count=1)
+        self.project.experiments.remove(self.experiments[1])
+        self.assertAggregate(
+            self.project, experiment_count=1, dataset_count=0, total_size=0
+        )
+        self.dataset.delete()
+        self.assertAggregate(self.experiments[1], dataset_count=0, datafile_count=0)
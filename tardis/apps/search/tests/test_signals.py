@@ -0,0 +1,123 @@
+from unittest.mock import patch
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django_elasticsearch_dsl import Document
+from elasticsearch_dsl.connections import connections
+
+from tardis.tardis_portal.models import DataFile, Dataset, Experiment
+
+from ..models import IndexQueueItem
+from ..signals import QueuedSignalProcessor, queue_documents
+from ..tasks import flush_index_queue
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=True)
+class QueuedSignalProcessorTest(TestCase):
+    def setUp(self):
+        # replace the real-time processor, which would index straight away
+        default_processor = apps.get_app_config(
+            "django_elasticsearch_dsl"
+        ).signal_processor
+        default_processor.teardown()
+        self.addCleanup(default_processor.setup)
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="queue_user")
+        self.experiment = Experiment.objects.create(
+            title="experiment", created_by=self.user
+        )
+        self.dataset = Dataset.objects.create(description="dataset")
+        self.dataset.experiments.add(self.experiment)
+        cache.clear()
+        self.processor = QueuedSignalProcessor(connections)
+        self.addCleanup(self.processor.teardown)
+
+    def queued(self):
+        return set(IndexQueueItem.objects.values_list("index", "object_id"))
+
+    @patch("tardis.apps.search.tasks.flush_index_queue.apply_async")
+    def test_changes_are_coalesced(self, apply_async):
+        with self.captureOnCommitCallbacks(execute=True):
+            datafiles = [
+                DataFile.objects.create(
+                    dataset=self.dataset,
+                    filename="file%d.txt" % idx,
+                    size=idx,
+                    md5sum="bogus",
+                )
+                for idx in range(10)
+            ]
+            for datafile in datafiles:
+                datafile.size += 1
+                datafile.save()
+            # saving the dataset queues the documents of its datafiles
+            self.dataset.save()
+        self.assertEqual(
+            self.queued(),
+            {("datafile", datafile.id) for datafile in datafiles}
+            | {("dataset", self.dataset.id)},
+        )
+        # one flush is scheduled for all of the changes
+        apply_async.assert_called_once_with(
+            countdown=settings.ELASTICSEARCH_QUEUE_WINDOW
+        )
+
+    @patch("tardis.apps.search.tasks.flush_index_queue.apply_async")
+    def test_delete_is_queued(self, apply_async):
+        datafile = DataFile.objects.create(
+            dataset=self.dataset, filename="file.txt", size=1, md5sum="bogus"
+        )
+        IndexQueueItem.objects.all().delete()
+        datafile_id = datafile.id
+        datafile.delete()
+        self.assertEqual(self.queued(), {("datafile", datafile_id)})
+
+    @patch.object(Document, "_bulk")
+    def test_flush(self, bulk):
+        IndexQueueItem.objects.bulk_create(
+            [
+                IndexQueueItem(index="dataset", object_id=self.dataset.id),
+                IndexQueueItem(index="dataset", object_id=self.dataset.id + 1),
+            ]
+        )
+        flush_index_queue()
+        self.assertFalse(IndexQueueItem.objects.exists())
+        actions = [
+            (action["_op_type"], action["_id"])
+            for call in bulk.call_args_list
+            for action in call.args[0]
+        ]
+        self.assertEqual(
+            actions, [("index", self.dataset.id), ("delete", self.dataset.id + 1)]
+        )
+
+    @patch.object(Document, "_bulk")
+    def test_requeued_during_flush(self, bulk):
+        queue_documents([("dataset", self.dataset.id)])
+
+        # the dataset changes again while it is being indexed
+        def requeue(*args, **kwargs):
+            queue_documents([("dataset", self.dataset.id)])
+
+        bulk.side_effect = requeue
+        flush_index_queue()
+        self.assertEqual(self.queued(), {("dataset", self.dataset.id)})
+        self.assertFalse(IndexQueueItem.objects.get().claimed)
+
+    @patch("tardis.apps.search.tasks.flush_index_queue.apply_async")
+    @patch.object(Document, "_bulk", side_effect=RuntimeError("unavailable"))
+    def test_failed_flush(self, bulk, apply_async):
+        queue_documents([("dataset", self.dataset.id)])
+        apply_async.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                flush_index_queue()
+        # the document is indexed by the next flush
+        self.assertEqual(self.queued(), {("dataset", self.dataset.id)})
+        apply_async.assert_called_once_with(
+            countdown=settings.ELASTICSEARCH_QUEUE_WINDOW
+        )
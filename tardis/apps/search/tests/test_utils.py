@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tardis.tardis_portal.models import (
+    DataFile,
+    DatafileACL,
+    Dataset,
+    DatasetACL,
+    Experiment,
+    ExperimentACL,
+)
+from tardis.apps.projects.models import Project, ProjectACL
+
+from ..utils.api import cleaning_preload
+
+
+class CleaningPreloadTest(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="search_user")
+        self.project = Project.objects.create(
+            name="project",
+            description="",
+            principal_investigator=self.user,
+            created_by=self.user,
+        )
+        ProjectACL.objects.create(
+            project=self.project, user=self.user, canRead=True, canSensitive=True
+        )
+        self.experiments = []
+        for title in ("exp1", "exp2"):
+            exp = Experiment.objects.create(title=title, created_by=self.user)
+            ExperimentACL.objects.create(experiment=exp, user=self.user, canRead=True)
+            self.project.experiments.add(exp)
+            self.experiments.append(exp)
+        # one dataset is shared by both experiments, the other isn't readable
+        self.dataset = Dataset.objects.create(description="shared")
+        self.dataset.experiments.add(*self.experiments)
+        DatasetACL.objects.create(dataset=self.dataset, user=self.user, canRead=True)
+        self.hidden = Dataset.objects.create(description="hidden")
+        self.hidden.experiments.add(self.experiments[0])
+
+        def datafile(filename, size, dataset, **acl):
+            df = DataFile.objects.create(
+                dataset=dataset, filename=filename, size=size, md5sum="bogus"
+            )
+            if acl:
+                DatafileACL.objects.create(datafile=df, user=self.user, **acl)
+            return df
+
+        self.downloadable = datafile(
+            "dl.txt", 10, self.dataset, canRead=True, canDownload=True
+        )
+        self.readable = datafile("read.txt", 5, self.dataset, canRead=True)
+        datafile("hidden.txt", 100, self.hidden)
+
+    def hits(self, **ids):
+        return [
+            SimpleNamespace(
+                hits=SimpleNamespace(
+                    hits=[
+                        {"_index": objtype, "_source": {"id": obj_id}}
+                        for obj_id in ids.get(objtype, [])
+                    ]
+                )
+            )
+            for objtype in ("project", "experiment", "dataset", "datafile")
+        ]
+
+    def test_preload_hits(self):
+        preloaded, datafiles_dl = cleaning_preload(
+            self.user,
+            self.hits(
+                project=[self.project.id],
+                experiment=[exp.id for exp in self.experiments],
+                dataset=[self.dataset.id, self.hidden.id],
+                datafile=[self.downloadable.id, self.readable.id],
+            ),
+        )
+        self.assertEqual(preloaded["project"]["sens_list"], {self.project.id})
+        self.assertEqual(
+            preloaded["project"]["objects"][self.project.id],
+            {
+                "counts": {"experiments": 2, "datasets": 2, "datafiles": 3},
+                "size": 115,
+                "userDownloadRights": "partial",
+            },
+        )
+        self.assertEqual(
+            preloaded["experiment"]["objects"][self.experiments[0].id]["counts"],
+            {"datasets": 2, "datafiles": 3},
+        )
+        self.assertEqual([*preloaded["dataset"]["objects"]], [self.dataset.id])
+        self.assertEqual(datafiles_dl, {self.downloadable.id})
+
+    def test_only_hits_are_loaded(self):
+        preloaded, datafiles_dl = cleaning_preload(
+            self.user, self.hits(dataset=[self.dataset.id])
+        )
+        self.assertEqual(preloaded["project"]["objects"], {})
+        self.assertEqual(preloaded["datafile"]["objects"], {})
+        self.assertEqual(datafiles_dl, set())
+        self.assertEqual(
+            preloaded["dataset"]["objects"][self.dataset.id],
+            {"counts": {"datafiles": 2}, "size": 15, "userDownloadRights": "partial"},
+        )
@@ -2,15 +2,39 @@
 helper functions used in api.py
 """
 
-from datetime import datetime
-
+from django.db.models import Count, Q as ModelQ
 from django.template.defaultfilters import filesizeformat
 from elasticsearch_dsl import Q
 
+from tardis.tardis_portal.auth.acl_resolver import ACLResolver, get_acl_model
 from tardis.tardis_portal.models import (
+    DataFile,
     Schema,
 )
 
+from ..models import ObjectAggregate
+
+HIERARCHY = ["project", "experiment", "dataset", "datafile"]
+
+# lookups from datafiles to the IDs of the objects they are nested in
+DATAFILE_PARENT_LOOKUPS = {
+    "project": "dataset__experiments__projects__id",
+    "experiment": "dataset__experiments__id",
+    "dataset": "dataset_id",
+}
+
+# nested object counts returned for each object type, and the aggregate
+# fields they come from
+NESTED_COUNTS = {
+    "project": {
+        "experiments": "experiment_count",
+        "datasets": "dataset_count",
+        "datafiles": "datafile_count",
+    },
+    "experiment": {"datasets": "dataset_count", "datafiles": "datafile_count"},
+    "dataset": {"datafiles": "datafile_count"},
+}
+
 
 def cleaning_results(results, result_dict, preloaded, datafiles_dl):
     """
@@ -29,7 +53,7 @@ def cleaning_results(results, result_dict, preloaded, datafiles_dl):
             sensitive_bool = False
             size = 0
             # If user/group has sensitive permission, update flag
-            if hit["_source"]["id"] in preloaded[hit["_index"]]["sens_list"]:
+            if int(hit["_source"]["id"]) in preloaded[hit["_index"]]["sens_list"]:
                 sensitive_bool = True
             # Re-package parameters into single parameter list
             param_list = []
@@ -48,63 +72,19 @@ def cleaning_results(results, result_dict, preloaded, datafiles_dl):
 
             # Get count of all nested objects and download status
             if hit["_index"] == "datafile":
-                if hit["_source"]["id"] in datafiles_dl:
+                if int(hit["_source"]["id"]) in datafiles_dl:
                     hit["_source"]["userDownloadRights"] = "full"
                     size = hit["_source"]["size"]
                 else:
                     hit["_source"]["userDownloadRights"] = "none"
 
             else:
-                safe_nested_dfs_set = {*preloaded["datafile"]["objects"]}.intersection(
-                    preloaded[hit["_index"]]["objects"][hit["_source"]["id"]]["dfs"]
-                )
-                safe_nested_dfs_count = len(safe_nested_dfs_set)
-                if hit["_index"] in {"project", "experiment"}:
-                    safe_nested_set = len(
-                        {*preloaded["dataset"]["objects"]}.intersection(
-                            preloaded[hit["_index"]]["objects"][hit["_source"]["id"]][
-                                "sets"
-                            ]
-                        )
-                    )
-                # Ugly hack, should do a nicer, less verbose loop+type detection
-                if hit["_index"] == "project":
-                    safe_nested_exp = len(
-                        {*preloaded["experiment"]["objects"]}.intersection(
-                            preloaded[hit["_index"]]["objects"][hit["_source"]["id"]][
-                                "exps"
-                            ]
-                        )
-                    )
-                    hit["_source"]["counts"] = {
-                        "experiments": safe_nested_exp,
-                        "datasets": safe_nested_set,
-                        "datafiles": (safe_nested_dfs_count),
-                    }
-                if hit["_index"] == "experiment":
-                    hit["_source"]["counts"] = {
-                        "datasets": safe_nested_set,
-                        "datafiles": safe_nested_dfs_count,
-                    }
-                if hit["_index"] == "dataset":
-                    hit["_source"]["counts"] = {"datafiles": safe_nested_dfs_count}
-                # Get downloadable datafiles ultimately belonging to this "hit" object
-                # and calculate the total size of these files
-                safe_nested_dfs_dl = [*safe_nested_dfs_set.intersection(datafiles_dl)]
-                size = sum(
-                    (
-                        preloaded["datafile"]["objects"][id]["size"]
-                        for id in safe_nested_dfs_dl
-                    )
-                )
-                # Determine the download state of the "hit" object
-                # safe_nested_dfs_dl_bool = [id in datafiles_dl for id in safe_nested_dfs]
-                if safe_nested_dfs_set.issubset(datafiles_dl):
-                    hit["_source"]["userDownloadRights"] = "full"
-                elif safe_nested_dfs_set.intersection(datafiles_dl):
-                    hit["_source"]["userDownloadRights"] = "partial"
-                else:
-                    hit["_source"]["userDownloadRights"] = "none"
+                nested = preloaded[hit["_index"]]["objects"][int(hit["_source"]["id"])]
+                hit["_source"]["counts"] = nested["counts"]
+                # size of the datafiles ultimately belonging to this "hit"
+                # object, and the user's download state on them
+                size = nested["size"]
+                hit["_source"]["userDownloadRights"] = nested["userDownloadRights"]
 
             hit["_source"]["size"] = filesizeformat(size)
 
@@ -160,192 +140,92 @@ def cleaning_parent_filter(results, filter_level):
     return results
 
 
-def cleaning_preload(preloaded, projects, experiments, datasets, datafiles):
-    """
-    Populate the preload dictionary with IDs and child IDs of search results.
-    """
-
-    # Probably a cleaner/simpler way to do this, but hey ho!
-    for otype, id_list in {
-        "project": projects,
-        "experiment": experiments,
-        "dataset": datasets,
-        "datafile": datafiles,
-    }.items():
-        # iterate over objects in list - each list element has the obj_id
-        # followed by separated lists of any children objects
-        for ids in id_list:
-            # extract object ID
-            obj_id = ids[0]
-            # Check if the ID already exists in preloaded dict
-            if obj_id in preloaded[otype]["objects"]:
-                # add nested children to the dict
-                # Note: Datafiles don't have children so only in the else clause
-                if otype == "dataset":
-                    preloaded[otype]["objects"][obj_id]["dfs"].add(ids[1])
-                elif otype == "experiment":
-                    preloaded[otype]["objects"][obj_id]["sets"].add(ids[1])
-                    preloaded[otype]["objects"][obj_id]["dfs"].add(ids[2])
-                elif otype == "project":
-                    preloaded[otype]["objects"][obj_id]["exps"].add(ids[1])
-                    preloaded[otype]["objects"][obj_id]["sets"].add(ids[2])
-                    preloaded[otype]["objects"][obj_id]["dfs"].add(ids[3])
-            else:
-                # create the new dict for the object and populate with
-                # children (proj/exp/set) or datafile size (datafile)
-                new_dict = {}
-                if otype == "datafile":
-                    new_dict["size"] = ids[1]
-                elif otype == "dataset":
-                    new_dict["dfs"] = {ids[1]}
-                elif otype == "experiment":
-                    new_dict["sets"] = {ids[1]}
-                    new_dict["dfs"] = {ids[2]}
-                elif otype == "project":
-                    new_dict["exps"] = {ids[1]}
-                    new_dict["sets"] = {ids[2]}
-                    new_dict["dfs"] = {ids[3]}
-                # assign new dict to preloaded dict
-                preloaded[otype]["objects"][obj_id] = new_dict
-    return preloaded
-
-
-def cleaning_ids(user, groups, objtype):
-    """
-    Function to build up generic object queries to get ID information
-    on objects, and specifically also the size of Datafiles.
+def cleaning_preload(user, results):
     """
+    Load the sensitive and download permissions, counts of nested objects and
+    total sizes of the objects in the search results.
 
-    if objtype == "project":
-        prefetch_fields = [
-            "project__experiments",
-            "project__experiments__datasets",
-            "project__experiments__datasets__datafile",
-        ]
-        value_fields = [field + "__id" for field in prefetch_fields]
-
-    if objtype == "experiment":
-        prefetch_fields = [
-            "experiment__datasets",
-            "experiment__datasets__datafile",
-        ]
-        value_fields = [field + "__id" for field in prefetch_fields]
-
-    if objtype == "dataset":
-        prefetch_fields = [
-            "dataset__datafile",
-        ]
-        value_fields = [field + "__id" for field in prefetch_fields]
-
-    if objtype == "datafile":
-        prefetch_fields = None
-        value_fields = ["datafile__size"]
-
-    id_list = cleaning_acls(
-        user,
-        groups,
-        objtype,
-        prefetch_fields=prefetch_fields,
-        value_fields=value_fields,
-        flat=False,
-    )
-    return id_list
-
-
-def cleaning_acls(
-    user,
-    groups,
-    objtype,
-    canSensitive=False,
-    canDownload=False,
-    prefetch_fields=None,
-    value_fields=None,
-    flat=True,
-):
+    Only the hits in the results are resolved, so this should be called after
+    pagination; its cost depends on the page of hits rather than on every
+    object the user has access to.
     """
-    Function to build up generic object queries to get ACL or ID information
-    on objects.
-    """
-    if objtype == "project":
-        entity = user.projectacls
-    if objtype == "experiment":
-        entity = user.experimentacls
-    if objtype == "dataset":
-        entity = user.datasetacls
-    if objtype == "datafile":
-        entity = user.datafileacls
-
-    query = cleaning_acl_query(
-        entity,
-        objtype,
-        canSensitive=canSensitive,
-        canDownload=canDownload,
-        prefetch_fields=prefetch_fields,
-        value_fields=value_fields,
-        flat=flat,
-    )
-    for group in groups:
+    resolver = ACLResolver.for_user(user)
 
-        if objtype == "project":
-            entity = group.projectacls
-        if objtype == "experiment":
-            entity = group.experimentacls
-        if objtype == "dataset":
-            entity = group.datasetacls
-        if objtype == "datafile":
-            entity = group.datafileacls
-
-        query |= cleaning_acl_query(
-            entity,
-            objtype,
-            canSensitive=canSensitive,
-            canDownload=canDownload,
-            prefetch_fields=prefetch_fields,
-            value_fields=value_fields,
-            flat=flat,
+    hit_ids = {objtype: set() for objtype in HIERARCHY}
+    for item in results:
+        for hit in item.hits.hits:
+            hit_ids[hit["_index"]].add(int(hit["_source"]["id"]))
+
+    preloaded = {}
+    datafiles_dl = set()
+    for objtype, ids in hit_ids.items():
+        preloaded[objtype] = {"sens_list": set(), "objects": {}}
+        if not ids:
+            continue
+        # load the ACLs of the hits only - objects without ACLs for this user
+        # are dropped from the results by cleaning_results
+        dummy_model, fk = get_acl_model(objtype)
+        for obj_id, sensitive, download in (
+            resolver.acls(objtype)
+            .filter(**{fk + "_id__in": ids})
+            .values_list(fk + "_id", "canSensitive", "canDownload")
+        ):
+            preloaded[objtype]["objects"][obj_id] = {}
+            if sensitive:
+                preloaded[objtype]["sens_list"].add(obj_id)
+            if download and objtype == "datafile":
+                datafiles_dl.add(obj_id)
+        if objtype != "datafile":
+            cleaning_nested(resolver, objtype, preloaded[objtype]["objects"])
+    return preloaded, datafiles_dl
+
+
+def cleaning_nested(resolver, objtype, objects):
+    """
+    Add the counts of nested objects and the total size of nested datafiles,
+    from the aggregates of the objects, and the user's download rights on the
+    nested datafiles to each object in objects, a dictionary with object IDs
+    as keys.
+    """
+    if not objects:
+        return
+    ids = [*objects]
+    count_fields = NESTED_COUNTS[objtype]
+    aggregates = {
+        row[0]: row[1:]
+        for row in ObjectAggregate.objects.filter(
+            **{objtype + "_id__in": ids}
+        ).values_list(objtype + "_id", *count_fields.values(), "total_size")
+    }
+    for obj_id in ids:
+        values = aggregates.get(obj_id, (0,) * (len(count_fields) + 1))
+        objects[obj_id].update(
+            counts=dict(zip(count_fields, values)),
+            size=values[-1],
+            userDownloadRights="full",
         )
-    return [*query.distinct()]
-
-
-def cleaning_acl_query(
-    entity_acls,
-    objtype,
-    canSensitive=False,
-    canDownload=False,
-    prefetch_fields=None,
-    value_fields=None,
-    flat=True,
-):
-    """
-    Function to build up generic object queries to get ACL or ID information
-    on objects.
-    """
-    # build query on object and related ACLs
-    query = entity_acls.select_related(objtype)
-
-    # apply specific ACL perm filter
-    if canSensitive is True:
-        query = query.filter(canSensitive=True)
-    if canDownload is True:
-        query = query.filter(canSensitive=True)
-
-    # if prefetch_fields are specified, add prefetch to query
-    if prefetch_fields is not None:
-        query = query.prefetch_related(*prefetch_fields)
-
-    # exclude too-new/expired ACLs
-    query = query.exclude(
-        effectiveDate__gte=datetime.today(),
-        expiryDate__lte=datetime.today(),
-    )
-
-    # add OBJ__id to values_list return
-    value_list_to_add = [objtype + "__id"]
-    # if list of extra values_list specified, add them to query
-    if value_fields is not None:
-        value_list_to_add.extend(value_fields)
 
-    return query.values_list(*value_list_to_add, flat=flat)
+    # count the accessible and downloadable nested datafiles once per parent,
+    # however many paths lead from the parent to them
+    parent_lookup = DATAFILE_PARENT_LOOKUPS[objtype]
+    downloadable = ModelQ(
+        id__in=resolver.object_ids("datafile", perms={"canDownload": True})
+    )
+    for obj_id, count, downloadable_count in (
+        DataFile.objects.filter(
+            **{parent_lookup + "__in": ids, "id__in": resolver.object_ids("datafile")}
+        )
+        .order_by()
+        .values_list(parent_lookup)
+        .annotate(
+            count=Count("id", distinct=True),
+            downloadable=Count("id", distinct=True, filter=downloadable),
+        )
+    ):
+        if downloadable_count == 0:
+            objects[obj_id]["userDownloadRights"] = "none"
+        elif downloadable_count < count:
+            objects[obj_id]["userDownloadRights"] = "partial"
 
 
 def query_add_sorting(request_sorting, obj, sort_dict):
@@ -393,11 +273,10 @@ def query_add_sorting(request_sorting, obj, sort_dict):
                     # for datafile size is easy to calculate
                     if obj == "datafile":
                         sort_dict[sort["field"][0]] = {"order": sort["order"]}
-                    # for parent models we need ACL context for this,
-                    # which is currently not available in ES.
+                    # for parent models sort on the total size of nested
+                    # datafiles indexed from their aggregates
                     else:
-                        # DO THIS SORTING AFTER ELASTICSEARCH
-                        pass
+                        sort_dict["aggregate.size"] = {"order": sort["order"]}
                 else:
                     sort_dict[sort["field"][0]] = {"order": sort["order"]}
     return sort_dict
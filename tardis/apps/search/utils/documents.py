@@ -6,16 +6,27 @@ from django.conf import settings
 from django_elasticsearch_dsl import fields
 
 from tardis.tardis_portal.models import (
-    ParameterName,
+    Dataset,
+    Experiment,
+    ExperimentACL,
     ExperimentParameter,
     DatasetParameter,
     DatafileParameter,
+    Schema,
+)
+from tardis.tardis_portal.auth.acl_resolver import (
+    datafile_acls_inherited,
+    get_acl_model,
+    overriding_datafile_acls,
 )
 
 from tardis.apps.projects.models import (
+    Project,
     ProjectParameter,
 )
 
+from ..models import ObjectAggregate
+
 
 def generic_acl_structure():
     """
@@ -34,6 +45,25 @@ def generic_acl_structure():
     )
 
 
+def generic_aggregate_structure():
+    """
+    Return the ES structure of the aggregate of a project/experiment/dataset.
+
+    - experiments/datasets/datafiles: counts of nested objects
+    - size: total size of nested datafiles
+    - verified_size: total size of nested verified datafiles
+    """
+    return fields.ObjectField(
+        properties={
+            "experiments": fields.LongField(),
+            "datasets": fields.LongField(),
+            "datafiles": fields.LongField(),
+            "size": fields.LongField(),
+            "verified_size": fields.LongField(),
+        }
+    )
+
+
 def generic_parameter_structure():
     """
     Return the ES structure of object parameters and schema.
@@ -105,93 +135,141 @@ def prepare_generic_acls_build(INSTANCE_ACL_SET, return_list):
             return_list.append(acl_dict)
 
 
-def prepare_generic_acls(type, INSTANCE_ACL_SET, INSTANCE_EXPS=None):
-    """Returns the ACLs associated with this
-    object, formatted for elasticsearch.
-
-    This function is mostly just a wrapper around "prepare_generic_acls_build"
-    to account for current macro/micro behaviour.
+def bulk_experiments(type, instances):
+    """Returns the IDs of the experiments of each of the provided
+    project/dataset/datafile instances, as a dictionary with instance IDs as
+    keys, and the public_access flags of these experiments.
     """
-    return_list = []
-    if settings.ONLY_EXPERIMENT_ACLS and type != "experiment":
-        for exp in INSTANCE_EXPS.all():
-            prepare_generic_acls_build(
-                exp.experimentacl_set.select_related("user", "group", "token")
-                .all()
-                .exclude(user__id=settings.PUBLIC_USER_ID)
-                .values(
-                    "user__id",
-                    "group__id",
-                    "token__id",
-                    "canDownload",
-                    "canSensitive",
-                ),
-                return_list,
-            )
+    if type == "project":
+        links = Project.experiments.through.objects.filter(
+            project_id__in=[instance.pk for instance in instances]
+        ).values_list("project_id", "experiment_id")
     else:
-        prepare_generic_acls_build(
-            INSTANCE_ACL_SET.select_related("user", "group", "token")
-            .all()
-            .exclude(user__id=settings.PUBLIC_USER_ID)
-            .values(
-                "user__id",
-                "group__id",
-                "token__id",
-                "canDownload",
-                "canSensitive",
-            ),
-            return_list,
+        links = Dataset.experiments.through.objects.filter(
+            dataset_id__in={
+                instance.pk if type == "dataset" else instance.dataset_id
+                for instance in instances
+            }
+        ).values_list("dataset_id", "experiment_id")
+    linked = {}
+    for obj_id, exp_id in links.order_by("experiment_id"):
+        linked.setdefault(obj_id, []).append(exp_id)
+    experiments = {
+        instance.pk: linked.get(
+            instance.pk if type != "datafile" else instance.dataset_id, []
         )
-    return return_list
+        for instance in instances
+    }
+    public_access = dict(
+        Experiment.objects.filter(
+            id__in={exp_id for exp_ids in linked.values() for exp_id in exp_ids}
+        ).values_list("id", "public_access")
+    )
+    return experiments, public_access
 
 
-def prepare_generic_parameters(instance, type):
-    """Returns the parameters associated with the provided instance,
-    formatted for elasticsearch."""
+def bulk_prepare_acls(type, ids, experiments=None):
+    """Returns the ACLs associated with each of the provided object IDs,
+    formatted for elasticsearch, as a dictionary with the IDs as keys.
 
+    The ACLs of experiments are used for projects, datasets and datafiles
+    if ONLY_EXPERIMENT_ACLS, in which case experiments maps the object IDs
+    to the IDs of their experiments.
+    """
+    if experiments is not None:
+        acl_model, fk = ExperimentACL, "experiment"
+        acl_ids = {exp_id for exp_ids in experiments.values() for exp_id in exp_ids}
+    else:
+        acl_model, fk = get_acl_model(type)
+        acl_ids = ids
+        experiments = {obj_id: [obj_id] for obj_id in ids}
+    acls = {}
+    for acl in (
+        acl_model.objects.filter(**{fk + "_id__in": acl_ids})
+        .exclude(user__id=settings.PUBLIC_USER_ID)
+        .values(
+            fk + "_id",
+            "user__id",
+            "group__id",
+            "token__id",
+            "canDownload",
+            "canSensitive",
+        )
+    ):
+        acls.setdefault(acl.pop(fk + "_id"), []).append(acl)
+    return_dict = {}
+    for obj_id in ids:
+        return_list = []
+        for acl_id in experiments[obj_id]:
+            prepare_generic_acls_build(acls.get(acl_id, []), return_list)
+        return_dict[obj_id] = return_list
+    return return_dict
+
+
+def bulk_prepare_parameters(type, ids):
+    """Returns the parameters associated with each of the provided object
+    IDs, formatted for elasticsearch, as a dictionary with the IDs as keys.
+    """
     type_dict = {
-        "project": ProjectParameter,
-        "experiment": ExperimentParameter,
-        "dataset": DatasetParameter,
-        "datafile": DatafileParameter,
+        "project": (ProjectParameter, Schema.PROJECT),
+        "experiment": (ExperimentParameter, Schema.EXPERIMENT),
+        "dataset": (DatasetParameter, Schema.DATASET),
+        "datafile": (DatafileParameter, Schema.DATAFILE),
     }
-    OBJPARAMETERS = type_dict[type]
+    OBJPARAMETERS, schema_type = type_dict[type]
+    PARAMETERSETS = OBJPARAMETERS._meta.get_field(  # pylint: disable=W0212
+        "parameterset"
+    ).related_model
 
-    # get list of object parametersets
-    paramsets = list(instance.getParameterSets())
     parameter_groups = {
-        "string": [],
-        "numerical": [],
-        "datetime": [],
-        "schemas": [],
+        obj_id: {
+            "string": [],
+            "numerical": [],
+            "datetime": [],
+            "schemas": [],
+        }
+        for obj_id in ids
     }
-    # iterate over parametersets of an object
-    for paramset in paramsets:
-        param_type = {1: "datetime", 2: "string", 3: "numerical"}
-        # query parameters from parameterset
-        param_glob = OBJPARAMETERS.objects.filter(parameterset=paramset).values_list(
-            "name",
-            "datetime_value",
-            "string_value",
-            "numerical_value",
-        )
+    # query the parametersets of all objects
+    paramsets = PARAMETERSETS.objects.filter(
+        **{type + "__in": ids, "schema__type": schema_type}
+    ).values_list("id", type + "_id", "schema_id")
+    # query the parameters of all parametersets with their parametername info
+    param_glob = {}
+    for sublist in OBJPARAMETERS.objects.filter(
+        **{
+            "parameterset__" + type + "__in": ids,
+            "parameterset__schema__type": schema_type,
+        }
+    ).values_list(
+        "parameterset_id",
+        "name_id",
+        "name__full_name",
+        "name__sensitive",
+        "datetime_value",
+        "string_value",
+        "numerical_value",
+    ):
+        param_glob.setdefault(sublist[0], []).append(sublist[1:])
+
+    param_type = {1: "datetime", 2: "string", 3: "numerical"}
+    # iterate over parametersets of the objects
+    for paramset_id, obj_id, schema_id in paramsets:
         # add schema information to dict
-        parameter_groups["schemas"].append({"schema_id": paramset.schema_id})
+        parameter_groups[obj_id]["schemas"].append({"schema_id": schema_id})
         # iterate over parameter info "name/datetime/string/numerical"
-        for sublist in param_glob:
-            # query parametername info using "name"
-            PN = ParameterName.objects.get(id=sublist[0])
+        for pn_id, pn_name, sensitive, *values in param_glob.get(paramset_id, []):
             # build dict for param
             param_dict = {}
             type_idx = 0
             # iterate over datetime/string/numerical info
-            for idx, value in enumerate(sublist[1:]):
+            for idx, value in enumerate(values):
                 # if datetime/string/numerical atually contains info
                 if value not in [None, ""]:
                     # add parametername info to dict
-                    param_dict["pn_id"] = str(PN.id)
-                    param_dict["pn_name"] = str(PN.full_name)
-                    param_dict["sensitive"] = PN.sensitive
+                    param_dict["pn_id"] = str(pn_id)
+                    param_dict["pn_name"] = str(pn_name)
+                    param_dict["sensitive"] = sensitive
                     type_idx = idx + 1
                     # detect type of param, and add value to dict
                     if type_idx == 1:
@@ -203,5 +281,69 @@ def prepare_generic_parameters(instance, type):
             # if parameter with a value is added, add param_dict to
             # parameters_dict
             if type_idx:
-                parameter_groups[param_type[type_idx]].append(param_dict)
+                parameter_groups[obj_id][param_type[type_idx]].append(param_dict)
     return parameter_groups
+
+
+def bulk_prepare_aggregates(type, ids):
+    """Returns the aggregate of each of the provided project/experiment/
+    dataset IDs, formatted for elasticsearch, as a dictionary with the IDs
+    as keys.
+    """
+    return_dict = dict.fromkeys(ids)
+    for aggregate in ObjectAggregate.objects.filter(**{type + "_id__in": ids}):
+        return_dict[getattr(aggregate, type + "_id")] = {
+            "experiments": aggregate.experiment_count,
+            "datasets": aggregate.dataset_count,
+            "datafiles": aggregate.datafile_count,
+            "size": aggregate.total_size,
+            "verified_size": aggregate.verified_size,
+        }
+    return return_dict
+
+
+def prepare_generic_bulk(type, instances):
+    """Returns the ACLs, parameters, public_access flag and aggregate of each
+    of the provided instances, formatted for elasticsearch, as a dictionary
+    with instance IDs as keys.
+
+    The related objects of all instances are loaded with a fixed number of
+    queries, so that documents can be prepared in chunks rather than running
+    queries for every instance.
+    """
+    ids = [instance.pk for instance in instances]
+    experiments = None
+    prepared = {
+        instance.pk: {"public_access": instance.public_access} for instance in instances
+    }
+    # account for current macro/micro behaviour
+    if settings.ONLY_EXPERIMENT_ACLS and type != "experiment":
+        experiments, public_access = bulk_experiments(type, instances)
+        for obj_id, exp_ids in experiments.items():
+            prepared[obj_id]["public_access"] = max(
+                (public_access[exp_id] for exp_id in exp_ids), default=1
+            )
+    acls = bulk_prepare_acls(type, ids, experiments)
+    if type == "datafile" and experiments is None and datafile_acls_inherited():
+        # files without ACLs of their own have those of their dataset
+        overridden = set(
+            overriding_datafile_acls()
+            .filter(datafile_id__in=ids)
+            .values_list("datafile_id", flat=True)
+        )
+        inheriting = [
+            instance for instance in instances if instance.pk not in overridden
+        ]
+        dataset_acls = bulk_prepare_acls(
+            "dataset", {instance.dataset_id for instance in inheriting}
+        )
+        for instance in inheriting:
+            acls[instance.pk] = dataset_acls[instance.dataset_id]
+    for obj_id, obj_acls in acls.items():
+        prepared[obj_id]["acls"] = obj_acls
+    for obj_id, parameters in bulk_prepare_parameters(type, ids).items():
+        prepared[obj_id]["parameters"] = parameters
+    if type != "datafile":
+        for obj_id, aggregate in bulk_prepare_aggregates(type, ids).items():
+            prepared[obj_id]["aggregate"] = aggregate
+    return prepared
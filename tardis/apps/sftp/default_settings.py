@@ -7,6 +7,48 @@ SFTP_PORT = 2200
 #     "-----END RSA PRIVATE KEY-----\n")
 SFTP_HOST_KEY = ""
 
+SFTP_MAX_CONNECTIONS = 100
+"""
+Maximum number of simultaneous connections to the SFTP server, each of which
+is handled by its own thread.  0 means no limit.
+"""
+
+SFTP_MAX_CONNECTIONS_PER_USER = 10
+"""
+Maximum number of simultaneous SFTP connections of each user.  Logins beyond
+the limit fail.  0 means no limit.
+"""
+
+SFTP_TREE_TTL = 60
+"""
+Number of seconds for which the experiments, datasets and files listed by an
+SFTP session are kept in memory before they are queried again.
+"""
+
+SFTP_READ_AHEAD = 8 * 1024 * 1024
+"""
+Number of bytes of each open file which are read ahead of the client's
+reads, in a separate thread, so that reading from storage overlaps with
+sending data.  A storage box can override it with an "sftp_read_ahead"
+StorageBoxAttribute, e.g. 0 to disable read-ahead for local disks.
+"""
+
+SFTP_READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+"""
+Number of bytes read from storage at a time when reading ahead.
+"""
+
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+"""
+SSH channel window size, in bytes, advertised to SFTP clients.
+"""
+
+SFTP_COMPRESSION = True
+"""
+Offer zlib compression to SFTP clients.  On fast networks compression is
+slower than sending the data uncompressed, so it can be disabled.
+"""
+
 SFTP_USERNAME_ATTRIBUTE = "email"
 """
 The attribute from the User model ('email' or 'username') used to generate
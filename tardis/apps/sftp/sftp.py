@@ -8,13 +8,16 @@ import base64
 import collections
 import logging
 import os
+import queue
 import socketserver
 import stat
+import threading
 import time
 import uuid
 from io import StringIO
 
 from django.conf import settings
+from django.db import connections
 
 from paramiko import (
     OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED,
@@ -31,7 +34,7 @@ from paramiko import (
     SSHException,
     Transport,
 )
-from paramiko.common import AUTH_FAILED, AUTH_SUCCESSFUL
+from paramiko.common import AUTH_FAILED, AUTH_SUCCESSFUL, DEFAULT_WINDOW_SIZE
 from paramiko.rsakey import RSAKey
 
 from tardis.analytics import tracker
@@ -55,11 +58,20 @@ from django.contrib.sites.models import Site  # noqa
 
 
 class DynamicTree(object):
+    """
+    A node of the directory tree of an SFTP session.
+
+    The tree is populated lazily: the children of a node are only queried
+    when a path below it is looked up, and are then kept in memory for
+    SFTP_TREE_TTL seconds, so that repeated listings don't query the
+    database again.
+    """
+
     def __init__(self, host_obj=None):
         self.name = None
         self.obj = None  # an object if applicable
         self.update = self.update_nothing
-        self.last_updated = None  # a time.time() number
+        self.last_updated = None  # a time.monotonic() number
         self.host_obj = host_obj
         self.children = None
         self.clear_children()
@@ -70,6 +82,17 @@ class DynamicTree(object):
     def clear_children(self):
         self.children = collections.defaultdict(lambda: DynamicTree(self.host_obj))
 
+    def refresh(self, force=False):
+        """
+        Populates the children of the node, unless they were populated less
+        than SFTP_TREE_TTL seconds ago
+        """
+        now = time.monotonic()
+        ttl = getattr(settings, "SFTP_TREE_TTL", 60)
+        if force or self.last_updated is None or now - self.last_updated >= ttl:
+            self.update()
+            self.last_updated = now
+
     def add_path(self, path):
         path = path.strip("/")
         elems = split_path(path)
@@ -89,41 +112,58 @@ class DynamicTree(object):
         new_child.obj = obj
 
     def get_leaf(self, path, update=False):
+        """
+        Returns the node at a path, None if there isn't one.  If update is
+        True, the nodes along the path are refreshed if they are stale.
+        """
         path = path.strip("/")
-        elems = collections.deque(split_path(path))
-        leaf = self.children.get(elems.popleft())
-        if leaf and update:
-            leaf.update()
-        while elems:
-            leaf = leaf.children.get(elems.popleft())
-            if leaf and update:
-                leaf.update()
+        leaf = self
+        for elem in split_path(path):
+            leaf = leaf.children.get(elem)
+            if leaf is None:
+                return None
+            if update:
+                leaf.refresh()
         return leaf
 
-    def update_experiments(self):
-        exps = [(path_mapper(exp), exp) for exp in self.host_obj.experiments]
+    def _replace_children(self, entries):
+        """
+        Replaces the children with (name, object, update method name)
+        entries, keeping the populated subtrees of the children whose object
+        didn't change
+        """
+        old_children = self.children
         self.clear_children()
-        for exp_name, exp in exps:
-            child = self.children[exp_name]
-            child.name = exp_name
-            child.obj = exp
-            child.update = child.update_datasets
+        for name, obj, update in entries:
+            child = old_children.get(name)
+            if (
+                child is not None
+                and type(child.obj) is type(obj)
+                and child.obj.pk == obj.pk
+            ):
+                self.children[name] = child
+            else:
+                child = self.children[name]
+            child.name = name
+            child.obj = obj
+            child.update = getattr(child, update)
+
+    def update_experiments(self):
+        self._replace_children(
+            (path_mapper(exp), exp, "update_datasets")
+            for exp in self.host_obj.experiments
+        )
 
     def update_datasets(self):
         all_files_name = "00_all_files"
-        datasets = [(path_mapper(ds), ds) for ds in self.obj.datasets.all()]
-        self.clear_children()
-        for ds_name, ds in datasets:
+        entries = []
+        for ds in self.obj.datasets.all():
+            ds_name = path_mapper(ds)
             if ds_name == all_files_name:
                 ds_name = "%s_dataset" % all_files_name
-            child = self.children[ds_name]
-            child.name = ds_name
-            child.obj = ds
-            child.update = child.update_dataset_files
-        child = self.children[all_files_name]
-        child.name = all_files_name
-        child.obj = self.obj
-        child.update = child.update_all_files
+            entries.append((ds_name, ds, "update_dataset_files"))
+        entries.append((all_files_name, self.obj, "update_all_files"))
+        self._replace_children(entries)
 
     def update_all_files(self):
         self.clear_children()
@@ -173,8 +213,8 @@ class MyTSFTPServerInterface(SFTPServerInterface):
     MyTardis data via SFTP
     """
 
-    _cache_time = 60  # in seconds
     _exps_cache = {}
+    _exps_cache_lock = threading.Lock()
 
     def __init__(self, server, *args, **kwargs):
         """
@@ -188,15 +228,18 @@ class MyTSFTPServerInterface(SFTPServerInterface):
 
     @property
     def experiments(self):
-        u = self.user.username
-        if u not in self._exps_cache:
-            self._exps_cache[u] = {"all": None, "last_update": None}
-        if self._exps_cache[u]["all"] is None:
-            self._exps_cache[u]["all"] = Experiment.safe.all(user=self.user)
-            self._exps_cache[u]["last_update"] = time.time()
-        elif self._exps_cache[u]["last_update"] - time.time() > self._cache_time:
-            self._exps_cache[u]["all"]._result_cache = None
-        return self._exps_cache[u]["all"]
+        """
+        The experiments the user has access to, cached for SFTP_TREE_TTL
+        seconds and shared by all sessions of the user
+        """
+        now = time.monotonic()
+        with self._exps_cache_lock:
+            cached = self._exps_cache.get(self.user.id)
+        if cached is None or now - cached[0] >= getattr(settings, "SFTP_TREE_TTL", 60):
+            cached = (now, list(Experiment.safe.all(user=self.user)))
+            with self._exps_cache_lock:
+                self._exps_cache[self.user.id] = cached
+        return cached[1]
 
     def session_started(self):
         """
@@ -223,6 +266,8 @@ class MyTSFTPServerInterface(SFTPServerInterface):
         tracker.track_logout(
             "sftp", session_id=self.uuid, ip=self.client_ip, user=self.user
         )
+        # each session runs in its own thread, with its own connections
+        connections.close_all()
 
     def open(self, path, flags, attr):
         """
@@ -295,6 +340,8 @@ class MyTSFTPServerInterface(SFTPServerInterface):
         """
         path = os.path.normpath(path)
         leaf = self.tree.get_leaf(path, update=True)
+        if leaf is None:
+            return SFTP_NO_SUCH_FILE
         stats = [self.stat(os.path.join(path, child)) for child in leaf.children.keys()]
         return stats
 
@@ -346,6 +393,120 @@ class MyTSFTPServerInterface(SFTPServerInterface):
         return os.path.normpath(path)
 
 
+class ReadAheadFile(object):
+    """
+    Wraps a file, reading the chunks which follow the last read in a
+    separate thread, so that reading from storage overlaps with sending data
+    to the client.  A read from anywhere else restarts the read-ahead there.
+
+    :param file fileobj: the file to read, which is only used by the
+        read-ahead thread
+    :param int size: bytes to read ahead
+    :param int chunk_size: bytes read at a time
+    """
+
+    def __init__(self, fileobj, size, chunk_size):
+        self.file = fileobj
+        self.chunk_size = max(1, chunk_size)
+        self.depth = max(1, size // self.chunk_size)
+        self.position = 0
+        self.buffer = b""
+        self.buffer_offset = 0
+        self.eof = False
+        self.chunks = None
+        self.stopped = None
+        self.thread = None
+
+    def _start(self, offset):
+        self.chunks = queue.Queue(self.depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._read_ahead,
+            args=(offset, self.chunks, self.stopped),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def _stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def _read_ahead(self, offset, chunks, stopped):
+        try:
+            self.file.seek(offset)
+            while not stopped.is_set():
+                data = self.file.read(self.chunk_size)
+                self._put(chunks, stopped, data)
+                if not data:
+                    return
+        except Exception as e:  # raised by read
+            self._put(chunks, stopped, e)
+
+    @staticmethod
+    def _put(chunks, stopped, item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        self.position = offset
+
+    def read(self, length):
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if not self.buffer_offset <= self.position <= buffer_end:
+            self._stop()
+            self.buffer = b""
+            self.buffer_offset = self.position
+            self.eof = False
+        while (
+            self.position + length > self.buffer_offset + len(self.buffer)
+            and not self.eof
+        ):
+            if self.thread is None:
+                self._start(self.buffer_offset + len(self.buffer))
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                self._stop()
+                raise chunk
+            if not chunk:
+                self.eof = True
+                self._stop()
+                break
+            # drop the data which has already been read
+            self.buffer = self.buffer[self.position - self.buffer_offset :] + chunk
+            self.buffer_offset = self.position
+        start = self.position - self.buffer_offset
+        data = self.buffer[start : start + length]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self._stop()
+        self.file.close()
+
+
+def get_read_ahead(df):
+    """
+    Returns the number of bytes to read ahead of SFTP reads of a DataFile,
+    from the "sftp_read_ahead" attribute of its storage box if it has one,
+    otherwise from SFTP_READ_AHEAD
+    """
+    dfo = df.get_preferred_dfo()
+    if dfo is not None:
+        attribute = dfo.storage_box.attributes.filter(key="sftp_read_ahead").first()
+        if attribute is not None:
+            return int(attribute.value)
+    return getattr(settings, "SFTP_READ_AHEAD", 0)
+
+
 class MyTSFTPHandle(SFTPHandle):
     """
     SFTP File Handle
@@ -368,6 +529,14 @@ class MyTSFTPHandle(SFTPHandle):
                 fo = df.file_objects.all()[0]
                 error_string = "%s:%s" % (fo.storage_box.name, fo.uri)
                 self.readfile = StringIO(error_string)
+        else:
+            read_ahead = get_read_ahead(df)
+            if read_ahead and self.readfile is not None:
+                self.readfile = ReadAheadFile(
+                    self.readfile,
+                    read_ahead,
+                    getattr(settings, "SFTP_READ_AHEAD_CHUNK_SIZE", 1024 * 1024),
+                )
 
     def stat(self):
         """
@@ -382,11 +551,92 @@ class MyTSFTPHandle(SFTPHandle):
         return SFTP_OP_UNSUPPORTED
 
 
+class ConnectionLimiter(object):
+    """
+    Counts the open SFTP connections, in total and per user, and refuses
+    connections beyond SFTP_MAX_CONNECTIONS and SFTP_MAX_CONNECTIONS_PER_USER.
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, max_connections=None, max_per_user=None):
+        if max_connections is None:
+            max_connections = getattr(settings, "SFTP_MAX_CONNECTIONS", 0)
+        if max_per_user is None:
+            max_per_user = getattr(settings, "SFTP_MAX_CONNECTIONS_PER_USER", 0)
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.connections = 0
+        self.user_connections = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add_connection(self):
+        """
+        Counts a new connection, returns False if there are too many
+        """
+        with self.lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def remove_connection(self):
+        with self.lock:
+            self.connections -= 1
+
+    def add_user(self, user_id):
+        """
+        Counts a new connection of an authenticated user, returns False if
+        the user has too many
+        """
+        with self.lock:
+            if (
+                self.max_per_user
+                and self.user_connections[user_id] >= self.max_per_user
+            ):
+                return False
+            self.user_connections[user_id] += 1
+            return True
+
+    def remove_user(self, user_id):
+        with self.lock:
+            self.user_connections[user_id] -= 1
+            if self.user_connections[user_id] <= 0:
+                del self.user_connections[user_id]
+
+
 class MyTServerInterface(ServerInterface):
-    def __init__(self):
+    def __init__(self, limiter=None):
+        """
+        :param ConnectionLimiter limiter: counts the connections of each
+            user, if they are limited
+        """
         super().__init__()
         self.username = None
         self.user = None
+        self.limiter = limiter
+        self.counted_user_id = None
+
+    def _login(self, username, user):
+        """
+        Completes a successful authentication, unless the user has too many
+        connections
+        """
+        if self.limiter is not None and self.counted_user_id is None:
+            if not self.limiter.add_user(user.id):
+                logger.warning("Too many SFTP connections for user %s", username)
+                return AUTH_FAILED
+            self.counted_user_id = user.id
+        self.username = username
+        self.user = user
+        return AUTH_SUCCESSFUL
+
+    def logout(self):
+        """
+        Stops counting the connection of the authenticated user
+        """
+        if self.counted_user_id is not None:
+            self.limiter.remove_user(self.counted_user_id)
+            self.counted_user_id = None
 
     def get_allowed_auths(self, username):
         auth_methods = ["password", "keyboard-interactive", "publickey"]
@@ -411,9 +661,7 @@ class MyTServerInterface(ServerInterface):
             # the following line is Australian Synchrotron specific and will
             # disappear when we start using their newer auth system
             user.epn_list = fake_request.session.get("_epn_list", [])
-            self.username = username
-            self.user = user
-            return AUTH_SUCCESSFUL
+            return self._login(username, user)
         return AUTH_FAILED
 
     def check_auth_password(self, username, password):
@@ -433,9 +681,7 @@ class MyTServerInterface(ServerInterface):
                 except User.DoesNotExist:
                     logger.error("User with username %s does not exist.", username)
                 if user.is_active:
-                    self.username = username
-                    self.user = user
-                    return AUTH_SUCCESSFUL
+                    return self._login(username, user)
 
         return AUTH_FAILED
 
@@ -469,19 +715,30 @@ class MyTSFTPRequestHandler(socketserver.BaseRequestHandler):
     auth_timeout = 60
 
     def setup(self):
-        self.transport = Transport(self.request)
+        self.transport = Transport(
+            self.request,
+            default_window_size=getattr(
+                settings, "SFTP_WINDOW_SIZE", DEFAULT_WINDOW_SIZE
+            ),
+        )
         self.transport.load_server_moduli()
         so = self.transport.get_security_options()
         so.digests = ("hmac-sha1",)
-        so.compression = ("zlib@openssh.com", "none")
+        if getattr(settings, "SFTP_COMPRESSION", True):
+            so.compression = ("zlib@openssh.com", "none")
+        else:
+            so.compression = ("none",)
         self.transport.add_server_key(self.server.host_key)
         self.transport.set_subsystem_handler(
             "sftp", MyTSFTPServer, MyTSFTPServerInterface
         )
 
     def handle(self):
+        server_interface = MyTServerInterface(limiter=self.server.limiter)
         try:
-            self.transport.start_server(server=MyTServerInterface())
+            self.transport.start_server(server=server_interface)
+            # keep the connection counted until the client disconnects
+            self.transport.join()
         except SSHException as e:
             logger.error("SSH error: %s" % str(e))
             self.transport.close()
@@ -490,22 +747,47 @@ class MyTSFTPRequestHandler(socketserver.BaseRequestHandler):
             logger.warning("Socket error: %s" % str(e))
         except Exception as e:
             logger.error("Error: %s" % str(e))
+        finally:
+            server_interface.logout()
 
     def handle_timeout(self):
         self.transport.close()
 
 
-class MyTSFTPTCPServer(socketserver.TCPServer):
+class MyTSFTPTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Handles each connection in its own thread, up to SFTP_MAX_CONNECTIONS
+    connections at a time
+    """
+
     # If the server stops/starts quickly, don't fail because of
     # "port in use" error.
     allow_reuse_address = True
+    daemon_threads = True
 
-    def __init__(self, address, host_key, RequestHandlerClass=None):
+    def __init__(self, address, host_key, RequestHandlerClass=None, limiter=None):
         self.host_key = host_key
+        self.limiter = limiter or ConnectionLimiter()
         if RequestHandlerClass is None:
             RequestHandlerClass = MyTSFTPRequestHandler
         socketserver.TCPServer.__init__(self, address, RequestHandlerClass)
 
+    def verify_request(self, request, client_address):
+        if not self.limiter.add_connection():
+            logger.warning(
+                "Refusing SFTP connection from %s: too many connections",
+                client_address[0],
+            )
+            request.close()
+            return False
+        return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.limiter.remove_connection()
+
     def shutdown_request(self, request):
         # Prevent TCPServer from closing the connection prematurely
         return
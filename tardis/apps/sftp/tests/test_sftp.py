@@ -8,14 +8,20 @@ from unittest.mock import patch
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.management import call_command
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 
 from flexmock import flexmock
+from paramiko import SFTP_NO_SUCH_FILE
 from paramiko.common import AUTH_FAILED, AUTH_SUCCESSFUL
 from paramiko.rsakey import RSAKey
 
 from tardis.apps.sftp.models import SFTPPublicKey
-from tardis.apps.sftp.sftp import MyTServerInterface, MyTSFTPServerInterface
+from tardis.apps.sftp.sftp import (
+    ConnectionLimiter,
+    ReadAheadFile,
+    MyTServerInterface,
+    MyTSFTPServerInterface,
+)
 from tardis.apps.sftp.views import cybderduck_connection_window, sftp_access
 from tardis.tardis_portal.download import make_mapper
 from tardis.tardis_portal.models import (
@@ -131,6 +137,58 @@ class SFTPTest(TestCase):
         self.user.is_active = True
         self.user.save()
 
+    def test_sftp_tree_is_cached(self):
+        path_mapper = make_mapper(settings.DEFAULT_PATH_MAPPER, rootdir=None)
+        MyTSFTPServerInterface._exps_cache.clear()  # pylint: disable=W0212
+        sftp_interface = MyTSFTPServerInterface(server=flexmock(user=self.user))
+        sftp_interface.session_started()
+        dataset_path = "/home/%s/experiments/%s/%s/" % (
+            self.username,
+            path_mapper(self.exp),
+            path_mapper(self.dataset),
+        )
+        sftp_interface.list_folder(dataset_path)
+        # the listing is served from memory
+        with self.assertNumQueries(0):
+            sftp_files = sftp_interface.list_folder(dataset_path)
+        self.assertEqual([sftp_file.filename for sftp_file in sftp_files], ["file.txt"])
+        with override_settings(SFTP_TREE_TTL=0):
+            with self.assertNumQueries(3):
+                sftp_interface.list_folder(dataset_path)
+        self.assertEqual(
+            sftp_interface.list_folder(dataset_path + "missing/"), SFTP_NO_SUCH_FILE
+        )
+
+    def test_sftp_connections_per_user(self):
+        limiter = ConnectionLimiter(max_connections=0, max_per_user=1)
+        first = MyTServerInterface(limiter=limiter)
+        second = MyTServerInterface(limiter=limiter)
+        self.assertEqual(
+            first.check_auth_password(self.username, self.password), AUTH_SUCCESSFUL
+        )
+        self.assertEqual(
+            second.check_auth_password(self.username, self.password), AUTH_FAILED
+        )
+        first.logout()
+        self.assertEqual(
+            second.check_auth_password(self.username, self.password), AUTH_SUCCESSFUL
+        )
+
+    def test_sftp_read_ahead(self):
+        content = bytes(range(256)) * 40
+        readfile = ReadAheadFile(BytesIO(content), size=1024, chunk_size=100)
+        self.assertEqual(readfile.read(150), content[:150])
+        self.assertEqual(readfile.read(1000), content[150:1150])
+        readfile.seek(5000)
+        self.assertEqual(readfile.read(300), content[5000:5300])
+        readfile.seek(20)
+        self.assertEqual(readfile.read(10), content[20:30])
+        readfile.seek(10000)
+        self.assertEqual(readfile.read(1000), content[10000:])
+        self.assertEqual(readfile.read(1000), b"")
+        readfile.close()
+        self.assertIsNone(readfile.thread)
+
     def test_sftp_key_connect(self):
         server_interface = MyTServerInterface()
         pub_key_str = (
@@ -11,3 +11,14 @@
 #    INSTALLED_APPS = INSTALLED_APPS + ('django_user_agents',)
 #    MIDDLEWARE = MIDDLEWARE + \
 #        ('django_user_agents.middleware.UserAgentMiddleware',)
+
+GOOGLE_ANALYTICS_QUEUE_SIZE = 10000
+"""
+Maximum number of Google Analytics events waiting to be sent by each process.
+Events are dropped while the queue is full.
+"""
+
+GOOGLE_ANALYTICS_TIMEOUT = 10
+"""
+Timeout in seconds of the requests sending events to Google Analytics
+"""
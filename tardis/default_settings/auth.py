@@ -7,6 +7,39 @@ GROUP_PROVIDERS = (
 
 ONLY_EXPERIMENT_ACLS = True
 
+DATAFILE_ACL_INHERITANCE = False
+"""
+If True, DataFiles which have no ACLs of their own, other than the
+PUBLIC_USER ACL of a public file, get their permissions from the ACLs of
+their dataset when they are checked or queried.  New DataFiles then get no
+copies of their dataset's ACLs, or owner ACLs.  ACLs added to a file
+replace those of its dataset for that file.  This only matters if
+ONLY_EXPERIMENT_ACLS is False.
+"""
+
+ACL_CACHE_TIMEOUT = 0
+"""
+Number of seconds for which the project, experiment and dataset ACLs of each
+user, group and token, and the group memberships of each user, are kept in the ACL_CACHE cache, so that
+listings such as Experiment.safe.all() don't query the ACL tables for repeat
+visitors.  Cached entries are dropped when ACLs or group memberships change.
+Use a cache shared by all web and Celery processes, e.g. memcached or Redis.
+The default of 0 disables caching.
+"""
+
+ACL_CACHE = "default"
+"""
+Name of the cache in CACHES to keep ACLs in if ACL_CACHE_TIMEOUT is set.
+"""
+
+ACL_CACHE_MAX_ROWS = 10000
+"""
+Maximum number of ACLs of a single user, group or token of a model which are
+kept in the ACL cache.  Principals with more ACLs, e.g. the public user on a
+large public facility, are queried with a subquery instead, which keeps cache
+entries below the item size limit of memcached (1 MB by default).
+"""
+
 # For a freshly installed MyTardis DB this will the default User ID,
 # as it is created in the migrations prior to any SuperUser creation.
 # For existing DBs this will need to be overriden in the settings.py file
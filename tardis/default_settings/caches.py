@@ -25,3 +25,15 @@ CACHES = {
 change the CACHES setting to memcached if you prefer. Requires additional
 dependencies.
 """
+
+FACILITY_OVERVIEW_CACHE_TIMEOUT = 30
+"""
+Number of seconds for which the dataset and file listings of the facility
+overview are kept in the FACILITY_OVERVIEW_CACHE cache, per facility.  Set
+to 0 to disable caching.
+"""
+
+FACILITY_OVERVIEW_CACHE = "default"
+"""
+Name of the cache in CACHES to keep facility overview data in
+"""
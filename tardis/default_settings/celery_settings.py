@@ -38,5 +38,10 @@ CELERYBEAT_SCHEDULE = {
         "task": "tardis_portal.verify_dfos",
         "schedule": timedelta(seconds=300),
         "kwargs": {"priority": DEFAULT_TASK_PRIORITY},
-    }
+    },
+    "reverify-files": {
+        "task": "tardis_portal.reverify_dfos",
+        "schedule": timedelta(days=1),
+        "kwargs": {"priority": DEFAULT_TASK_PRIORITY},
+    },
 }
@@ -146,6 +146,24 @@ which corresponds to the following PROXY_DOWNLOAD_PREFIXES setting:
   }
 """
 
+PROXY_DOWNLOAD_HEADER = "X-Accel-Redirect"
+"""
+Header used to hand proxied downloads over to the front-end web server.
+"X-Accel-Redirect" (NGINX) takes an internal URL, built with
+PROXY_DOWNLOAD_PREFIXES or with the "proxy_download_prefix" attribute of
+the file's StorageBox, which takes precedence:
+
+  StorageBoxAttribute(storage_box=box, key='proxy_download_prefix',
+                      value='/protected/box1/')
+
+"X-Sendfile" (Apache mod_xsendfile, lighttpd) takes the file system path
+of the file, and is used for storage boxes under one of the
+PROXY_DOWNLOAD_PREFIXES keys or with a "proxy_download_prefix" attribute.
+
+Downloads which are not proxied are sent with a FileResponse, which lets
+the WSGI server use os.sendfile for files on local storage.
+"""
+
 RECALL_URI_TEMPLATES = {}
 """
 When a file recall (from tape/archive) is requested, MyTardis can
@@ -161,3 +179,40 @@ For example,
       '/api/v1/hsm_replica/{dfo_id}/recall/'
   }
 """
+
+DOWNLOAD_ARCHIVE_PREFETCH_FILES = 0
+"""
+Number of DataFiles to open and read ahead on a background thread pool
+while the current member of a tar/tgz archive download is being streamed.
+On storage with a high per-file latency (NFS, object stores) this lets
+archive downloads approach the aggregate bandwidth of the storage backend.
+0 disables read-ahead, so that files are opened one at a time.
+"""
+
+DOWNLOAD_ARCHIVE_PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+"""
+Maximum number of bytes held in read-ahead buffers per archive download
+when DOWNLOAD_ARCHIVE_PREFETCH_FILES is enabled.  Files which don't fit
+into the remaining budget are opened ahead, but read as they are streamed.
+"""
+
+DOWNLOAD_ARCHIVE_GZIP_WORKERS = 0
+"""
+Number of threads used to compress tgz archive downloads.  When set, the
+archive is compressed in independent 1 MiB blocks on a thread pool (like
+pigz) and streamed as concatenated gzip members, which any gzip
+implementation decompresses as a single stream.  0 compresses the
+archive on the streaming thread with a single gzip stream.
+"""
+
+DOWNLOAD_ARCHIVE_UNCOMPRESSED_MIMETYPES = []
+"""
+Mimetypes of already compressed files which are stored rather than
+compressed in tgz archive downloads, e.g.
+
+  DOWNLOAD_ARCHIVE_UNCOMPRESSED_MIMETYPES = [
+      'application/gzip', 'application/zip', 'image/jpeg', 'video/mp4'
+  ]
+
+Only used when DOWNLOAD_ARCHIVE_GZIP_WORKERS is set.
+"""
@@ -7,5 +7,6 @@ MIDDLEWARE = (
     "tardis.tardis_portal.logging_middleware.LoggingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "tardis.tardis_portal.auth.token_auth.TokenAuthMiddleware",
+    "tardis.tardis_portal.auth.authorisation.PermissionCacheMiddleware",
     # 'django.middleware.cache.FetchFromCacheMiddleware',
 )
@@ -25,6 +25,31 @@ Setting for running elastic search index in parallel mode to get indexing speed
 https://django-elasticsearch-dsl.readthedocs.io/en/latest/settings.html#elasticsearch-dsl-parallel
 """
 
+ELASTICSEARCH_PREPARE_CHUNK_SIZE = 1000
+"""
+Number of objects whose Elasticsearch documents are prepared together. The
+ACLs, parameters and related objects of each chunk of objects are loaded with
+a few queries, rather than with several queries for every object.
+"""
+
+ELASTICSEARCH_QUEUE_WINDOW = 5
+"""
+Number of seconds for which changes are collected by the QueuedSignalProcessor
+before the affected documents are re-indexed in bulk by a Celery task. To
+re-index documents asynchronously rather than on the request path:
+
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = (
+    'tardis.apps.search.signals.QueuedSignalProcessor'
+)
+"""
+
+ELASTICSEARCH_QUEUE_CACHE = "default"
+"""
+Cache which records whether a flush of the index queue is already scheduled.
+It should be shared between all web server processes, e.g. the database or
+memcached cache, otherwise each process schedules its own flushes.
+"""
+
 
 RESULTS_PER_PAGE = 10000
 """
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from os import path
 
 DEFAULT_STORAGE_BASE_DIR = path.abspath(
@@ -14,6 +15,81 @@ REQUIRE_VALIDATION_ON_INGESTION = True
 COMPUTE_MD5 = True
 COMPUTE_SHA512 = False
 
+CHECKSUM_CHUNK_SIZE = 8 * 1024 * 1024
+"""
+Number of bytes read at a time when computing checksums, rounded down to a
+multiple of the page size.  The md5 and sha512 checksums of each chunk are
+computed in parallel threads while the next chunk is read.
+"""
+
+CHECKSUM_USE_MMAP = True
+"""
+Memory-map local files to compute their checksums, rather than copying each
+chunk into a buffer
+"""
+
+VERIFY_AUDIT_INTERVAL = timedelta(days=90)
+"""
+The periodic re-verification of verified files only reads a file and
+computes its checksums if its fingerprint (its size, modification time and
+inode or ETag) changed since it was last verified, or if its checksums were
+last computed longer ago than this interval.  Set to None to only rely on
+fingerprints.
+"""
+
+REVERIFY_INTERVAL = timedelta(days=7)
+"""
+The periodic re-verification of verified files only checks files which were
+last verified longer ago than this interval, so that each daily run checks
+a share of the files rather than all of them.
+"""
+
+STORAGE_FINGERPRINT_METHODS = {}
+"""
+A custom method can be provided for getting the fingerprint of a file in a
+storage class, similar to CALCULATE_CHECKSUMS_METHODS, e.g.
+
+STORAGE_FINGERPRINT_METHODS = {
+    'storages.backends.s3boto3.S3Boto3Storage':
+        'tardis.apps.s3utils.utils.get_fingerprint'
+}
+"""
+
+VERIFY_BATCH_SIZE = 1000
+"""
+Number of unverified DataFileObjects claimed by each batch verification task.
+A task which claims a full batch queues the next one when it's done.
+"""
+
+VERIFY_BATCH_THREADS = 4
+"""
+Number of threads in which each batch verification task reads and checksums
+files
+"""
+
+VERIFY_BATCH_TASKS = 1
+"""
+Number of concurrent batch verification tasks started for each storage box
+by the periodic verify_dfos task
+"""
+
+CLEANUP_DFO_AGE = timedelta(days=7)
+"""
+The periodic cleanup_dfos task deletes DataFileObjects which are still
+unverified this long after they were created
+"""
+
+CLEANUP_BATCH_SIZE = 1000
+"""
+Number of DataFiles or DataFileObjects deleted at a time by the cleanup_dfs
+and cleanup_dfos tasks
+"""
+
+CLEANUP_THREADS = 4
+"""
+Number of threads in which the cleanup_dfos task deletes files from storage
+"""
+
 CALCULATE_CHECKSUMS_METHODS = {}
 """
 A custom method can be provided for calculating checksums for a storage class,
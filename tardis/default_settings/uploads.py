@@ -10,3 +10,15 @@ To use filepicker, please also get an API key at http://filepicker.io
 
 # New in Django 1.10:
 DATA_UPLOAD_MAX_MEMORY_SIZE = 262144000  # 250 MB
+
+DATAFILE_BULK_MAX_RECORDS = 10000
+"""
+Maximum number of file records accepted by one request to the bulk DataFile
+registration API endpoint, /api/v1/dataset_file/bulk/
+"""
+
+DATAFILE_BULK_BATCH_SIZE = 1000
+"""
+Number of rows written by each INSERT when DataFiles, DataFileObjects and
+their ACLs are registered in bulk
+"""
@@ -6,22 +6,22 @@ Implemented with Tastypie.
 .. moduleauthor:: Grischa Meyer <grischa@gmail.com>
 .. moduleauthor:: James Wettenhall <james.wettenhall@monash.edu>
 """
+import base64
 import contextlib
 import json
 import logging
 import re
 from itertools import chain
 from typing import List, Optional, Tuple
-from urllib.parse import quote
 from wsgiref.util import FileWrapper
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Group, User
-from django.core.paginator import EmptyPage, InvalidPage, Paginator
 from django.db import IntegrityError, transaction
-from django.db.models import Model, Q
+from django.db.models import Model, Q, prefetch_related_objects
 from django.http import (
     HttpResponse,
+    HttpResponseBadRequest,
     HttpResponseForbidden,
     HttpResponseNotFound,
     JsonResponse,
@@ -56,16 +56,19 @@ from tardis.apps.identifiers.models import (
 )
 
 from . import tasks
+from .auth.acl_resolver import datafile_acls_inherited
 from .auth.decorators import (
     has_access,
     has_delete_permissions,
     has_download_access,
+    has_download_access_bulk,
     has_sensitive_access,
     has_write,
 )
+from .download import get_proxy_download_response
 from .models.access_control import DatafileACL, DatasetACL, ExperimentACL
 from .models.datafile import DataFile, DataFileObject, compute_checksums
-from .models.dataset import Dataset
+from .models.dataset import Dataset, DatasetDirectory
 from .models.experiment import Experiment, ExperimentAuthor
 from .models.facility import Facility, facilities_managed_by
 from .models.instrument import Instrument
@@ -1258,6 +1261,29 @@ class ExperimentAuthorResource(MyTardisModelResource):
         always_return_data = True
 
 
+def _encode_dir_nodes_cursor(datafile):
+    """
+    Returns a cursor for the files after datafile in a directory listing
+    ordered by filename and id
+    """
+    cursor = json.dumps([datafile.filename, datafile.id])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_dir_nodes_cursor(cursor):
+    """
+    Returns the (filename, id) of a cursor from _encode_dir_nodes_cursor,
+    None if the cursor is missing or invalid
+    """
+    if not cursor:
+        return None
+    try:
+        filename, df_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(filename), int(df_id)
+    except (TypeError, ValueError):
+        return None
+
+
 class DatasetResource(MyTardisModelResource):
     experiments = fields.ToManyField(
         ExperimentResource, "experiments", related_name="datasets"
@@ -1444,7 +1470,14 @@ class DatasetResource(MyTardisModelResource):
         return super().hydrate_m2m(bundle)
 
     def get_root_dir_nodes(self, request, **kwargs):
-        """Return JSON-serialized list of filenames/folders in the dataset's root directory"""
+        """Return JSON-serialized list of filenames/folders in the dataset's root directory
+
+        Files are returned in pages ordered by filename.  The marker element
+        of a page which has more files after it holds a ``cursor`` to pass
+        with the next page's request, which is used instead of counting and
+        offsetting all of the dataset's root files.  Requests without a
+        cursor for a page past the last one get the last page.
+        """
         self.method_check(request, allowed=["get"])
         self.is_authenticated(request)
 
@@ -1457,35 +1490,45 @@ class DatasetResource(MyTardisModelResource):
         dir_tuples = dataset.get_dir_tuples(request.user, "")
         # get files at root level
         if settings.ONLY_EXPERIMENT_ACLS:
-            dfs = (
-                DataFile.objects.filter(dataset=dataset, directory="")
-                | DataFile.objects.filter(dataset=dataset, directory__isnull=True)
-            ).distinct()
+            dfs = DataFile.objects.filter(dataset=dataset)
         else:
-            dfs = (
-                DataFile.safe.all(user=request.user).filter(
-                    dataset=dataset, directory=""
-                )
-                | DataFile.safe.all(user=request.user).filter(
-                    dataset=dataset, directory__isnull=True
-                )
-            ).distinct()
+            dfs = DataFile.safe.all(user=request.user).filter(dataset=dataset)
+        dfs = (
+            dfs.filter(Q(directory="") | Q(directory__isnull=True))
+            .select_related("dataset")
+            .order_by("filename", "id")
+        )
 
         pgresults = 1000
 
-        paginator = Paginator(dfs, pgresults)
-
         try:
             page_num = int(request.GET.get("page", "0"))
         except ValueError:
             page_num = 0
 
-        # If page request (9999) is out of range, deliver last page of results.
+        # fetch one file more than a page to find out if there's a next page
+        cursor = _decode_dir_nodes_cursor(request.GET.get("cursor", None))
+        if cursor:
+            filename, df_id = cursor
+            dfs = list(
+                dfs.filter(
+                    Q(filename__gt=filename) | Q(filename=filename, id__gt=df_id)
+                )[: pgresults + 1]
+            )
+        else:
+            page = []
+            if page_num >= 0:
+                offset = page_num * pgresults
+                page = list(dfs[offset : offset + pgresults + 1])
+            if not page and page_num != 0:
+                # If page request (9999) is out of range, deliver last page of results.
+                page_num = max(dfs.count() - 1, 0) // pgresults
+                offset = page_num * pgresults
+                page = list(dfs[offset : offset + pgresults + 1])
+            dfs = page
+        has_next_page = len(dfs) > pgresults
+        dfs = dfs[:pgresults]
 
-        try:
-            dfs = paginator.page(page_num + 1)
-        except (EmptyPage, InvalidPage):
-            dfs = paginator.page(paginator.num_pages)
         child_list = []
         # append directories list
         if dir_tuples and page_num == 0:
@@ -1497,27 +1540,19 @@ class DatasetResource(MyTardisModelResource):
                 }
                 child_list.append(child_dict)
                 # append files to list
-        if dfs:
-            for df in dfs:
-                children = {
-                    "name": df.filename,
-                    "verified": df.verified,
-                    "id": df.id,
-                    "is_online": df.is_online,
-                    "recall_url": df.recall_url,
-                }
-                child_list.append(children)
-        if paginator.num_pages - 1 > page_num:
+        child_list.extend(self._get_datafile_nodes(request, dfs))
+        if has_next_page:
             # append a marker element
             children = {
                 "next_page": True,
                 "next_page_num": page_num + 1,
-                "display_text": "Displaying {current} of {total} ".format(
-                    current=(dfs.number * pgresults), total=paginator.count
+                "cursor": _encode_dir_nodes_cursor(dfs[-1]),
+                "display_text": "Displaying {current} ".format(
+                    current=((page_num + 1) * pgresults)
                 ),
             }
             child_list.append(children)
-        if paginator.num_pages - 1 == page_num:
+        else:
             # append a marker element
             children = {"next_page": False}
             child_list.append(children)
@@ -1551,6 +1586,7 @@ class DatasetResource(MyTardisModelResource):
             dfs = DataFile.safe.all(user=request.user).filter(
                 dataset=dataset, directory=base_dir
             )
+        dfs = dfs.select_related("dataset")
         # walk the directory tree and append files and dirs
         # if there are directories append this to data
         child_list = []
@@ -1558,20 +1594,38 @@ class DatasetResource(MyTardisModelResource):
             child_list = dataset.get_dir_nodes(child_dir_tuples)
 
         # if there are files append this
-        if dfs:
-            for df in dfs:
-                child = {
-                    "name": df.filename,
-                    "id": df.id,
-                    "verified": df.verified,
-                    "is_online": df.is_online,
-                    "recall_url": df.recall_url,
-                    "can_download": has_download_access(request, df.id, "datafile"),
-                }
-                child_list.append(child)
+        child_list.extend(self._get_datafile_nodes(request, dfs, can_download=True))
 
         return JsonResponse(child_list, status=200, safe=False)
 
+    def _get_datafile_nodes(self, request, dfs, can_download=False):
+        """Return tree view nodes for a list of DataFiles
+
+        The DataFileObjects, their storage boxes and the boxes' attributes
+        are prefetched for all files, and download access is checked for all
+        files at once, so the number of queries doesn't grow with the number
+        of files.
+        """
+        dfs = list(dfs)
+        prefetch_related_objects(dfs, "file_objects__storage_box__attributes")
+        if not dfs:
+            return []
+        if can_download:
+            download_access = has_download_access_bulk(request, dfs, "datafile")
+        nodes = []
+        for df in dfs:
+            node = {
+                "name": df.filename,
+                "id": df.id,
+                "verified": df.verified,
+                "is_online": df.is_online,
+                "recall_url": df.recall_url,
+            }
+            if can_download:
+                node["can_download"] = download_access[df.id]
+            nodes.append(node)
+        return nodes
+
     def get_child_dir_files(self, request, **kwargs):
         """
         Return a list of datafile Ids within a child subdirectory
@@ -1592,10 +1646,15 @@ class DatasetResource(MyTardisModelResource):
             return HttpResponse("Please specify folder path")
 
         if settings.ONLY_EXPERIMENT_ACLS:
+            # look up the directory and its subdirectories in the directory
+            # index, and their files by (dataset, directory)
+            dir_path = dir_path.strip("/")
+            dir_paths = DatasetDirectory.objects.filter(
+                Q(path=dir_path) | Q(path__startswith=dir_path + "/"),
+                dataset__id=dataset_id,
+            ).values("path")
             df_list = DataFile.objects.filter(
-                dataset__id=dataset_id, directory=dir_path
-            ) | DataFile.objects.filter(
-                dataset__id=dataset_id, directory__startswith=dir_path + "/"
+                dataset__id=dataset_id, directory__in=dir_paths
             )
         else:
             df_list = DataFile.safe.all(user=request.user).filter(
@@ -1603,7 +1662,7 @@ class DatasetResource(MyTardisModelResource):
             ) | DataFile.safe.all(user=request.user).filter(
                 dataset__id=dataset_id, directory__startswith=dir_path + "/"
             )
-        ids = [df.id for df in df_list]
+        ids = list(df_list.values_list("id", flat=True))
         return JsonResponse(ids, status=200, safe=False)
 
     def _populate_children(self, request, sub_child_dirs, dir_node, dataset):
@@ -1861,18 +1920,9 @@ class DataFileResource(MyTardisModelResource):
             template = URITemplate(download_uri_templates[storage_class_name])
             return redirect(template.expand(dfo_id=preferred_dfo.id))
 
-        if settings.PROXY_DOWNLOADS:
-            full_path = preferred_dfo.get_full_path()
-            for key, value in settings.PROXY_DOWNLOAD_PREFIXES.items():
-                if full_path.startswith(key):
-                    cd = 'attachment; filename="{}"'.format(file_record.filename)
-                    xar = quote("{}{}".format(value, full_path.split(key)[1]))
-                    response = HttpResponse(
-                        status=200,
-                        content_type="application/force-download",
-                        headers={"Content-Disposition": cd, "X-Accel-Redirect": xar},
-                    )
-                    return response
+        response = get_proxy_download_response(preferred_dfo, file_record.filename)
+        if response is not None:
+            return response
 
         # Log file download event
         if getattr(settings, "ENABLE_EVENTLOG", False):
@@ -1925,6 +1975,335 @@ class DataFileResource(MyTardisModelResource):
             )
         return HttpResponse()
 
+    BULK_FIELDS = (
+        "filename",
+        "directory",
+        "size",
+        "created_time",
+        "modification_time",
+        "mimetype",
+        "md5sum",
+        "sha512sum",
+        "version",
+        "public_access",
+    )
+
+    def bulk_create_files(self, request, **kwargs):
+        """
+        Registers many DataFiles in one request, for high-volume ingestion.
+
+        The body is a JSON array of file records, an object with an "objects"
+        array like a PATCH to the list endpoint, or JSON lines if the content
+        type is application/x-ndjson or application/jsonlines.  A record has
+        the fields of a POST to the list endpoint, and optionally replicas
+        and identifiers, but no parameter sets, users, groups or attached
+        files.
+
+        Each dataset is looked up and authorised once.  The valid records are
+        inserted with bulk inserts in one transaction, along with their
+        DataFileObjects and ACLs, and the response lists the result of each
+        record in order: its status, and either its resource URI, plus the
+        path to upload it to if it has no replicas, or an error.
+        """
+        self.method_check(request, allowed=["post"])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if not all(
+            [
+                request.user.has_perm("tardis_portal.change_dataset"),
+                request.user.has_perm("tardis_portal.add_datafile"),
+            ]
+        ):
+            return HttpResponseForbidden()
+        try:
+            records = self._bulk_records(request)
+        except ValueError as err:
+            return HttpResponseBadRequest(str(err))
+        max_records = getattr(settings, "DATAFILE_BULK_MAX_RECORDS", 10000)
+        if len(records) > max_records:
+            return HttpResponseBadRequest(
+                "Too many file records, the maximum is %d" % max_records
+            )
+
+        results = [None] * len(records)
+        datasets = {}
+        candidates = []
+        for index, record in enumerate(records):
+            if not isinstance(record, dict):
+                results[index] = {"status": 400, "error": "Not a file record"}
+                continue
+            dataset, error = self._bulk_dataset(
+                request, record.get("dataset"), datasets
+            )
+            if dataset is None:
+                results[index] = error
+                continue
+            try:
+                datafile = self._bulk_datafile(record, dataset)
+            except Exception as err:
+                results[index] = {"status": 400, "error": str(err)}
+                continue
+            candidates.append((index, record, datafile))
+
+        # one query per dataset for the files which are already registered
+        existing = set()
+        filenames = {}
+        for dummy, dummy, datafile in candidates:
+            filenames.setdefault(datafile.dataset_id, set()).add(datafile.filename)
+        for dataset_id, names in filenames.items():
+            existing.update(
+                (dataset_id,) + key
+                for key in DataFile.objects.filter(
+                    dataset_id=dataset_id, filename__in=names
+                ).values_list("directory", "filename", "version")
+            )
+        valid = []
+        for index, record, datafile in candidates:
+            key = (
+                datafile.dataset_id,
+                datafile.directory,
+                datafile.filename,
+                datafile.version,
+            )
+            if key in existing:
+                results[index] = {"status": 409, "error": "Duplicate file"}
+                continue
+            existing.add(key)
+            valid.append((index, record, datafile))
+
+        try:
+            with transaction.atomic():
+                created = self._bulk_insert(request, valid, datasets)
+        except IntegrityError as err:
+            logger.warning("Bulk registration of DataFiles failed: %s", err)
+            created = {index: {"status": 409, "error": str(err)} for index, *_ in valid}
+        for index, result in created.items():
+            results[index] = result
+
+        self.log_throttled_access(request)
+        return self.create_response(request, {"objects": results})
+
+    @staticmethod
+    def _bulk_records(request):
+        """
+        Returns the file records of a bulk registration request
+        """
+        content_type = request.META.get("CONTENT_TYPE", "application/json")
+        body = request.body.decode("utf-8")
+        if content_type.split(";")[0].strip() in (
+            "application/x-ndjson",
+            "application/jsonlines",
+        ):
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        records = json.loads(body)
+        if isinstance(records, dict):
+            records = records.get("objects")
+        if not isinstance(records, list):
+            raise ValueError("Expected a list of file records")
+        return records
+
+    def _bulk_dataset(self, request, uri, datasets):
+        """
+        Returns the dataset of a file record, or None and the error of the
+        record, looking up and authorising each dataset once
+        """
+        if not isinstance(uri, str):
+            return None, {"status": 400, "error": "Missing dataset"}
+        if uri not in datasets:
+            entry = {"dataset": None}
+            try:
+                dataset = DatasetResource.get_via_uri(DatasetResource(), uri, request)
+            except (NotFound, Dataset.DoesNotExist, ImmediateHttpResponse):
+                entry["error"] = {"status": 404, "error": "Dataset not found"}
+            else:
+                if has_write(request, dataset.id, "dataset"):
+                    entry["dataset"] = dataset
+                else:
+                    entry["error"] = {"status": 403, "error": "Permission denied"}
+            datasets[uri] = entry
+        entry = datasets[uri]
+        return entry["dataset"], entry.get("error")
+
+    def _bulk_datafile(self, record, dataset):
+        """
+        Returns a validated, unsaved DataFile for a file record
+        """
+        unsupported = {"parameter_sets", "users", "groups", "attached_file"} & set(
+            record
+        )
+        if unsupported:
+            raise ValueError(
+                "Unsupported fields in bulk registration: %s"
+                % ", ".join(sorted(unsupported))
+            )
+        datafile = DataFile(dataset=dataset)
+        for name in self.BULK_FIELDS:
+            if name in record:
+                setattr(
+                    datafile,
+                    name,
+                    DataFile._meta.get_field(name).to_python(record[name]),
+                )
+        datafile.clean_fields(exclude=["dataset"])
+        datafile.prepare_save()
+        for replica in record.get("replicas") or []:
+            if not isinstance(replica, dict) or not replica.get("url"):
+                raise ValueError("Replicas need a url")
+        return datafile
+
+    def _bulk_insert(self, request, valid, datasets):
+        """
+        Inserts the DataFiles of valid file records, their DataFileObjects,
+        ACLs and identifiers, and returns the result of each record by index
+        """
+        # files which were registered since the duplicate check are
+        # reported by the unique constraint
+        datafiles = DataFile.bulk_register(
+            [datafile for dummy, dummy, datafile in valid]
+        )
+        boxes = {}
+        storages = {}
+
+        def get_box(name, datafile):
+            if name not in boxes:
+                boxes[name] = StorageBox.objects.filter(name=name).first()
+            box = boxes[name]
+            if box is None:
+                box = get_dataset_box("default", datafile)
+            return box
+
+        def get_dataset_box(kind, datafile):
+            key = (kind, datafile.dataset_id)
+            if key not in boxes:
+                if kind == "receiving":
+                    boxes[key] = datafile.get_receiving_storage_box()
+                else:
+                    boxes[key] = datafile.get_default_storage_box()
+            return boxes[key]
+
+        dfos = []
+        temp_urls = {}
+        for (index, record, dummy), datafile in zip(valid, datafiles):
+            replicas = record.get("replicas")
+            if replicas:
+                for replica in replicas:
+                    dfos.append(
+                        DataFileObject(
+                            datafile=datafile,
+                            storage_box=get_box(replica.get("location"), datafile),
+                            uri=replica["url"],
+                        )
+                    )
+                continue
+            box = get_dataset_box("receiving", datafile)
+            if box.id not in storages:
+                storages[box.id] = box.get_initialised_storage_instance()
+            # nothing has been uploaded to the staging location yet
+            dfo = DataFileObject(datafile=datafile, storage_box=box, stored_size=0)
+            dfo._cached_storage = storages[box.id]  # pylint: disable=W0212
+            dfo.create_set_uri()
+            temp_urls[index] = dfo.get_full_path()
+            dfos.append(dfo)
+        DataFileObject.bulk_register(dfos)
+
+        dataset_acls = {}
+        acls = []
+        # inheriting files get their permissions from their dataset
+        if not datafile_acls_inherited():
+            for datafile in datafiles:
+                if not settings.ONLY_EXPERIMENT_ACLS:
+                    acls.append(
+                        DatafileACL(
+                            datafile=datafile,
+                            user=request.user,
+                            canRead=True,
+                            canDownload=True,
+                            canWrite=True,
+                            canDelete=True,
+                            canSensitive=True,
+                            isOwner=True,
+                            aclOwnershipType=DatafileACL.OWNER_OWNED,
+                        )
+                    )
+                if datafile.dataset_id not in dataset_acls:
+                    dataset_acls[datafile.dataset_id] = list(
+                        DatasetACL.objects.filter(dataset_id=datafile.dataset_id)
+                    )
+                for parent_acl in dataset_acls[datafile.dataset_id]:
+                    # public access follows the file's own public_access
+                    if parent_acl.user_id == settings.PUBLIC_USER_ID:
+                        continue
+                    acls.append(
+                        DatafileACL(
+                            datafile=datafile,
+                            user_id=parent_acl.user_id,
+                            group_id=parent_acl.group_id,
+                            token_id=parent_acl.token_id,
+                            canRead=parent_acl.canRead,
+                            canDownload=parent_acl.canDownload,
+                            canWrite=parent_acl.canWrite,
+                            canSensitive=parent_acl.canSensitive,
+                            canDelete=parent_acl.canDelete,
+                            isOwner=parent_acl.isOwner,
+                            effectiveDate=parent_acl.effectiveDate,
+                            expiryDate=parent_acl.expiryDate,
+                            aclOwnershipType=parent_acl.aclOwnershipType,
+                        )
+                    )
+        if not settings.ONLY_EXPERIMENT_ACLS:
+            # like the public_acls post_save handler, which isn't called for
+            # bulk inserts
+            acls.extend(
+                DatafileACL(
+                    datafile=datafile,
+                    user_id=settings.PUBLIC_USER_ID,
+                    canRead=True,
+                    aclOwnershipType=DatafileACL.SYSTEM_OWNED,
+                )
+                for datafile in datafiles
+                if datafile.public_access > DataFile.PUBLIC_ACCESS_EMBARGO
+            )
+        batch_size = getattr(settings, "DATAFILE_BULK_BATCH_SIZE", 1000)
+        DatafileACL.objects.bulk_create(acls, batch_size=batch_size)
+
+        if (
+            "tardis.apps.identifiers" in settings.INSTALLED_APPS
+            and "datafile" in settings.OBJECTS_WITH_IDENTIFIERS
+        ):
+            DatafileID.objects.bulk_create(
+                [
+                    DatafileID(datafile=datafile, identifier=str(identifier))
+                    for (dummy, record, dummy), datafile in zip(valid, datafiles)
+                    for identifier in record.get("identifiers") or []
+                ],
+                batch_size=batch_size,
+            )
+
+        if getattr(settings, "ENABLE_EVENTLOG", False):
+            from tardis.apps.eventlog.utils import log_many
+
+            log_many(
+                "UPLOAD_DATAFILE",
+                [
+                    {"id": datafile.id, "type": "bulk"}
+                    for (index, dummy, dummy), datafile in zip(valid, datafiles)
+                    if index not in temp_urls
+                ],
+                request=request,
+            )
+
+        results = {}
+        for (index, dummy, dummy), datafile in zip(valid, datafiles):
+            results[index] = {
+                "status": 201,
+                "id": datafile.id,
+                "resource_uri": self.get_resource_uri(datafile),
+            }
+            if index in temp_urls:
+                results[index]["temp_url"] = temp_urls[index]
+        return results
+
     def __clean_bundle_of_identifiers(
         self,
         bundle: Bundle,
@@ -2001,7 +2380,11 @@ class DataFileResource(MyTardisModelResource):
         create ACL before any related objects are created in order to use
         ACL permissions for those objects.
         """
-        if getattr(bundle.obj, "id", False) and not settings.ONLY_EXPERIMENT_ACLS:
+        if (
+            getattr(bundle.obj, "id", False)
+            and not settings.ONLY_EXPERIMENT_ACLS
+            and not datafile_acls_inherited()
+        ):
             datafile = bundle.obj
             # TODO: unify this with the view function's ACL creation,
             # maybe through an ACL toolbox.
@@ -2043,7 +2426,9 @@ class DataFileResource(MyTardisModelResource):
                 sbox = bundle.obj.get_receiving_storage_box()
                 if sbox is None:
                     raise NotImplementedError
-                dfo = DataFileObject(datafile=bundle.obj, storage_box=sbox)
+                dfo = DataFileObject(
+                    datafile=bundle.obj, storage_box=sbox, stored_size=0
+                )
                 dfo.create_set_uri()
                 dfo.save()
                 self.temp_url = dfo.get_full_path()
@@ -2153,7 +2538,7 @@ class DataFileResource(MyTardisModelResource):
                         canSensitive=canSensitive,
                         isOwner=isOwner,
                     )
-            if not any(
+            if not datafile_acls_inherited() and not any(
                 [bundle.data.get("users", False), bundle.data.get("groups", False)]
             ):
                 for parent_acl in dataset.datasetacl_set.all():
@@ -2195,6 +2580,12 @@ class DataFileResource(MyTardisModelResource):
                 self.wrap_view("verify_file"),
                 name="api_verify_file",
             ),
+            re_path(
+                r"^(?P<resource_name>%s)/bulk%s$"
+                % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view("bulk_create_files"),
+                name="api_bulk_create_files",
+            ),
         ]
 
     def deserialize(self, request, data, format=None):
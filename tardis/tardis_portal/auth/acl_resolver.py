@@ -0,0 +1,430 @@
+"""
+Batched resolution of ACLs for a user
+
+The ACLResolver works out the principals a user acts as -- the user itself,
+the groups it belongs to and, for anonymous users, any valid tokens -- once,
+and matches all of them with a single query per ACL table, rather than
+OR-ing a separate query for every group.
+
+If ACL_CACHE_TIMEOUT is set, the ACLs of each principal are also kept in a
+Django cache shared between requests and processes, and invalidated by the
+ACL and group membership signal handlers in models/access_control.py.
+"""
+from datetime import date, datetime
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db.models import Q
+
+from .token_auth import TokenGroupProvider
+
+
+def get_acl_model(model_name):
+    """
+    Returns the ACL model and the name of its foreign key to the protected
+    object for a model name, as in ContentType.model
+
+    :param str model_name: project, experiment, dataset or datafile
+    :returns: (ACL model, foreign key name)
+    :rtype: tuple
+    """
+    model_name = model_name.replace(" ", "")
+    if model_name == "project":
+        from tardis.apps.projects.models import ProjectACL
+
+        return ProjectACL, "project"
+    if model_name == "experiment":
+        from ..models.access_control import ExperimentACL
+
+        return ExperimentACL, "experiment"
+    if model_name == "dataset":
+        from ..models.access_control import DatasetACL
+
+        return DatasetACL, "dataset"
+    if model_name == "datafile":
+        from ..models.access_control import DatafileACL
+
+        return DatafileACL, "datafile"
+    raise ValueError("No ACLs for model %s" % model_name)
+
+
+def datafile_acls_inherited():
+    """
+    Returns True if DataFiles without ACLs of their own inherit the ACLs of
+    their dataset, see DATAFILE_ACL_INHERITANCE
+    """
+    return getattr(settings, "DATAFILE_ACL_INHERITANCE", False)
+
+
+def overriding_datafile_acls():
+    """
+    Returns the DatafileACLs which override the ACLs of a file's dataset if
+    DATAFILE_ACL_INHERITANCE is set: all ACLs but those of the PUBLIC_USER,
+    which are kept in sync with the public access of the file
+
+    :rtype: QuerySet
+    """
+    from ..models.access_control import DatafileACL
+
+    return DatafileACL.objects.exclude(user_id=settings.PUBLIC_USER_ID)
+
+
+ACL_CACHE_FIELDS = (
+    "isOwner",
+    "canRead",
+    "canDownload",
+    "canWrite",
+    "canDelete",
+    "canSensitive",
+    "effectiveDate",
+    "expiryDate",
+)
+
+ACL_CACHE_PREFIX = "tardis_acls"
+
+# DataFile ACLs are too numerous to cache as id lists, e.g. those of the
+# PUBLIC_USER may exceed the item size limit of memcached
+ACL_CACHED_MODELS = ("project", "experiment", "dataset")
+
+
+def get_acl_cache():
+    """
+    Returns the cache for ACLs, None if ACL caching is disabled
+    """
+    if not getattr(settings, "ACL_CACHE_TIMEOUT", 0):
+        return None
+    return caches[getattr(settings, "ACL_CACHE", "default")]
+
+
+def _acl_cache_version(cache):
+    version_key = "%s:version" % ACL_CACHE_PREFIX
+    version = cache.get(version_key)
+    if version is None:
+        version = 1
+        cache.add(version_key, version, None)
+    return version
+
+
+def _acl_cache_key(version, *parts):
+    return ":".join(str(part) for part in (ACL_CACHE_PREFIX, version) + parts)
+
+
+def invalidate_acl_cache(model_name=None, user_ids=(), group_ids=(), token_ids=()):
+    """
+    Drops cached ACLs of the given principals for a model, and the cached
+    group memberships of the given users if no model is given
+
+    :param str model_name: project, experiment, dataset or datafile
+    :param list user_ids: ids of users
+    :param list group_ids: ids of groups
+    :param list token_ids: ids of tokens
+    """
+    cache = get_acl_cache()
+    if cache is None:
+        return
+    version = _acl_cache_version(cache)
+    if model_name is None:
+        keys = [_acl_cache_key(version, "groups", user_id) for user_id in user_ids]
+    else:
+        keys = [
+            _acl_cache_key(version, model_name, kind, principal_id)
+            for kind, principal_ids in (
+                ("user", user_ids),
+                ("group", group_ids),
+                ("token", token_ids),
+            )
+            for principal_id in principal_ids
+        ]
+    cache.delete_many(keys)
+
+
+def clear_acl_cache():
+    """
+    Drops all cached ACLs, for use after changes to ACLs which don't send
+    signals, e.g. bulk_create
+    """
+    cache = get_acl_cache()
+    if cache is None:
+        return
+    version_key = "%s:version" % ACL_CACHE_PREFIX
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, 2, None)
+
+
+class ACLResolver:
+    """
+    Resolves the principal set of a user and builds ACL queries for it.
+
+    Group memberships are matched with a subquery, so they are always
+    current, unless the ACL cache is enabled.  Tokens are resolved on first
+    use; use
+    :py:meth:`for_user` to get a resolver which is kept on the user object
+    and reused for as long as the user's allowed tokens don't change.
+
+    :param User user: a User or AnonymousUser instance
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.allowed_tokens = tuple(getattr(user, "allowed_tokens", ()))
+        self.user_ids = []
+        self.group_ids = None
+        self._token_ids = None
+        if user.is_authenticated:
+            self.user_ids = [user.id]
+            self.group_ids = user.groups.values("id")
+
+    @property
+    def token_ids(self):
+        """
+        ids of the valid tokens among the user's allowed tokens
+        """
+        if self._token_ids is None:
+            self._token_ids = [
+                token.id for token in TokenGroupProvider().getGroups(self.user)
+            ]
+        return self._token_ids
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Returns the resolver cached on the user object, creating it if needed
+
+        :param User user: a User or AnonymousUser instance
+        :returns: the user's resolver
+        :rtype: ACLResolver
+        """
+        resolver = getattr(user, "_acl_resolver", None)
+        if resolver is None or resolver.allowed_tokens != tuple(
+            getattr(user, "allowed_tokens", ())
+        ):
+            resolver = cls(user)
+            user._acl_resolver = resolver  # pylint: disable=W0212
+        return resolver
+
+    @classmethod
+    def for_principal(cls, user=None, group=None):
+        """
+        Returns a resolver which matches the ACLs of a single user or group
+        only, without the user's group memberships or tokens
+
+        :param User user: a User instance
+        :param Group group: a Group instance
+        :returns: the resolver
+        :rtype: ACLResolver
+        """
+        resolver = cls(AnonymousUser())
+        resolver._token_ids = []  # pylint: disable=W0212
+        if user is not None:
+            resolver.user_ids = [user.id]
+        if group is not None:
+            resolver.group_ids = [group.id]
+        return resolver
+
+    def principal_query(
+        self, include_principals=True, include_public=False, include_tokens=None
+    ):
+        """
+        Q object matching ACL rows of the user's principals and/or of the
+        PUBLIC_USER, through which public access is granted
+
+        :param bool include_principals: match ACLs of the user, its groups
+            and tokens
+        :param bool include_public: match ACLs of the PUBLIC_USER
+        :param bool include_tokens: match ACLs of the user's tokens; by
+            default tokens only apply to anonymous users
+        :returns: the Q object, or None if there are no principals to match
+        :rtype: Q
+        """
+        if include_tokens is None:
+            # the only authorisation available for anonymous users is tokenauth
+            include_tokens = not self.user.is_authenticated
+        user_ids = list(self.user_ids) if include_principals else []
+        if include_public:
+            user_ids.append(settings.PUBLIC_USER_ID)
+        clauses = []
+        if user_ids:
+            clauses.append(Q(user_id__in=user_ids))
+        if include_principals and self.group_ids is not None:
+            clauses.append(Q(group_id__in=self.group_ids))
+        if include_principals and include_tokens and self.token_ids:
+            clauses.append(Q(token_id__in=self.token_ids))
+        if not clauses:
+            return None
+        query = clauses[0]
+        for clause in clauses[1:]:
+            query |= clause
+        return query
+
+    def acls(
+        self,
+        model_name,
+        isOwner=None,
+        include_principals=True,
+        include_public=False,
+        include_tokens=None,
+    ):
+        """
+        Returns the effective ACLs of the user's principals for a model
+
+        :param str model_name: project, experiment, dataset or datafile
+        :param bool isOwner: only owner ACLs if True, only non-owner ACLs if
+            False, all ACLs if None
+        :param bool include_principals: match ACLs of the user, its groups
+            and tokens
+        :param bool include_public: match ACLs of the PUBLIC_USER
+        :param bool include_tokens: see :py:meth:`principal_query`
+        :returns: QuerySet of ACLs
+        :rtype: QuerySet
+        """
+        acl_model, dummy_fk = get_acl_model(model_name)
+        principals = self.principal_query(
+            include_principals, include_public, include_tokens
+        )
+        if principals is None:
+            return acl_model.objects.none()
+        query = acl_model.objects.filter(principals)
+        if isOwner is not None:
+            query = query.filter(isOwner=isOwner)
+        return query.exclude(
+            effectiveDate__gte=datetime.today(), expiryDate__lte=datetime.today()
+        )
+
+    def object_ids(self, model_name, isOwner=None, perms=None, **kwargs):
+        """
+        Returns the ids of the objects which the ACLs returned by
+        :py:meth:`acls` apply to, as a values_list QuerySet which is
+        evaluated as a subquery when used in an ``id__in`` lookup, or as a
+        list if the ACL cache is enabled and the ACLs could be cached
+
+        :param str model_name: project, experiment, dataset or datafile
+        :param bool isOwner: see :py:meth:`acls`
+        :param dict perms: additional ACL field values to filter on, e.g.
+            ``{"canDownload": True}``
+        :param kwargs: include_principals, include_public and include_tokens,
+            see :py:meth:`acls`
+        :returns: QuerySet or list of object ids
+        :rtype: QuerySet
+        """
+        cache = get_acl_cache()
+        if cache is not None and model_name.replace(" ", "") in ACL_CACHED_MODELS:
+            object_ids = self._cached_object_ids(
+                cache, model_name, isOwner=isOwner, perms=perms, **kwargs
+            )
+            if object_ids is not None:
+                return object_ids
+        dummy_model, fk = get_acl_model(model_name)
+        query = self.acls(model_name, isOwner=isOwner, **kwargs)
+        if perms:
+            query = query.filter(**perms)
+        return query.values_list(fk + "_id", flat=True)
+
+    def _cached_object_ids(
+        self,
+        cache,
+        model_name,
+        isOwner=None,
+        perms=None,
+        include_principals=True,
+        include_public=False,
+        include_tokens=None,
+    ):
+        """
+        :py:meth:`object_ids` from the ACLs of each principal in the cache,
+        or None if a principal has more than ACL_CACHE_MAX_ROWS ACLs
+        """
+        model_name = model_name.replace(" ", "")
+        if include_tokens is None:
+            include_tokens = not self.user.is_authenticated
+        version = _acl_cache_version(cache)
+        user_ids = list(self.user_ids) if include_principals else []
+        if include_public:
+            user_ids.append(settings.PUBLIC_USER_ID)
+        principals = {"user": user_ids, "group": [], "token": []}
+        if include_principals and self.user.is_authenticated:
+            principals["group"] = self._cached_group_ids(cache, version)
+        elif include_principals and self.group_ids is not None:
+            principals["group"] = list(self.group_ids)
+        if include_principals and include_tokens:
+            principals["token"] = self.token_ids
+
+        rows = self._cached_acl_rows(cache, version, model_name, principals)
+        if rows is None:
+            return None
+        today = date.today()
+        object_ids = set()
+        for row in rows:
+            values = dict(zip(ACL_CACHE_FIELDS, row[1:]))
+            if isOwner is not None and values["isOwner"] != isOwner:
+                continue
+            if perms and any(values[key] != value for key, value in perms.items()):
+                continue
+            effective, expiry = values["effectiveDate"], values["expiryDate"]
+            if effective and expiry and expiry <= today <= effective:
+                continue
+            object_ids.add(row[0])
+        return list(object_ids)
+
+    def _cached_group_ids(self, cache, version):
+        key = _acl_cache_key(version, "groups", self.user.id)
+        group_ids = cache.get(key)
+        if group_ids is None:
+            group_ids = list(self.user.groups.values_list("id", flat=True))
+            cache.set(key, group_ids, settings.ACL_CACHE_TIMEOUT)
+        return group_ids
+
+    def _cached_acl_rows(self, cache, version, model_name, principals):
+        """
+        Returns (object id, ACL_CACHE_FIELDS...) tuples of the ACLs of all
+        principals, querying the ACL table once for each kind of principal
+        that isn't cached yet.  Principals with more than ACL_CACHE_MAX_ROWS
+        ACLs are cached as False, and None is returned for them
+        """
+        acl_model, fk = get_acl_model(model_name)
+        max_rows = getattr(settings, "ACL_CACHE_MAX_ROWS", 10000)
+        keys = {
+            (kind, principal_id): _acl_cache_key(
+                version, model_name, kind, principal_id
+            )
+            for kind, principal_ids in principals.items()
+            for principal_id in principal_ids
+        }
+        cached = cache.get_many(list(keys.values()))
+        rows = []
+        missing = {}
+        too_many = False
+        for (kind, principal_id), key in keys.items():
+            if key in cached:
+                if cached[key] is False:
+                    too_many = True
+                else:
+                    rows.extend(cached[key])
+            else:
+                missing.setdefault(kind, []).append(principal_id)
+        to_cache = {}
+        for kind, principal_ids in missing.items():
+            principal_rows = {principal_id: [] for principal_id in principal_ids}
+            for acl in (
+                acl_model.objects.filter(**{kind + "_id__in": principal_ids})
+                .values_list(kind + "_id", fk + "_id", *ACL_CACHE_FIELDS)
+                .iterator()
+            ):
+                acl_rows = principal_rows[acl[0]]
+                if acl_rows is False:
+                    continue
+                if len(acl_rows) >= max_rows:
+                    principal_rows[acl[0]] = False
+                    continue
+                acl_rows.append(tuple(acl[1:]))
+            for principal_id, acl_rows in principal_rows.items():
+                if acl_rows is False:
+                    too_many = True
+                else:
+                    rows.extend(acl_rows)
+                to_cache[keys[(kind, principal_id)]] = acl_rows
+        if to_cache:
+            cache.set_many(to_cache, settings.ACL_CACHE_TIMEOUT)
+        return None if too_many else rows
@@ -3,16 +3,56 @@ Object-level authorisation backend
 
 .. moduleauthor:: Grischa Meyer <grischa@gmail.com>
 """
-from datetime import datetime
+from contextvars import ContextVar
 
 from django.conf import settings
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 from ..models.access_control import DatafileACL, DatasetACL, ExperimentACL
-from .token_auth import TokenGroupProvider
+from ..models.datafile import DataFile
+from ..models.dataset import Dataset
+from ..models.experiment import Experiment
+from .acl_resolver import (
+    ACLResolver,
+    datafile_acls_inherited,
+    get_acl_model,
+    overriding_datafile_acls,
+)
+
+# results of permission checks, keyed by (user, token, perm, model, object id),
+# for the duration of a request; None outside of PermissionCacheMiddleware
+_perm_cache = ContextVar("tardis_acl_perm_cache", default=None)
+
+
+class PermissionCacheMiddleware(object):
+    """
+    caches the results of ACLAwareBackend's object permission checks for the
+    duration of a request
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _perm_cache.set({})
+        try:
+            return self.get_response(request)
+        finally:
+            _perm_cache.reset(token)
+
+
+def clear_perm_cache(**kwargs):
+    """
+    empties the permission cache of the current request, connected to the
+    signals of models which permissions are derived from
+    """
+    cache = _perm_cache.get()
+    if cache is not None:
+        cache.clear()
 
 
 class ACLAwareBackend(object):
@@ -48,14 +88,78 @@ class ACLAwareBackend(object):
         """
         main method, calls other methods based on permission type queried
         """
+        if obj is None:
+            return False
+        return self.has_perms(user_obj, perm, [obj])[obj.pk]
+
+    def has_perms(self, user_obj, perm, objs):
+        """
+        checks a permission on a list of objects of the same type, with a
+        single ACL query for all objects which the models' own permission
+        methods don't decide
+
+        :param User user_obj: a User or AnonymousUser instance
+        :param str perm: the permission, e.g. "tardis_acls.download_datafile"
+        :param list objs: the objects to check
+        :returns: dict of object id to bool
+        :rtype: dict
+        """
         if not user_obj.is_authenticated:
             allowed_tokens = getattr(user_obj, "allowed_tokens", [])
             user_obj = AnonymousUser()
             user_obj.allowed_tokens = allowed_tokens
 
-        if obj is None:
-            return False
+        cache = _perm_cache.get()
+        user_key = (user_obj.pk, tuple(sorted(getattr(user_obj, "allowed_tokens", []))))
+        results = {}
+        pending = []
+        for obj in objs:
+            key = (user_key, perm, type(obj), obj.pk)
+            if cache is not None and key in cache:
+                results[obj.pk] = cache[key]
+            else:
+                pending.append(obj)
+        if not pending:
+            return results
+
+        parsed_perm = self._parse_perm(user_obj, perm)
+        undecided = []
+        for obj in pending:
+            result = False
+            if parsed_perm is not None:
+                result = self._has_model_perm(user_obj, obj, *parsed_perm)
+            if result is None:
+                undecided.append(obj)
+            else:
+                results[obj.pk] = result
+
+        if undecided:
+            ct = ContentType.objects.get_for_model(undecided[0])
+            allowed = set()
+            if ct.model == "experiment" or not settings.ONLY_EXPERIMENT_ACLS:
+                allowed = self._acl_object_ids(
+                    user_obj, parsed_perm[1], ct, [obj.pk for obj in undecided]
+                )
+                if ct.model == "datafile" and datafile_acls_inherited():
+                    allowed |= self._inherited_object_ids(
+                        user_obj,
+                        parsed_perm[1],
+                        [obj for obj in undecided if obj.pk not in allowed],
+                    )
+            for obj in undecided:
+                results[obj.pk] = obj.pk in allowed
+
+        if cache is not None:
+            for obj in pending:
+                if obj.pk is not None:
+                    cache[(user_key, perm, type(obj), obj.pk)] = results[obj.pk]
+        return results
 
+    def _parse_perm(self, user_obj, perm):
+        """
+        splits a permission into (label, action, content type), returns None
+        if the permission is not handled by this backend
+        """
         try:
             perm_label, perm_type = perm.split(".")
             # the following is necessary because of the ridiculous naming
@@ -65,16 +169,23 @@ class ACLAwareBackend(object):
             perm_action = type_list[0]
             perm_ct = "_".join(type_list[1:])
         except:
-            return False
+            return None
 
         if perm_label != self.app_label:
-            return False
+            return None
 
         if perm_type == "change_experiment" and not user_obj.has_perm(
             "tardis_portal.change_experiment"
         ):
-            return False
+            return None
+
+        return perm_label, perm_action, perm_ct
 
+    def _has_model_perm(self, user_obj, obj, perm_label, perm_action, perm_ct):
+        """
+        runs the checks which don't depend on the object's own ACLs,
+        returns None if the ACLs need to be checked
+        """
         ct = ContentType.objects.get_for_model(obj)
         if ct.model != perm_ct:
             return False
@@ -103,152 +214,60 @@ class ACLAwareBackend(object):
                     if user_obj.has_perm(new_perm, msp):
                         return True
 
-        if ct.model == "experiment":
-            # the only authorisation available for anonymous users is tokenauth
-            tgp = TokenGroupProvider()
-            query = ExperimentACL.objects.none()
-            for token in tgp.getGroups(user_obj):
-                query |= (
-                    token.experimentacls.select_related("experiment")
-                    .filter(experiment__id=obj.id)
-                    .filter(self.get_perm_bool(perm_action))
-                    .exclude(
-                        effectiveDate__gte=datetime.today(),
-                        expiryDate__lte=datetime.today(),
-                    )
-                )
-            if user_obj.is_authenticated:
-                query |= (
-                    user_obj.experimentacls.select_related("experiment")
-                    .filter(experiment__id=obj.id)
-                    .filter(self.get_perm_bool(perm_action))
-                    .exclude(
-                        effectiveDate__gte=datetime.today(),
-                        expiryDate__lte=datetime.today(),
-                    )
-                )
-                for group in user_obj.groups.all():
-                    query |= (
-                        group.experimentacls.select_related("experiment")
-                        .filter(experiment__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-            return query.exists()
-
-        if not settings.ONLY_EXPERIMENT_ACLS:
-
-            if ct.model.replace(" ", "") == "project":
-                from tardis.apps.projects.models import ProjectACL
-
-                # the only authorisation available for anonymous users is tokenauth
-                tgp = TokenGroupProvider()
-                query = ProjectACL.objects.none()
-                for token in tgp.getGroups(user_obj):
-                    query |= (
-                        token.projectacls.select_related("project")
-                        .filter(project__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                if user_obj.is_authenticated:
-                    query |= (
-                        user_obj.projectacls.select_related("project")
-                        .filter(project__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                    for group in user_obj.groups.all():
-                        query |= (
-                            group.projectacls.select_related("project")
-                            .filter(project__id=obj.id)
-                            .filter(self.get_perm_bool(perm_action))
-                            .exclude(
-                                effectiveDate__gte=datetime.today(),
-                                expiryDate__lte=datetime.today(),
-                            )
-                        )
-                return query.exists()
-
-            if ct.model == "dataset":
-                # the only authorisation available for anonymous users is tokenauth
-                tgp = TokenGroupProvider()
-                query = DatasetACL.objects.none()
-                for token in tgp.getGroups(user_obj):
-                    query |= (
-                        token.datasetacls.select_related("dataset")
-                        .filter(dataset__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                if user_obj.is_authenticated:
-                    query |= (
-                        user_obj.datasetacls.select_related("dataset")
-                        .filter(dataset__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                    for group in user_obj.groups.all():
-                        query |= (
-                            group.datasetacls.select_related("dataset")
-                            .filter(dataset__id=obj.id)
-                            .filter(self.get_perm_bool(perm_action))
-                            .exclude(
-                                effectiveDate__gte=datetime.today(),
-                                expiryDate__lte=datetime.today(),
-                            )
-                        )
-                return query.exists()
-
-            if ct.model.replace(" ", "") == "datafile":
-                # the only authorisation available for anonymous users is tokenauth
-                tgp = TokenGroupProvider()
-                query = DatafileACL.objects.none()
-                for token in tgp.getGroups(user_obj):
-                    query |= (
-                        token.datafileacls.select_related("datafile")
-                        .filter(datafile__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                if user_obj.is_authenticated:
-                    query |= (
-                        user_obj.datafileacls.select_related("datafile")
-                        .filter(datafile__id=obj.id)
-                        .filter(self.get_perm_bool(perm_action))
-                        .exclude(
-                            effectiveDate__gte=datetime.today(),
-                            expiryDate__lte=datetime.today(),
-                        )
-                    )
-                    for group in user_obj.groups.all():
-                        query |= (
-                            group.datafileacls.select_related("datafile")
-                            .filter(datafile__id=obj.id)
-                            .filter(self.get_perm_bool(perm_action))
-                            .exclude(
-                                effectiveDate__gte=datetime.today(),
-                                expiryDate__lte=datetime.today(),
-                            )
-                        )
-                return query.exists()
-
-        return False
+        return None
+
+    def _acl_object_ids(self, user_obj, perm_action, ct, obj_ids):
+        """
+        returns the ids of the objects among obj_ids which the ACLs of the
+        user, its groups and tokens grant the permission on
+        """
+        try:
+            dummy_model, fk = get_acl_model(ct.model)
+        except ValueError:
+            return set()
+        acls = (
+            ACLResolver.for_user(user_obj)
+            .acls(ct.model, include_tokens=True)
+            .filter(**{fk + "_id__in": obj_ids})
+            .filter(self.get_perm_bool(perm_action))
+        )
+        return set(acls.values_list(fk + "_id", flat=True))
+
+    def _inherited_object_ids(self, user_obj, perm_action, datafiles):
+        """
+        returns the ids of the datafiles without ACLs of their own whose
+        dataset's ACLs grant the permission
+        """
+        if not datafiles:
+            return set()
+        overridden = set(
+            overriding_datafile_acls()
+            .filter(datafile_id__in=[datafile.pk for datafile in datafiles])
+            .values_list("datafile_id", flat=True)
+        )
+        inheriting = [
+            datafile for datafile in datafiles if datafile.pk not in overridden
+        ]
+        if not inheriting:
+            return set()
+        allowed_datasets = self._acl_object_ids(
+            user_obj,
+            perm_action,
+            ContentType.objects.get_for_model(Dataset),
+            {datafile.dataset_id for datafile in inheriting},
+        )
+        return {
+            datafile.pk
+            for datafile in inheriting
+            if datafile.dataset_id in allowed_datasets
+        }
+
+
+for _sender in (ExperimentACL, DatasetACL, DatafileACL, Experiment, Dataset, DataFile):
+    post_save.connect(clear_perm_cache, sender=_sender)
+    post_delete.connect(clear_perm_cache, sender=_sender)
+if "tardis.apps.projects" in settings.INSTALLED_APPS:
+    for _sender in ("projects.ProjectACL", "projects.Project"):
+        post_save.connect(clear_perm_cache, sender=_sender)
+        post_delete.connect(clear_perm_cache, sender=_sender)
+m2m_changed.connect(clear_perm_cache, sender=User.groups.through)
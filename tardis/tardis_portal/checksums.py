@@ -0,0 +1,126 @@
+"""
+Streaming checksum engine
+
+Files are read in large chunks, aligned to the page size, or memory-mapped
+if they are local files.  Each chunk is fed to all of the hash functions in
+separate threads -- hashlib releases the GIL while hashing -- while the next
+chunk is being read, so that checksumming is limited by the speed of the
+storage rather than by the CPU or by system calls.
+"""
+import hashlib
+import io
+import mmap
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+CHECKSUM_ALGORITHMS = {"md5sum": "md5", "sha512sum": "sha512"}
+"""The hashlib algorithm of each checksum field of DataFile"""
+
+
+def _aligned(size):
+    return max(mmap.PAGESIZE, size - size % mmap.PAGESIZE)
+
+
+class ChecksumEngine:
+    """
+    Computes several checksums of a file in a single pass.
+
+    :param list checksums: the checksums to compute, e.g.
+        ``["md5sum", "sha512sum"]``
+    :param int chunk_size: bytes to read at a time, rounded down to a
+        multiple of the page size, CHECKSUM_CHUNK_SIZE by default
+    :param bool use_mmap: memory-map files which have a file descriptor,
+        CHECKSUM_USE_MMAP by default
+
+    :attribute bytes_read: number of bytes checksummed
+    :attribute elapsed: seconds spent reading and checksumming
+    """
+
+    def __init__(self, checksums, chunk_size=None, use_mmap=None):
+        self.hashers = {
+            checksum: hashlib.new(CHECKSUM_ALGORITHMS[checksum])
+            for checksum in checksums
+        }
+        if chunk_size is None:
+            chunk_size = getattr(settings, "CHECKSUM_CHUNK_SIZE", 8 * 1024 * 1024)
+        self.chunk_size = _aligned(chunk_size)
+        if use_mmap is None:
+            use_mmap = getattr(settings, "CHECKSUM_USE_MMAP", True)
+        self.use_mmap = use_mmap
+        self.bytes_read = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Measured throughput in bytes per second
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed
+
+    @staticmethod
+    def _map(file_object):
+        """
+        Memory-maps a file, returns None if it can't be mapped
+        """
+        try:
+            fileno = file_object.fileno()
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+        try:
+            mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # e.g. empty files, pipes and sockets
+            return None
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return mapped
+
+    def _update(self, executor, chunks):
+        pending = []
+        # hashing a chunk overlaps with reading the next one
+        for chunk in chunks:
+            for future in pending:
+                future.result()
+            pending = [
+                executor.submit(hasher.update, chunk)
+                for hasher in self.hashers.values()
+            ]
+            self.bytes_read += len(chunk)
+        for future in pending:
+            future.result()
+
+    def update_file(self, file_object):
+        """
+        Checksums the whole contents of a file object, from its start
+        """
+        file_object.seek(0)
+        mapped = self._map(file_object) if self.use_mmap else None
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(self.hashers) or 1) as executor:
+            if mapped is None:
+                self._update(
+                    executor, iter(lambda: file_object.read(self.chunk_size), b"")
+                )
+            else:
+                with mapped, memoryview(mapped) as view:
+                    self._update(
+                        executor,
+                        (
+                            view[offset : offset + self.chunk_size]
+                            for offset in range(0, len(view), self.chunk_size)
+                        ),
+                    )
+        self.elapsed += time.monotonic() - started
+
+    def hexdigests(self):
+        """
+        :return: the checksums, e.g. {'md5sum': result, 'sha512sum': result}
+        :rtype: dict
+        """
+        return {
+            checksum: hasher.hexdigest() for checksum, hasher in self.hashers.items()
+        }
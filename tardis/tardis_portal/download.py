@@ -10,7 +10,6 @@ download.py
 """
 import logging
 import os
-import time
 import urllib
 from importlib import import_module
 
@@ -24,20 +23,15 @@ except ImportError:
 
     crc32 = binascii.crc32
 
-import gzip
 import io
-import tarfile
 from itertools import chain
-from tarfile import TarFile
+from urllib.parse import quote
 from wsgiref.util import FileWrapper
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ImproperlyConfigured
-from django.http import StreamingHttpResponse
-from django.utils.dateformat import format as dateformatter
-
-from tardis.analytics.tracker import IteratorTracker
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 
 from .auth.decorators import (
     dataset_download_required,
@@ -51,6 +45,7 @@ from .shortcuts import (
     return_response_error,
     return_response_not_found,
 )
+from .tar_stream import UncachedTarStream
 from .util import get_filesystem_safe_dataset_name, get_filesystem_safe_experiment_name
 
 logger = logging.getLogger(__name__)
@@ -58,6 +53,62 @@ logger = logging.getLogger(__name__)
 DEFAULT_ORGANIZATION = settings.DEFAULT_PATH_MAPPER
 
 
+def get_proxy_download_response(
+    dfo,
+    filename,
+    disposition="attachment",
+    content_type="application/force-download",
+):
+    """
+    Returns a response handing the download of a DataFileObject over to the
+    front-end web server with an X-Accel-Redirect (NGINX) or X-Sendfile
+    (Apache, lighttpd) header, so that the file data doesn't pass through
+    Python at all.
+
+    The internal URL is built from the storage box's proxy_download_prefix
+    attribute if it has one, or else from PROXY_DOWNLOAD_PREFIXES.
+
+    :returns: the response, or None if PROXY_DOWNLOADS is disabled or the
+        file is not in a location known to the front-end web server
+    :rtype: HttpResponse
+    """
+    if not getattr(settings, "PROXY_DOWNLOADS", False):
+        return None
+    header = getattr(settings, "PROXY_DOWNLOAD_HEADER", "X-Accel-Redirect")
+    internal_path = None
+    if header == "X-Accel-Redirect":
+        box_prefix = dfo.storage_box.proxy_download_prefix
+        if box_prefix and dfo.uri:
+            internal_path = quote(
+                "{}/{}".format(box_prefix.rstrip("/"), dfo.uri.lstrip("/"))
+            )
+    if internal_path is None:
+        try:
+            full_path = dfo.get_full_path()
+        except NotImplementedError:
+            # not a file system based storage box
+            return None
+        if header == "X-Accel-Redirect":
+            for key, value in settings.PROXY_DOWNLOAD_PREFIXES.items():
+                if full_path.startswith(key):
+                    internal_path = quote(
+                        "{}{}".format(value, full_path.split(key, 1)[1])
+                    )
+                    break
+        elif dfo.storage_box.proxy_download_prefix or any(
+            full_path.startswith(key) for key in settings.PROXY_DOWNLOAD_PREFIXES
+        ):
+            internal_path = full_path
+    if internal_path is None:
+        return None
+    cd = '{}; filename="{}"'.format(disposition, filename)
+    return HttpResponse(
+        status=200,
+        content_type=content_type,
+        headers={"Content-Disposition": cd, header: internal_path},
+    )
+
+
 def _create_download_response(
     request, datafile_id, disposition="attachment"
 ):  # too complex # noqa
@@ -100,6 +151,15 @@ def _create_download_response(
         if ignore_verif.lower() in ["", "1", "true"]:
             verified_only = False
 
+        # Let the front-end web server send the file if it can
+        preferred_dfo = datafile.get_preferred_dfo(verified_only)
+        if preferred_dfo is not None:
+            response = get_proxy_download_response(
+                preferred_dfo, datafile.filename, disposition, datafile.get_mimetype()
+            )
+            if response is not None:
+                return response
+
         # Get file object for datafile
         file_obj = datafile.get_file(verified_only=verified_only)
         if not file_obj:
@@ -111,8 +171,10 @@ def _create_download_response(
                     status=503,
                 )
             return return_response_not_found(request)
-        wrapper = FileWrapper(file_obj, blksize=65535)
-        response = StreamingHttpResponse(wrapper, content_type=datafile.get_mimetype())
+        # FileResponse lets the WSGI server send local files with
+        # os.sendfile (wsgi.file_wrapper) instead of reading them in Python
+        response = FileResponse(file_obj, content_type=datafile.get_mimetype())
+        response.block_size = 65535
         response["Content-Disposition"] = '%s; filename="%s"' % (
             disposition,
             datafile.filename,
@@ -228,193 +290,6 @@ def _get_datafile_details_for_archive(mapper, datafiles):
     return res
 
 
-class UncachedTarStream(TarFile):
-    """
-    Stream files into a compressed tar stream on the fly
-    """
-
-    def __init__(
-        self,
-        mapped_file_objs,
-        filename,
-        do_gzip=False,
-        buffersize=2 * 65536,
-        comp_level=6,
-        http_buffersize=65535,
-    ):
-        self.errors = "strict"
-        self.pax_headers = {}
-        self.mode = "w"
-        self.closed = False
-        self.members = []
-        self._loaded = False
-        self.offset = 0
-        self.inodes = {}
-        self._loaded = True
-        self.mapped_file_objs = mapped_file_objs
-        filenum = len(mapped_file_objs)
-        self.tarinfos = [None] * filenum
-        self.tarinfo_bufs = [None] * filenum
-        self.filename = filename
-        self.buffersize = buffersize
-        self.http_buffersize = http_buffersize
-        self.do_gzip = do_gzip
-        if do_gzip:
-            self.binary_buffer = io.BytesIO()
-            self.gzipfile = gzip.GzipFile(
-                bytes(filename), "w", comp_level, self.binary_buffer
-            )
-        self.tar_size = self.compute_size()
-
-    def compute_size(self):
-        total_size = 0
-        for num, fobj in enumerate(self.mapped_file_objs):
-            df, name = fobj
-            tarinfo = self.tarinfo_for_df(df, name)
-            self.tarinfos[num] = tarinfo
-            tarinfo_buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
-            self.tarinfo_bufs[num] = tarinfo_buf
-            total_size += len(tarinfo_buf)
-            size = int(tarinfo.size)
-            blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
-            if remainder > 0:
-                blocks += 1
-            total_size += blocks * tarfile.BLOCKSIZE
-        blocks, remainder = divmod(total_size, tarfile.RECORDSIZE)
-        if remainder > 0:
-            blocks += 1
-        total_size = blocks * tarfile.RECORDSIZE
-        return total_size
-
-    def tarinfo_for_df(self, df, name):
-        tarinfo = self.tarinfo(name)
-        tarinfo.size = int(df.get_size())
-        try:
-            dj_mtime = df.modification_time or df.get_preferred_dfo().modified_time
-        except Exception as e:
-            dj_mtime = None
-            logger.debug(
-                "cannot read m_time for file id" " %d, exception %s" % (df.id, str(e))
-            )
-        if dj_mtime is not None:
-            tarinfo.mtime = float(dateformatter(dj_mtime, "U"))
-        else:
-            tarinfo.mtime = time.time()
-        return tarinfo
-
-    def compress(self, buf):
-        self.gzipfile.write(buf)
-        self.gzipfile.flush()
-        self.binary_buffer.seek(0)
-        result = self.binary_buffer.read()
-        self.binary_buffer.seek(0)
-        self.binary_buffer.truncate()
-        return result
-
-    def prepare_output(self, uc_buf, remainder):
-        if self.do_gzip:
-            result_buf = self.compress(uc_buf)
-        else:
-            result_buf = uc_buf
-        if remainder is not None:
-            result_buf = b"".join([remainder, result_buf])
-        stream_buffers = []
-        while len(result_buf) >= self.http_buffersize:
-            stream_buffers.append(result_buf[: self.http_buffersize])
-            result_buf = result_buf[self.http_buffersize :]
-        return stream_buffers, result_buf
-
-    def close_gzip(self):
-        self.gzipfile.close()
-        self.binary_buffer.seek(0)
-        result = self.binary_buffer.read()
-        self.binary_buffer.seek(0)
-        self.binary_buffer.truncate()
-        return result
-
-    def make_tar(self):  # noqa
-        """
-        main tar generator. until python 3 needs to be in one function
-        because 'yield's don't bubble up.
-        """
-        remainder_buf = None
-        for num, fobj in enumerate(self.mapped_file_objs):
-            df, dummy_name = fobj
-            fileobj = df.file_object
-            self._check("aw")
-            tarinfo = self.tarinfos[num]
-            buf = self.tarinfo_bufs[num]
-            stream_buffers, remainder_buf = self.prepare_output(buf, remainder_buf)
-            for stream_buf in stream_buffers:
-                yield stream_buf
-            self.offset += len(buf or "")
-            if tarinfo.isreg():
-                if tarinfo.size == 0:
-                    continue
-                # split into file read buffer sized chunks
-                blocks, remainder = divmod(tarinfo.size, self.buffersize)
-                for dummy_b in range(blocks):
-                    buf = fileobj.read(self.buffersize)
-                    if len(buf) < self.buffersize:
-                        raise IOError("end of file reached")
-                    # send in http_buffersize sized chunks
-                    stream_buffers, remainder_buf = self.prepare_output(
-                        buf, remainder_buf
-                    )
-                    for stream_buf in stream_buffers:
-                        yield stream_buf
-                # in case the file has remaining read bytes
-                if remainder != 0:
-                    buf = fileobj.read(remainder)
-                    if len(buf) < remainder:
-                        raise IOError("end of file reached")
-                    # send remaining file data
-                    stream_buffers, remainder_buf = self.prepare_output(
-                        buf, remainder_buf
-                    )
-                    for stream_buf in stream_buffers:
-                        yield stream_buf
-                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
-                if remainder > 0:
-                    buf = tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
-                    stream_buffers, remainder_buf = self.prepare_output(
-                        buf, remainder_buf
-                    )
-                    for stream_buf in stream_buffers:
-                        yield stream_buf
-                    blocks += 1
-                self.offset += blocks * tarfile.BLOCKSIZE
-            fileobj.close()
-        # fill up the end with zero-blocks
-        # (like option -b20 for tar does)
-        blocks, remainder = divmod(self.offset, tarfile.RECORDSIZE)
-        if remainder > 0:
-            buf = tarfile.NUL * (tarfile.RECORDSIZE - remainder)
-            stream_buffers, remainder_buf = self.prepare_output(buf, remainder_buf)
-            for stream_buf in stream_buffers:
-                yield stream_buf
-        if remainder_buf:
-            yield remainder_buf
-        if self.do_gzip:
-            yield self.close_gzip()
-
-    def get_response(self, tracker_data=None):
-        if self.do_gzip:
-            content_type = "application/x-gzip"
-            content_length = None
-            self.filename += ".gz"
-        else:
-            content_type = "application/x-tar"
-            content_length = self.tar_size
-        file_iterator = IteratorTracker(self.make_tar(), tracker_data)
-        response = StreamingHttpResponse(file_iterator, content_type=content_type)
-        response["Content-Disposition"] = 'attachment; filename="%s"' % self.filename
-        response["X-Accel-Buffering"] = "no"
-        if content_length is not None:
-            response["Content-Length"] = content_length
-        return response
-
-
 def _streaming_downloader(
     request,
     datafiles,
@@ -436,18 +311,32 @@ def _streaming_downloader(
         )
 
     if getattr(settings, "ENABLE_EVENTLOG", False):
-        from tardis.apps.eventlog.utils import log
+        from tardis.apps.eventlog.utils import log_many
 
-        for df in datafiles:
-            log(
-                action="DOWNLOAD_DATAFILE",
-                extra={"id": df.id, "type": "tar"},
-                request=request,
-            )
+        log_many(
+            action="DOWNLOAD_DATAFILE",
+            extras=[{"id": df.id, "type": "tar"} for df in datafiles],
+            request=request,
+        )
 
     try:
+        # a stable member order keeps the archive layout identical between
+        # requests, which is required for resuming with Range requests
+        datafiles = sorted(datafiles, key=lambda df: df.id)
         files = _get_datafile_details_for_archive(mapper, datafiles)
-        tfs = UncachedTarStream(files, filename=filename, do_gzip=comptype != "tar")
+        tfs = UncachedTarStream(
+            files,
+            filename=filename,
+            do_gzip=comptype != "tar",
+            prefetch_files=getattr(settings, "DOWNLOAD_ARCHIVE_PREFETCH_FILES", 0),
+            prefetch_max_bytes=getattr(
+                settings, "DOWNLOAD_ARCHIVE_PREFETCH_MAX_BYTES", 64 * 1024 * 1024
+            ),
+            gzip_workers=getattr(settings, "DOWNLOAD_ARCHIVE_GZIP_WORKERS", 0),
+            uncompressed_mimetypes=getattr(
+                settings, "DOWNLOAD_ARCHIVE_UNCOMPRESSED_MIMETYPES", ()
+            ),
+        )
         tracker_data = {
             "label": "tar",
             "session_id": request.COOKIES.get("_ga"),
@@ -457,7 +346,11 @@ def _streaming_downloader(
             "num_files": len(datafiles),
             "ua": request.META.get("HTTP_USER_AGENT", None),
         }
-        return tfs.get_response(tracker_data)
+        return tfs.get_response(
+            tracker_data,
+            range_header=request.META.get("HTTP_RANGE"),
+            if_range=request.META.get("HTTP_IF_RANGE"),
+        )
     except ValueError:  # raised when replica not verified TODO: custom excptn
         message = """The experiment you are trying to access has not yet been
                      verified completely.
@@ -0,0 +1,278 @@
+"""
+Data for the facility overview
+
+The facility overview lists the datasets recorded by a facility's
+instruments, with their file counts and sizes, and the files of a dataset
+with their upload progress.
+
+The aggregates of all datasets on a page are computed by one annotated query,
+and their experiments, owners and groups by one query each, rather than by
+several queries per dataset.  The upload progress of unverified files is the
+stored size recorded by their DataFileObjects when the files were written or
+verified, so that no files are opened.
+
+If FACILITY_OVERVIEW_CACHE_TIMEOUT is set, the results are kept in the
+FACILITY_OVERVIEW_CACHE cache for that many seconds, per facility.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import (
+    Count,
+    Exists,
+    IntegerField,
+    Max,
+    OuterRef,
+    Prefetch,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DataFile, DataFileObject, Dataset, Experiment
+from .models.access_control import ExperimentACL
+
+logger = logging.getLogger(__name__)
+
+FACILITY_OVERVIEW_CACHE_PREFIX = "facility_overview"
+
+
+def datetime_to_us(dt):
+    """
+    The datetime objects are kept as None if they aren't set, otherwise
+    they're converted to milliseconds so AngularJS can format them nicely.
+    """
+    if dt is None:
+        return None
+    dt = timezone.localtime(dt)
+    return time.mktime(dt.timetuple()) * 1000 + dt.microsecond / 1000
+
+
+def get_facility_overview_cache():
+    """
+    Returns the cache for facility overview data, None if caching is disabled
+    """
+    if not getattr(settings, "FACILITY_OVERVIEW_CACHE_TIMEOUT", 0):
+        return None
+    return caches[getattr(settings, "FACILITY_OVERVIEW_CACHE", "default")]
+
+
+def _cached(facility_id, key, compute):
+    """
+    Returns the value cached for a facility under a key, computing and caching
+    it if needed
+    """
+    cache = get_facility_overview_cache()
+    if cache is None:
+        return compute()
+    cache_key = ":".join(
+        str(part) for part in (FACILITY_OVERVIEW_CACHE_PREFIX, facility_id) + key
+    )
+    value = cache.get(cache_key)
+    if value is None:
+        value = compute()
+        cache.set(cache_key, value, settings.FACILITY_OVERVIEW_CACHE_TIMEOUT)
+    return value
+
+
+def _file_aggregate(datafiles, aggregate):
+    """
+    Returns a subquery of an aggregate over the DataFiles of the outer
+    Dataset, 0 if it has none
+    """
+    return Coalesce(
+        Subquery(
+            datafiles.filter(dataset=OuterRef("pk"))
+            .order_by()
+            .values("dataset")
+            .annotate(value=aggregate)
+            .values("value"),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+def annotate_dataset_aggregates(datasets):
+    """
+    Annotates datasets with the number and size of their files, as
+    datafile_count and dataset_size, and of their verified files, as
+    verified_datafiles_count and verified_datafiles_size.
+
+    A file is verified if it has DataFileObjects, all of which are verified.
+
+    :param QuerySet datasets: Dataset queryset
+    :rtype: QuerySet
+    """
+    dfos = DataFileObject.objects.filter(datafile=OuterRef("pk"))
+    verified_datafiles = DataFile.objects.filter(
+        Exists(dfos), ~Exists(dfos.filter(verified=False))
+    )
+    return datasets.annotate(
+        datafile_count=_file_aggregate(DataFile.objects.all(), Count("pk")),
+        dataset_size=_file_aggregate(DataFile.objects.all(), Sum("size")),
+        verified_datafiles_count=_file_aggregate(verified_datafiles, Count("pk")),
+        verified_datafiles_size=_file_aggregate(verified_datafiles, Sum("size")),
+    )
+
+
+def get_facility_datasets(facility_id, start_index, end_index):
+    """
+    Returns the datasets of a facility in the given index range, newest first,
+    with their aggregates, parent experiment, owners and groups.  Datasets
+    which aren't in any experiment aren't listed.
+
+    :param int facility_id: id of the Facility
+    :param int start_index: index of the first dataset
+    :param int end_index: index after the last dataset
+    :rtype: list
+    """
+    return _cached(
+        facility_id,
+        ("datasets", start_index, end_index),
+        lambda: _facility_datasets(facility_id, start_index, end_index),
+    )
+
+
+def _facility_datasets(facility_id, start_index, end_index):
+    datasets = list(
+        annotate_dataset_aggregates(
+            Dataset.objects.filter(instrument__facility__id=facility_id)
+        )
+        .select_related("instrument__facility")
+        .prefetch_related(
+            Prefetch(
+                "experiments",
+                queryset=Experiment.objects.only("id", "title", "institution_name"),
+            )
+        )
+        .order_by("-id")[start_index:end_index]
+    )
+    parents = {
+        dataset.id: dataset.experiments.all()[0]
+        for dataset in datasets
+        if dataset.experiments.all()
+    }
+    owners = {}
+    groups = {}
+    for experiment_id, username, group_name in (
+        ExperimentACL.objects.filter(experiment__in=set(parents.values()))
+        .filter(Q(user__isnull=False, isOwner=True) | Q(group__isnull=False))
+        .order_by("id")
+        .values_list("experiment_id", "user__username", "group__name")
+    ):
+        if username is not None:
+            owners.setdefault(experiment_id, []).append(username)
+        else:
+            groups.setdefault(experiment_id, []).append(group_name)
+
+    facility_data = []
+    for dataset in datasets:
+        parent_experiment = parents.get(dataset.id)
+        if parent_experiment is None:
+            logger.warning("Not listing dataset id %s in Facility Overview", dataset.id)
+            continue
+        instrument = dataset.instrument
+        facility = instrument.facility
+        facility_data.append(
+            {
+                "id": dataset.id,
+                "parent_experiment": {
+                    "id": parent_experiment.id,
+                    "title": parent_experiment.title,
+                },
+                "created_time": datetime_to_us(dataset.created_time),
+                "description": dataset.description,
+                "institution": parent_experiment.institution_name,
+                "datafile_count": dataset.datafile_count,
+                "size": dataset.dataset_size,
+                "verified_datafiles_count": dataset.verified_datafiles_count,
+                "verified_datafiles_size": dataset.verified_datafiles_size,
+                "owner": ", ".join(owners.get(parent_experiment.id, [])),
+                "group": ", ".join(groups.get(parent_experiment.id, [])),
+                "instrument": {
+                    "id": instrument.id,
+                    "name": instrument.name,
+                },
+                "facility": {
+                    "id": facility.id,
+                    "name": facility.name,
+                },
+            }
+        )
+    return facility_data
+
+
+def _upload_status(verified, size, stored_size):
+    """
+    Returns the upload status of a file, with the number of bytes uploaded
+    if it is known, i.e. stored_size isn't None
+    """
+    if verified:
+        return "Yes"
+    if stored_size is not None and stored_size < size:
+        return "No (%s of %s bytes uploaded)" % (
+            "{:,}".format(stored_size),
+            "{:,}".format(size),
+        )
+    return "No"
+
+
+def get_dataset_datafiles(dataset):
+    """
+    Returns the files of a dataset with their upload status, from a single
+    query
+
+    :param Dataset dataset: the Dataset
+    :rtype: list
+    """
+    facility_id = dataset.instrument.facility_id if dataset.instrument else None
+    return _cached(
+        facility_id,
+        ("datafiles", dataset.id),
+        lambda: _dataset_datafiles(dataset),
+    )
+
+
+def _dataset_datafiles(dataset):
+    dfos = DataFileObject.objects.filter(datafile=OuterRef("pk"))
+    datafiles = (
+        DataFile.objects.filter(dataset=dataset)
+        .annotate(
+            any_verified=Exists(dfos.filter(verified=True)),
+            stored_size=Subquery(
+                dfos.order_by()
+                .values("datafile")
+                .annotate(stored_size=Max("stored_size"))
+                .values("stored_size")
+            ),
+        )
+        .values(
+            "id",
+            "filename",
+            "size",
+            "created_time",
+            "modification_time",
+            "any_verified",
+            "stored_size",
+        )
+    )
+    return [
+        {
+            "id": datafile["id"],
+            "filename": datafile["filename"],
+            "size": int(datafile["size"]),
+            "created_time": datetime_to_us(datafile["created_time"]),
+            "modification_time": datetime_to_us(datafile["modification_time"]),
+            "verified": _upload_status(
+                datafile["any_verified"],
+                int(datafile["size"]),
+                datafile["stored_size"],
+            ),
+        }
+        for datafile in datafiles
+    ]
@@ -18,6 +18,7 @@ import sys
 
 from django.core.management.base import BaseCommand
 
+from ...auth.acl_resolver import clear_acl_cache
 from ...models import Experiment
 from ...models.access_control import DatafileACL, DatasetACL
 
@@ -88,4 +89,6 @@ class Command(BaseCommand):
                 sys.stderr.write("DataFiles done.\n")
             sys.stderr.write("Datasets done.\n")
 
+        # bulk_create doesn't send the signals which invalidate cached ACLs
+        clear_acl_cache()
         sys.stderr.write("All done.\n")
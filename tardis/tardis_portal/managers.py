@@ -5,13 +5,11 @@ managers.py
 
 """
 
-from datetime import datetime
-
 from django.conf import settings
-from django.contrib.auth.models import Group, User
+from django.contrib.auth.models import AnonymousUser, Group, User
 from django.core.exceptions import PermissionDenied
 from django.db import models
-from django.db.models import Prefetch
+from django.db.models import Exists, OuterRef, Q
 
 
 class OracleSafeManager(models.Manager):
@@ -60,14 +58,13 @@ class SafeManager(models.Manager):
 
     The "get, owned, shared, owned_and_shared, public, all" functions return
     distinct querysets of experiments/datasets/datafiles ready to be used elsewhere
-    in my tardis. They invoke one or more of the underscore functions that build
-    the appropriate Django query.
+    in my tardis, as do "owned_by_user, owned_by_group, owned_by_user_id".
 
-    The underscore functions "_query_owned, _query_owned_by_group, _query_shared,
-    _query_owned_and_shared, _query_all_public" are modular queries that can be
-    combined together using Django query logic, and do not call the distinct()
-    Django function which normally is only called at the end of a chain of queries
-    (such as in the get/owned/shared/owned_and_shared/public/all functions).
+    These resolve the principals (the user, its groups and tokens, or a single
+    user or group) once with an
+    :py:class:`~tardis.tardis_portal.auth.acl_resolver.ACLResolver` and select
+    the accessible objects with a single ``IN`` subquery on the ACL table, in
+    _query_resolved.
 
     The remaining functions are used to return various querysets of
     users/groups/tokens/acls pertaining to a given experiment/dataset/datafile.
@@ -118,11 +115,7 @@ class SafeManager(models.Manager):
         # the user must be authenticated
         if not kwargs["user"].is_authenticated:
             return super().get_queryset().none()
-        query = self._query_owned(**kwargs)
-        user = kwargs.pop("user")
-        for group in user.groups.all():
-            query |= self._query_owned_by_group(group=group, **kwargs)
-        return query.distinct()
+        return self._query_resolved(isOwner=True, **kwargs).distinct()
 
     def shared(self, **kwargs):
         """
@@ -132,7 +125,7 @@ class SafeManager(models.Manager):
         :returns: QuerySet of proj/exp/set/files shared with user
         :rtype: QuerySet
         """
-        return self._query_shared(**kwargs).distinct()
+        return self._query_resolved(isOwner=False, **kwargs).distinct()
 
     def owned_and_shared(self, **kwargs):
         """
@@ -143,7 +136,7 @@ class SafeManager(models.Manager):
         :returns: QuerySet of proj/exp/set/files owned by or shared with a user
         :rtype: QuerySet
         """
-        return self._query_owned_and_shared(**kwargs).distinct()
+        return self._query_resolved(**kwargs).distinct()
 
     def public(self, **kwargs):
         """
@@ -152,7 +145,9 @@ class SafeManager(models.Manager):
         :returns: QuerySet of proj/exp/set/files that are publicly available
         :rtype: QuerySet
         """
-        return self._query_all_public(**kwargs).distinct()
+        return self._query_resolved(
+            include_principals=False, include_public=True, **kwargs
+        ).distinct()
 
     def all(self, **kwargs):  # @ReservedAssignment
         """
@@ -162,219 +157,129 @@ class SafeManager(models.Manager):
         :returns: QuerySet of all proj/exp/set/files accessible to the user
         :rtype: QuerySet
         """
-        query = self._query_all_public(**kwargs) | self._query_owned_and_shared(
-            **kwargs
-        )
-        return query.distinct()
-
-    def _query_on_acls(self, **kwargs):
-        """
-        Performs underlying DB query on objects based upon User/group ACLs
-        :param dict kwargs:
-        :returns: QuerySet as specified by above parent functions
+        return self._query_resolved(include_public=True, **kwargs).distinct()
+
+    def _query_resolved(
+        self,
+        user=None,
+        isOwner=None,
+        include_principals=True,
+        include_public=False,
+        resolver=None,
+        **kwargs
+    ):
+        """
+        Returns all proj/exp/set/files with ACLs for the user's principals,
+        resolved with a single query on the ACL table.  If
+        DATAFILE_ACL_INHERITANCE is set, datafiles without ACLs of their own
+        are selected by the non-public ACLs of their dataset.
+        :param User user: a User instance, AnonymousUser if None
+        :param bool isOwner: only owner ACLs if True, only non-owner ACLs if
+            False, all ACLs if None
+        :param bool include_principals: include ACLs of the user, its groups
+            and tokens
+        :param bool include_public: include ACLs of the PUBLIC_USER
+        :param ACLResolver resolver: resolves the principals instead of the
+            user's resolver
+        :param dict kwargs: may contain ACL flags, e.g. canDownload=True
+        :returns: QuerySet of proj/exp/set/files
         :rtype: QuerySet
         """
+        from .auth.acl_resolver import (
+            ACLResolver,
+            datafile_acls_inherited,
+            overriding_datafile_acls,
+        )
 
-        filter_dict = {}
-        exclude_dict = {}
-        OBJECT = None
-        OBJECTACL = None
-        acl_str = ""
-        if self.model.get_ct(self.model).model == "project":
-            from tardis.apps.projects.models import Project, ProjectACL
-
-            OBJECT = Project
-            OBJECTACL = ProjectACL
-            acl_str = "projectacl"
-        if self.model.get_ct(self.model).model == "experiment":
-            from .models import Experiment, ExperimentACL
-
-            OBJECT = Experiment
-            OBJECTACL = ExperimentACL
-            acl_str = "experimentacl"
-        if self.model.get_ct(self.model).model == "dataset":
-            from .models import Dataset, DatasetACL
-
-            OBJECT = Dataset
-            OBJECTACL = DatasetACL
-            acl_str = "datasetacl"
-        if self.model.get_ct(self.model).model == "datafile":
-            from .models import DataFile, DatafileACL
-
-            OBJECT = DataFile
-            OBJECTACL = DatafileACL
-            acl_str = "datafileacl"
-
+        perms = {
+            perm: kwargs[perm]
+            for perm in ["canDownload", "canWrite", "canDelete", "canSensitive"]
+            if perm in kwargs
+        }
+        if resolver is None:
+            resolver = ACLResolver.for_user(user or AnonymousUser())
+        acl_kwargs = {
+            "isOwner": isOwner,
+            "perms": perms,
+            "include_principals": include_principals,
+            "include_public": include_public,
+        }
+        query = Q(id__in=resolver.object_ids(self.model._meta.model_name, **acl_kwargs))
         if (
-            not any(key in ["user", "group", "token", "isOwner"] for key in kwargs)
-            and OBJECT
+            self.model._meta.model_name == "datafile"
+            and datafile_acls_inherited()
+            and include_principals
         ):
-            return OBJECT.objects.none()
-        related = ""
-        if "user" in kwargs:
-            related = "user"
-            filter_dict[acl_str + "__user"] = kwargs["user"]
-        elif "group" in kwargs:
-            related = "group"
-            filter_dict[acl_str + "__group"] = kwargs["group"]
-        elif "token" in kwargs:
-            related = "token"
-            filter_dict[acl_str + "__token"] = kwargs["token"]
-
-        for perm in ["canDownload", "canWrite", "canDelete", "canSensitive"]:
-            if perm in kwargs:
-                filter_dict[acl_str + "__" + perm] = kwargs[perm]
-
-        if "isOwner" in kwargs:
-            filter_dict[acl_str + "__isOwner"] = True
-        else:
-            filter_dict[acl_str + "__isOwner"] = False
-
-        exclude_dict[acl_str + "__effectiveDate__gte"] = datetime.today()
-        exclude_dict[acl_str + "__expiryDate__lte"] = datetime.today()
-
-        query = None
-        if OBJECT:
-            query = (
-                OBJECT.objects.prefetch_related(
-                    Prefetch(
-                        acl_str + "_set",
-                        queryset=OBJECTACL.objects.select_related(related),
-                    )
-                )
-                .filter(**filter_dict)
-                .exclude(**exclude_dict)
-            )
-        return query
+            # files without ACLs of their own have those of their dataset,
+            # but public access always follows the file's own public_access
+            acl_kwargs["include_public"] = False
+            query |= Q(
+                dataset_id__in=resolver.object_ids("dataset", **acl_kwargs)
+            ) & ~Exists(overriding_datafile_acls().filter(datafile=OuterRef("pk")))
+        return self.get_queryset().filter(query)
 
-    def _query_owned(self, **kwargs):
+    def owned_by_user(self, **kwargs):
         """
-        Return all experiments/datasets/datafiles that are owned by a user.
+        Return all proj/exp/set/files which are owned by a particular user,
+        not including those owned by the user's groups
         :param dict kwargs:
         In kwargs: param User user: a User instance
         In kwargs: param int user_id: an ID coresponding to a user
-        :returns: QuerySet of all proj/exp/set/files owned by the user
+        :return: QuerySet of proj/exp/set/files owned by user
         :rtype: QuerySet
         """
-        if kwargs.get("user_id") is not None:
-            user = User.objects.get(pk=kwargs["user_id"])
-            kwargs.pop("user_id")
-        else:
-            user = kwargs.get("user")
+        user = kwargs.pop("user", None)
+        user_id = kwargs.pop("user_id", None)
+        if user_id is not None:
+            user = User.objects.get(pk=user_id)
         if user.id is None:
             return super().get_queryset().none()
-        if kwargs.get("user"):
-            kwargs.pop("user")
-        query = self._query_on_acls(isOwner=True, user=user, **kwargs)
-        return query
+        return self._query_owned_by_principal(user=user, **kwargs)
 
-    def _query_owned_by_group(self, **kwargs):
+    def owned_by_group(self, **kwargs):
         """
-        Return all experiments/datasets/datafiles that are owned by a group.
+        Return all proj/exp/set/files which are owned by a particular group
         :param dict kwargs:
-        In kwargs: param Group user: a Group instance
+        In kwargs: param Group group: a Group instance
         In kwargs: param int group_id: an ID coresponding to a group
-        :returns: QuerySet of all proj/exp/set/files owned by the group
+        :return: QuerySet of proj/exp/set/files owned by group
         :rtype: QuerySet
         """
-        if kwargs.get("group_id") is not None:
-            group = Group.objects.get(pk=kwargs["group_id"])
-            kwargs.pop("group_id")
-        else:
-            group = kwargs.get("group")
+        group = kwargs.pop("group", None)
+        group_id = kwargs.pop("group_id", None)
+        if group_id is not None:
+            group = Group.objects.get(pk=group_id)
         if group.id is None:
             return super().get_queryset().none()
-        query = self._query_on_acls(isOwner=True, **kwargs)
-        return query
-
-    def _query_shared(self, **kwargs):
-        """
-        Return all projects/experiments/datasets/datafiles that are shared with a user.
-        :param dict kwargs: In kwargs: param User user: a User instance
-        :returns: QuerySet of all proj/exp/set/files shared with the user
-        :rtype: QuerySet
-        """
-        # if the user is not authenticated, only tokens apply
-        # this is almost duplicate code of end of has_perm in authorisation.py
-        # should be refactored, but cannot think of good way atm
-        if not kwargs["user"].is_authenticated:
-            from .auth.token_auth import TokenGroupProvider
-
-            user = kwargs.pop("user")
-            query = self._query_on_acls(**kwargs)
-            tgp = TokenGroupProvider()
-            for token in tgp.getGroups(user):
-                query |= self._query_on_acls(token=token, **kwargs)
-            return query
-        # for which proj/exp/set/files does the user have read access
-        # based on USER permissions?
-        query = self._query_on_acls(**kwargs)
-        user = kwargs.pop("user")
-        # for which does proj/exp/set/files does the user have read access
-        # based on GROUP permissions
-        for group in user.groups.all():
-            query |= self._query_on_acls(group=group, **kwargs)
-        return query
-
-    def _query_owned_and_shared(self, **kwargs):
-        """
-        Return all projects/experiments/datasets/datafiles that are owned and shared with a user (inc. group access).
-        :param dict kwargs: In kwargs: param User user: a User instance
-        :returns: QuerySet of all proj/exp/set/files owned by or shared with the user (inc. group access)
-        :rtype: QuerySet
-        """
-        query = self._query_shared(**kwargs) | self._query_owned(**kwargs)
-        user = kwargs.pop("user")
-        for group in user.groups.all():
-            query |= self._query_owned_by_group(group=group, **kwargs)
-        return query
+        return self._query_owned_by_principal(group=group, **kwargs)
 
-    def _query_all_public(self, **kwargs):
-        """
-        Return all projects/experiments/datasets/datafiles that publicly accessible.
-        :param dict kwargs:
-        :returns: QuerySet of all proj/exp/set/files that are publicly accessible
-        :rtype: QuerySet
-        """
-        # Querying directly on the Proj/Exp/Set/File tables for public_flags scales
-        # horribly with table size, so query via a PUBLIC_USER who has a read_only
-        # ACL with all public objects.
-        if kwargs.get("user"):
-            kwargs.pop("user")
-        PUBLIC_USER = User.objects.get(pk=settings.PUBLIC_USER_ID)
-        return self._query_on_acls(user=PUBLIC_USER, **kwargs)
-
-    def owned_by_user(self, **kwargs):
+    def owned_by_user_id(self, **kwargs):
         """
         Return all proj/exp/set/files which are owned by a particular user id
-        :param dict kwargs: In kwargs: param User user: a User instance
-        :return: QuerySet of proj/exp/set/files owned by user
+        :param dict kwargs: In kwargs: param int user_id: an ID coresponding
+        to a user
+        :returns: QuerySet of proj/exp/set/files owned by user id
         :rtype: QuerySet
         """
-        query = self._query_owned(**kwargs)
-        return query
+        kwargs.pop("user", None)
+        return self.owned_by_user(**kwargs)
 
-    def owned_by_group(self, **kwargs):
+    def _query_owned_by_principal(self, user=None, group=None, **kwargs):
         """
-        Return all proj/exp/set/files which are owned by a particular group
-        :param dict kwargs: In kwargs: param Group user: a Group instance
-        :return: QuerySet of proj/exp/set/files owned by group
+        Returns all proj/exp/set/files with owner ACLs for a single user or
+        group, resolved like those of :py:meth:`_query_resolved`
+        :param User user: a User instance
+        :param Group group: a Group instance
+        :param dict kwargs: may contain ACL flags, e.g. canDownload=True
+        :returns: QuerySet of proj/exp/set/files
         :rtype: QuerySet
         """
-        query = self._query_owned_by_group(**kwargs)
-        return query
+        from .auth.acl_resolver import ACLResolver
 
-    def owned_by_user_id(self, **kwargs):
-        """
-        Return all proj/exp/set/files which are owned by a particular user id
-        :param dict kwargs:
-        :returns: QuerySet of proj/exp/set/files owned by user id
-        :rtype: QuerySet
-        """
-        if kwargs.get("user"):
-            kwargs.pop("user")
-        query = self._query_owned(**kwargs)
-        return query
+        resolver = ACLResolver.for_principal(user=user, group=group)
+        return self._query_resolved(
+            resolver=resolver, isOwner=True, **kwargs
+        ).distinct()
 
     def user_acls(self, obj_id):
         """
@@ -0,0 +1,97 @@
+# Generated by Django 4.2.10 on 2026-10-18 03:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_directory_index(apps, schema_editor):
+    """
+    Indexes the directories of existing DataFiles
+    """
+    DataFile = apps.get_model("tardis_portal", "DataFile")
+    DatasetDirectory = apps.get_model("tardis_portal", "DatasetDirectory")
+    rows = (
+        DataFile.objects.exclude(directory__isnull=True)
+        .exclude(directory="")
+        .order_by("dataset_id")
+        .values_list("dataset_id", "directory")
+        .annotate(file_count=Count("id"), total_size=Sum("size"))
+    )
+    dataset_id = None
+    stats = {}
+
+    def save_dataset_directories():
+        directories = {}
+        for path in sorted(stats, key=lambda p: p.count("/")):
+            parent_path, dummy_sep, name = path.rpartition("/")
+            directories[path] = DatasetDirectory.objects.create(
+                dataset_id=dataset_id,
+                path=path,
+                name=name,
+                parent=directories.get(parent_path),
+                file_count=stats[path][0],
+                total_size=stats[path][1],
+            )
+
+    for row_dataset_id, directory, file_count, total_size in rows.iterator():
+        if row_dataset_id != dataset_id:
+            save_dataset_directories()
+            dataset_id = row_dataset_id
+            stats = {}
+        components = [component for component in directory.split("/") if component]
+        for i in range(len(components)):
+            path = "/".join(components[: i + 1])
+            count, size = stats.get(path, (0, 0))
+            stats[path] = (count + file_count, size + (total_size or 0))
+    save_dataset_directories()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tardis_portal", "0026_alter_experiment_institution_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DatasetDirectory",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=255)),
+                ("name", models.CharField(max_length=255)),
+                ("file_count", models.BigIntegerField(default=0)),
+                ("total_size", models.BigIntegerField(default=0)),
+                (
+                    "dataset",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="directories",
+                        to="tardis_portal.dataset",
+                    ),
+                ),
+                (
+                    "parent",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="subdirectories",
+                        to="tardis_portal.datasetdirectory",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["name"],
+                "unique_together": {("dataset", "path")},
+            },
+        ),
+        migrations.RunPython(build_directory_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.10 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tardis_portal", "0027_datasetdirectory"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datafileobject",
+            name="fingerprint",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="datafileobject",
+            name="last_checksummed_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
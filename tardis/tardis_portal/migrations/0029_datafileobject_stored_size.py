@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tardis_portal", "0028_datafileobject_fingerprint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datafileobject",
+            name="stored_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
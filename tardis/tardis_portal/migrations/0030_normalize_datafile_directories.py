@@ -0,0 +1,39 @@
+from django.db import migrations
+from django.db.models import Q
+
+
+def normalize_directories(apps, schema_editor):
+    """
+    Strips leading, trailing and repeated slashes from DataFile directories,
+    which the directory index and directory listings expect.  Files whose
+    normalized directory would clash with another version of the file are
+    left as they are.
+    """
+    DataFile = apps.get_model("tardis_portal", "DataFile")
+    rows = DataFile.objects.filter(
+        Q(directory__startswith="/")
+        | Q(directory__endswith="/")
+        | Q(directory__contains="//")
+    ).values_list("id", "dataset_id", "directory", "filename", "version")
+    for df_id, dataset_id, directory, filename, version in rows.iterator():
+        normalized = "/".join(
+            component for component in directory.split("/") if component
+        )
+        if DataFile.objects.filter(
+            dataset_id=dataset_id,
+            directory=normalized,
+            filename=filename,
+            version=version,
+        ).exists():
+            continue
+        DataFile.objects.filter(id=df_id).update(directory=normalized)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tardis_portal", "0029_datafileobject_stored_size"),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_directories, migrations.RunPython.noop),
+    ]
@@ -53,7 +53,7 @@ from .access_control import (
     UserProfile,
 )
 from .datafile import DataFile, DataFileObject
-from .dataset import Dataset
+from .dataset import Dataset, DatasetDirectory
 from .experiment import Experiment, ExperimentAuthor
 from .facility import Facility
 from .instrument import Instrument
@@ -4,7 +4,7 @@ from django.conf import settings
 from django.contrib.auth.models import Group, Permission, User
 from django.db import models
 from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils.functional import lazy
 
@@ -441,10 +441,42 @@ def public_acls(instance, **kwargs):
                 ).delete()
 
 
+def invalidate_cached_acls(sender, instance, **kwargs):
+    # Post save/delete function to drop the cached ACLs of the ACL's principal
+    from ..auth.acl_resolver import invalidate_acl_cache
+
+    invalidate_acl_cache(
+        sender._meta.model_name[: -len("acl")],
+        user_ids=[instance.user_id] if instance.user_id else [],
+        group_ids=[instance.group_id] if instance.group_id else [],
+        token_ids=[instance.token_id] if instance.token_id else [],
+    )
+
+
+def invalidate_cached_groups(instance, action, reverse, pk_set, **kwargs):
+    # m2m_changed function to drop the cached group memberships of users
+    from ..auth.acl_resolver import invalidate_acl_cache
+
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        user_ids = [instance.id]
+    elif action == "pre_clear":
+        user_ids = list(instance.user_set.values_list("id", flat=True))
+    else:
+        user_ids = pk_set
+    invalidate_acl_cache(user_ids=user_ids)
+
+
 post_save.connect(delete_if_all_false, sender=ExperimentACL)
 post_save.connect(delete_if_all_false, sender=DatasetACL)
 post_save.connect(delete_if_all_false, sender=DatafileACL)
 
+for acl_model in (ExperimentACL, DatasetACL, DatafileACL):
+    post_save.connect(invalidate_cached_acls, sender=acl_model)
+    post_delete.connect(invalidate_cached_acls, sender=acl_model)
+m2m_changed.connect(invalidate_cached_groups, sender=User.groups.through)
+
 post_save.connect(public_acls, sender=Experiment)
 post_save.connect(public_acls, sender=Dataset)
 post_save.connect(public_acls, sender=DataFile)
@@ -1,10 +1,9 @@
 # pylint: disable=too-many-lines
-import hashlib
 import logging
 import mimetypes
 import re
 from contextlib import contextmanager
-from os import path
+from os import path, stat
 from tempfile import NamedTemporaryFile
 from urllib.parse import quote
 
@@ -12,10 +11,11 @@ from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.files import File
 from django.core.files.storage import get_storage_class
-from django.db import models, transaction
+from django.db import models, router, transaction
 from django.db.models import Q, Sum
-from django.db.models.signals import pre_delete
-from django.dispatch import receiver
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
 from django.forms.models import model_to_dict
 from django.urls import reverse
 from django.utils import timezone
@@ -26,12 +26,32 @@ import magic
 from uritemplate import URITemplate
 
 from .. import tasks
+from ..checksums import ChecksumEngine
 from ..managers import OracleSafeManager, SafeManager
-from .dataset import Dataset
+from .dataset import Dataset, DatasetDirectory, normalize_directory
 from .storage import StorageBox, StorageBoxAttribute, StorageBoxOption
 
 logger = logging.getLogger(__name__)
 
+dfos_verified = Signal()
+"""
+Sent with the DataFileObjects whose verified flag was changed by
+:py:meth:`DataFileObject.save_verifications`, which doesn't send post_save
+signals for them
+"""
+
+datafiles_created = Signal()
+"""
+Sent with the DataFiles inserted by :py:meth:`DataFile.bulk_register`, which
+doesn't send post_save signals for them
+"""
+
+datafiles_deleted = Signal()
+"""
+Sent with the DataFiles about to be deleted by :py:meth:`DataFile.bulk_delete`,
+whose post_delete receivers skip them
+"""
+
 IMAGE_FILTER = (Q(mimetype__startswith="image/") & ~Q(mimetype="image/x-icon")) | (
     Q(datafileparameterset__datafileparameter__name__units__startswith="image")
 )  # noqa
@@ -141,8 +161,8 @@ class DataFile(models.Model):
         At this stage it checks it returns true for no file objects, because
         those files are offline through other checks
         """
-        dfos = self.file_objects.filter(verified=True)
-        if dfos.count() == 0:
+        dfos = self._verified_file_objects()
+        if not dfos:
             return True
         for dfo in dfos:
             if (
@@ -159,6 +179,18 @@ class DataFile(models.Model):
                     return True
         return False
 
+    def _verified_file_objects(self):
+        """
+        Returns the verified DataFileObjects with their storage boxes, from
+        the file_objects prefetched with prefetch_related if available, so
+        that listings of many files don't query them file by file
+        """
+        if "file_objects" in getattr(self, "_prefetched_objects_cache", {}):
+            return [dfo for dfo in self.file_objects.all() if dfo.verified]
+        return list(
+            self.file_objects.filter(verified=True).select_related("storage_box")
+        )
+
     @classmethod
     def public_access_implies_distribution(cls, public_access_level):
         """
@@ -240,10 +272,32 @@ class DataFile(models.Model):
 
     # pylint: disable=W0222
     def save(self, *args, **kwargs):
+        self.prepare_save(require_checksums=kwargs.pop("require_checksums", True))
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the stored location of the file in the directory index, so saving
+        # the file doesn't have to query it
+        if not {"dataset_id", "directory", "size"} - set(instance.__dict__):
+            instance._indexed_directory = (  # pylint: disable=W0212
+                instance.dataset_id,
+                instance.directory,
+                instance.size,
+            )
+        return instance
+
+    def prepare_save(self, require_checksums=True):
+        """
+        Validates the checksums and size of a DataFile which is about to be
+        saved, normalizes its directory, and guesses its mimetype if it isn't
+        set
+        """
         if self.size is not None:
             self.size = int(self.size)
+        self.directory = normalize_directory(self.directory)
 
-        require_checksums = kwargs.pop("require_checksums", True)
         if (
             settings.REQUIRE_DATAFILE_CHECKSUMS
             and not self.md5sum
@@ -256,7 +310,90 @@ class DataFile(models.Model):
                 raise Exception("Invalid Datafile size (must be >= 0): %d" % self.size)
         self.update_mimetype(save=False)
 
-        super().save(*args, **kwargs)
+    @classmethod
+    def bulk_register(cls, datafiles, batch_size=None):
+        """
+        Inserts new DataFiles with bulk inserts.  No post_save signals are
+        sent for them: the directory index is updated once per directory, and
+        datafiles_created is sent with all of them.
+
+        The DataFiles must have been prepared with :py:meth:`prepare_save`.
+
+        :param list datafiles: the unsaved DataFiles
+        :param int batch_size: rows per insert, DATAFILE_BULK_BATCH_SIZE by
+            default
+        :returns: the DataFiles, with their ids
+        :rtype: list
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, "DATAFILE_BULK_BATCH_SIZE", 1000)
+        datafiles = cls.objects.bulk_create(datafiles, batch_size=batch_size)
+        if any(datafile.pk is None for datafile in datafiles):
+            # the database can't return the ids of inserted rows
+            cls._fetch_ids(datafiles)
+
+        cls._index_directories(datafiles)
+        datafiles_created.send(sender=cls, datafiles=datafiles)
+        return datafiles
+
+    @classmethod
+    def bulk_delete(cls, datafiles):
+        """
+        Deletes DataFiles together.  Their post_delete receivers skip them:
+        the directory index is updated once per directory, and
+        datafiles_deleted is sent with all of them.
+
+        :param list datafiles: the DataFiles
+        :returns: the number of deleted DataFiles
+        :rtype: int
+        """
+        datafiles = list(datafiles)
+        if not datafiles:
+            return 0
+        for datafile in datafiles:
+            datafile._bulk_deleted = True  # pylint: disable=W0212
+        collector = Collector(using=router.db_for_write(cls))
+        collector.collect(datafiles)
+        with transaction.atomic(using=collector.using):
+            cls._index_directories(datafiles, removed=True)
+            # sent before the delete, which clears the DataFiles' ids
+            datafiles_deleted.send(sender=cls, datafiles=datafiles)
+            deleted = collector.delete()[1]
+        return deleted.get(cls._meta.label, 0)
+
+    @staticmethod
+    def _index_directories(datafiles, removed=False):
+        directories = {}
+        for datafile in datafiles:
+            totals = directories.setdefault(
+                (datafile.dataset_id, datafile.directory), [0, 0]
+            )
+            totals[0] += 1
+            totals[1] += datafile.size or 0
+        sign = -1 if removed else 1
+        for (dataset_id, directory), (file_count, total_size) in directories.items():
+            DatasetDirectory.add_files(
+                dataset_id, directory, sign * file_count, sign * total_size
+            )
+
+    @classmethod
+    def _fetch_ids(cls, datafiles):
+        by_dataset = {}
+        for datafile in datafiles:
+            by_dataset.setdefault(datafile.dataset_id, []).append(datafile)
+        for dataset_id, dataset_files in by_dataset.items():
+            ids = {
+                tuple(row[1:]): row[0]
+                for row in cls.objects.filter(
+                    dataset_id=dataset_id,
+                    filename__in={datafile.filename for datafile in dataset_files},
+                ).values_list("id", "directory", "filename", "version")
+            }
+            for datafile in dataset_files:
+                datafile.pk = ids[
+                    (datafile.directory, datafile.filename, datafile.version)
+                ]
+                datafile._state.adding = False  # pylint: disable=W0212
 
     def get_size(self):
         return self.size
@@ -317,9 +454,7 @@ class DataFile(models.Model):
 
         from tardis.apps.hsm.storage import HsmFileSystemStorage
 
-        dfos = self.file_objects.filter(verified=True)
-
-        for dfo in dfos:
+        for dfo in self._verified_file_objects():
             storage_class_name = dfo.storage_box.django_storage_class
             if issubclass(get_storage_class(storage_class_name), HsmFileSystemStorage):
                 recall_uri_templates = getattr(settings, "RECALL_URI_TEMPLATES", {})
@@ -563,6 +698,15 @@ class DataFileObject(models.Model):
         with filename ``file1.txt`` which belongs to
         a :class:`~tardis.tardis_portal.models.dataset.Dataset`
         with a description of ``dataset1`` and an ID of ``12345``.
+    :attribute fingerprint: The size, modification time and inode or ETag of
+        the stored file when it was last verified, which change whenever the
+        file is modified.
+    :attribute last_checksummed_time: When the checksums of the stored file
+        were last computed, rather than verified from its fingerprint.
+    :attribute stored_size: The number of bytes stored when the file was
+        written or last checked, which shows the progress of uploads
+        without opening the file.  It is 0 for new staging locations, and
+        None if it isn't known.
     """
 
     datafile = models.ForeignKey(
@@ -575,9 +719,20 @@ class DataFileObject(models.Model):
     created_time = models.DateTimeField(auto_now_add=True)
     verified = models.BooleanField(default=False)
     last_verified_time = models.DateTimeField(blank=True, null=True)
+    fingerprint = models.CharField(max_length=255, blank=True, null=True)
+    last_checksummed_time = models.DateTimeField(blank=True, null=True)
+    stored_size = models.BigIntegerField(blank=True, null=True)
 
     _initial_values = None
 
+    VERIFICATION_FIELDS = [
+        "verified",
+        "last_verified_time",
+        "fingerprint",
+        "last_checksummed_time",
+        "stored_size",
+    ]
+
     class Meta:
         app_label = "tardis_portal"
         unique_together = ["datafile", "storage_box"]
@@ -606,7 +761,7 @@ class DataFileObject(models.Model):
             fields=[
                 field.name
                 for field in self._meta.fields
-                if field.name not in ["verified", "last_verified_time"]
+                if field.name not in self.VERIFICATION_FIELDS
             ],
         )
 
@@ -728,6 +883,7 @@ class DataFileObject(models.Model):
             self.uri or self.create_set_uri(), file_object
         )  # TODO: define behaviour
         # when overwriting existing files
+        self.stored_size = File(file_object).size
         file_object.close()
         self.verified = False
         self.save()
@@ -830,7 +986,75 @@ class DataFileObject(models.Model):
 
         return compute_checksums(self.file_object, compute_md5, compute_sha512)
 
-    def verify(self, add_checksums=True, add_size=True):  # too complex # noqa
+    def get_fingerprint(self):
+        """Returns a fingerprint of the stored file, which changes whenever
+        the file is modified, without reading it.
+
+        A custom method can be provided for a storage class in
+        STORAGE_FINGERPRINT_METHODS, otherwise the size, modification time
+        and inode of local files are used, or the size and modification time
+        reported by other storage classes.
+
+        :return: the fingerprint, None if the storage can't provide one
+        :rtype: str
+        """
+        from importlib import import_module
+
+        fingerprint_methods = getattr(settings, "STORAGE_FINGERPRINT_METHODS", {})
+        storage_class_name = self.storage_box.django_storage_class
+        if storage_class_name in fingerprint_methods:
+            module_path, method_name = fingerprint_methods[storage_class_name].rsplit(
+                ".", 1
+            )
+            return getattr(import_module(module_path), method_name)(self)
+
+        name = self.uri or self._create_uri()
+        try:
+            file_stat = stat(self._storage.path(name))
+            return "%d:%d:%d" % (
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+                file_stat.st_ino,
+            )
+        except NotImplementedError:
+            pass
+        try:
+            return "%d:%s" % (
+                self._storage.size(name),
+                self._storage.get_modified_time(name).isoformat(),
+            )
+        except NotImplementedError:
+            return None
+
+    def check(
+        self, add_checksums=True, add_size=True, use_fingerprint=False
+    ):  # too complex # noqa
+        """
+        Compares the size and checksums of the stored file with those
+        recorded for the DataFile, without saving anything.
+
+        The fingerprint and last_checksummed_time are updated, but not saved.
+
+        :param bool add_checksums: fill in checksums missing from the DataFile
+        :param bool add_size: fill in the size if missing from the DataFile
+        :param bool use_fingerprint: if the DataFileObject is verified, and its
+            fingerprint hasn't changed since its checksums were computed less
+            than VERIFY_AUDIT_INTERVAL ago, it verifies without reading the file
+        :return: whether the file verified, and the values to set on the
+            DataFile if it did
+        :rtype: tuple
+        """
+        try:
+            fingerprint = self.get_fingerprint()
+        except IOError:
+            fingerprint = None
+        if use_fingerprint and self._fingerprint_verifies(fingerprint):
+            return True, {}
+        # the fingerprint is taken before the file is read, so that changes
+        # made while it's being read are noticed next time
+        self.fingerprint = fingerprint
+        self.last_checksummed_time = timezone.now()
+
         compute_md5 = getattr(settings, "COMPUTE_MD5", True)
         compute_sha512 = getattr(settings, "COMPUTE_SHA512", False)
         comparisons = ["size"]
@@ -852,6 +1076,7 @@ class DataFileObject(models.Model):
         actual = {}
         try:
             actual["size"] = self.file_object.size
+            self.stored_size = actual["size"]
             if not empty_value["size"] and actual["size"] == database["size"]:
                 same_values["size"] = True
             elif empty_value["size"]:
@@ -883,12 +1108,7 @@ class DataFileObject(models.Model):
             io_error_str = str(ioe)
 
         result = all(same_value for same_value in same_values.values())
-        if result:
-            if database_update:
-                for key, val in database_update.items():
-                    setattr(df, key, val)
-                df.save()
-        else:
+        if not result:
             reasons = []
             if io_error:
                 reasons = [io_error_str]
@@ -903,15 +1123,107 @@ class DataFileObject(models.Model):
                 "DataFileObject with id %d did not verify. "
                 "Reasons: %s" % (self.id, " ".join(reasons))
             )
+        return result, database_update if result else {}
+
+    def _fingerprint_verifies(self, fingerprint):
+        if not (self.verified and fingerprint and self.last_checksummed_time):
+            return False
+        audit_interval = getattr(settings, "VERIFY_AUDIT_INTERVAL", None)
+        if (
+            audit_interval is not None
+            and timezone.now() - self.last_checksummed_time > audit_interval
+        ):
+            return False
+        return fingerprint == self.fingerprint
+
+    def verify(self, add_checksums=True, add_size=True, use_fingerprint=False):
+        result, database_update = self.check(
+            add_checksums, add_size, use_fingerprint=use_fingerprint
+        )
+        df = self.datafile
+        if database_update:
+            for key, val in database_update.items():
+                setattr(df, key, val)
+            df.save()
 
         self.verified = result
         self.last_verified_time = timezone.now()
-        self.save(update_fields=["verified", "last_verified_time"])
+        self.save(update_fields=self.VERIFICATION_FIELDS)
         df.update_mimetype()
         if getattr(settings, "USE_FILTERS", False):
             self.apply_filters()
         return result
 
+    @classmethod
+    def save_verifications(cls, results):
+        """
+        Saves the results of :py:meth:`check` for many DataFileObjects with
+        a bulk update, the equivalent of calling :py:meth:`verify` for each
+
+        :param list results: (DataFileObject, result of check) tuples
+        """
+        now = timezone.now()
+        changed = []
+        for dfo, (result, database_update) in results:
+            if result != dfo.verified:
+                changed.append(dfo)
+            if database_update:
+                for key, val in database_update.items():
+                    setattr(dfo.datafile, key, val)
+                dfo.datafile.save()
+            dfo.verified = result
+            dfo.last_verified_time = now
+        cls.objects.bulk_update(
+            [dfo for dfo, dummy in results],
+            cls.VERIFICATION_FIELDS,
+            batch_size=1000,
+        )
+        if changed:
+            # once the results are committed, so that receivers don't hold
+            # the transaction open
+            transaction.on_commit(lambda: dfos_verified.send(sender=cls, dfos=changed))
+        for dfo, dummy in results:
+            dfo.datafile.update_mimetype()
+            if getattr(settings, "USE_FILTERS", False):
+                dfo.apply_filters()
+
+    @classmethod
+    def bulk_register(cls, dfos, batch_size=None):
+        """
+        Inserts new DataFileObjects with bulk inserts, and queues one batch
+        verification task per storage box once the transaction is committed,
+        rather than one verification task per DataFileObject
+
+        :param list dfos: the unsaved DataFileObjects
+        :param int batch_size: rows per insert, DATAFILE_BULK_BATCH_SIZE by
+            default
+        :returns: the DataFileObjects, with their ids
+        :rtype: list
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, "DATAFILE_BULK_BATCH_SIZE", 1000)
+        dfos = cls.objects.bulk_create(dfos, batch_size=batch_size)
+        boxes = {dfo.storage_box_id: dfo.storage_box for dfo in dfos}
+        since = timezone.now().isoformat()
+
+        def verify():
+            for box in boxes.values():
+                try:
+                    tasks.verify_dfo_batch.apply_async(
+                        args=[box.id, since],
+                        countdown=5,
+                        priority=box.priority,
+                        shadow="verify_dfo_batch location:%s" % box.name,
+                    )
+                except Exception:
+                    logger.exception(
+                        "Failed to submit verification task for storage box %s",
+                        box.name,
+                    )
+
+        transaction.on_commit(verify)
+        return dfos
+
     def apply_filters(self):
         from django.core.files.storage import FileSystemStorage, get_storage_class
 
@@ -959,6 +1271,9 @@ def delete_dfo(sender, instance, **kwargs):
     """
     Deletes the actual file / object, before deleting the database record
     """
+    if getattr(instance, "_data_deleted", False):
+        # already deleted, e.g. by the cleanup_dfos task
+        return
     can_delete = getattr(
         instance.storage_box.attributes.filter(key="can_delete").first(),
         "value",
@@ -981,6 +1296,70 @@ def delete_dfo(sender, instance, **kwargs):
         )
 
 
+@receiver(pre_save, sender=DataFile, dispatch_uid="datafile_directory_pre_save")
+def remember_datafile_directory(
+    sender, instance, raw=False, update_fields=None, **kwargs
+):
+    """
+    Keeps the stored dataset, directory and size of a DataFile which is
+    about to be updated, to move it in the directory index after saving.
+    They are only queried if the DataFile wasn't loaded or saved before.
+    """
+    instance._moved_from = None  # pylint: disable=W0212
+    if update_fields is not None and not set(update_fields) & {
+        "dataset",
+        "directory",
+        "size",
+    }:
+        return
+    if raw or instance.pk is None or instance._state.adding:
+        return
+    indexed = getattr(instance, "_indexed_directory", None)
+    if indexed is None:
+        indexed = (
+            DataFile.objects.filter(pk=instance.pk)
+            .values_list("dataset_id", "directory", "size")
+            .first()
+        )
+    instance._moved_from = indexed  # pylint: disable=W0212
+
+
+@receiver(post_save, sender=DataFile, dispatch_uid="datafile_directory_post_save")
+def index_datafile_directory(sender, instance, created, raw=False, **kwargs):
+    """
+    Adds a new DataFile to the directory index, or moves an updated one
+    """
+    if raw:
+        return
+    new = (instance.dataset_id, instance.directory, instance.size or 0)
+    old = getattr(instance, "_moved_from", None)
+    if created:
+        DatasetDirectory.add_files(new[0], new[1], 1, new[2])
+    elif old is None:
+        return
+    elif (old[0], old[1], old[2] or 0) != new:
+        DatasetDirectory.add_files(old[0], old[1], -1, -(old[2] or 0))
+        DatasetDirectory.add_files(new[0], new[1], 1, new[2])
+    instance._indexed_directory = (  # pylint: disable=W0212
+        instance.dataset_id,
+        instance.directory,
+        instance.size,
+    )
+
+
+@receiver(post_delete, sender=DataFile, dispatch_uid="datafile_directory_delete")
+def unindex_datafile_directory(sender, instance, **kwargs):
+    """
+    Removes a deleted DataFile from the directory index
+    """
+    if getattr(instance, "_bulk_deleted", False):
+        # already removed by DataFile.bulk_delete
+        return
+    DatasetDirectory.add_files(
+        instance.dataset_id, instance.directory, -1, -(instance.size or 0)
+    )
+
+
 def compute_checksums(
     file_object, compute_md5=True, compute_sha512=False, close_file=True
 ):
@@ -996,30 +1375,20 @@ def compute_checksums(
     :return: the checksums as {'md5sum': result, 'sha512sum': result}
     :rtype: dict
     """
-    blocksize = 0
-    results = {}
+    checksums = []
     if compute_md5:
-        md5_hasher = hashlib.new("md5")
-        blocksize = max(md5_hasher.block_size, blocksize)
-        results["md5sum"] = md5_hasher
+        checksums.append("md5sum")
     if compute_sha512:
-        sha512_hasher = hashlib.new("sha512")
-        blocksize = max(sha512_hasher.block_size, blocksize)
-        results["sha512sum"] = sha512_hasher
-    update_fns = {
-        "md5sum": lambda x, y: x.update(y),
-        "sha512sum": lambda x, y: x.update(y),
-    }
-    file_object.seek(0)
-    for chunk in iter(lambda: file_object.read(32 * blocksize), b""):
-        for key, val in results.items():
-            update_fns[key](val, chunk)
+        checksums.append("sha512sum")
+    engine = ChecksumEngine(checksums)
+    engine.update_file(file_object)
     if close_file:
         file_object.close()
     else:
         file_object.seek(0)
-    final_fns = {
-        "md5sum": lambda x: x.hexdigest(),
-        "sha512sum": lambda x: x.hexdigest(),
-    }
-    return {key: final_fns[key](val) for key, val in results.items()}
+    logger.debug(
+        "Checksummed %d bytes at %.1f MB/s",
+        engine.bytes_read,
+        engine.throughput / 1e6,
+    )
+    return engine.hexdigests()
@@ -282,11 +282,22 @@ class Dataset(models.Model):
         >>> ds.get_dir_tuples(user, "test files/subdir3/subdir4")
         [('..', 'test files/subdir3/subdir4')]
         """
-        # from .datafile import DataFile
-
         dir_tuples = []
         if basedir:
             dir_tuples.append(("..", basedir))
+        if settings.ONLY_EXPERIMENT_ACLS:
+            # all of the dataset's files are accessible, so the directory
+            # index can be used
+            subdirs = DatasetDirectory.objects.filter(dataset=self)
+            if basedir:
+                subdirs = subdirs.filter(parent__path=basedir.strip("/"))
+            else:
+                subdirs = subdirs.filter(parent__isnull=True)
+            for dir_name in subdirs.values_list("name", flat=True):
+                dir_path = "/".join([basedir, dir_name]).lstrip("/")
+                dir_tuples.append((dir_name, dir_path))
+            return sorted(dir_tuples, key=lambda x: x[0])
+
         dirs_query = self.get_datafiles(user)
         if basedir:
             dirs_query = dirs_query.filter(directory__startswith="%s/" % basedir)
@@ -306,6 +317,34 @@ class Dataset(models.Model):
 
         return sorted(dir_tuples, key=lambda x: x[0])
 
+    def get_dir_stats(self, user, basedir):
+        """
+        Returns the number and total size of the files in a directory and
+        its subdirectories
+
+        :param User user: the user, whose access to DataFiles is checked if
+            ACLs are not only at the experiment level
+        :param str basedir: the directory's path
+        :returns: (file count, total size)
+        :rtype: tuple
+        """
+        if settings.ONLY_EXPERIMENT_ACLS:
+            stats = (
+                DatasetDirectory.objects.filter(dataset=self, path=basedir.strip("/"))
+                .values_list("file_count", "total_size")
+                .first()
+            )
+            return stats or (0, 0)
+        stats = (
+            self.get_datafiles(user)
+            .filter(
+                models.Q(directory=basedir)
+                | models.Q(directory__startswith="%s/" % basedir)
+            )
+            .aggregate(file_count=models.Count("id"), total_size=models.Sum("size"))
+        )
+        return stats["file_count"], stats["total_size"] or 0
+
     def get_dir_nodes(self, dir_tuples):
         """Return child node's subdirectories in format required for tree view
 
@@ -379,3 +418,94 @@ class Dataset(models.Model):
             child_dict = {"name": dir_name, "path": dir_path, "children": []}
             dir_list.append(child_dict)
         return dir_list
+
+
+def normalize_directory(directory):
+    """
+    Returns a DataFile directory without leading, trailing or repeated
+    slashes, e.g. "a/b" for "/a//b/", or None if directory is None
+    """
+    if directory is None:
+        return None
+    return "/".join(component for component in directory.split("/") if component)
+
+
+def split_directory(directory):
+    """
+    Returns the paths of a DataFile directory and all of its ancestors,
+    e.g. ["a", "a/b", "a/b/c"] for "a/b/c", ignoring empty components
+    """
+    components = [component for component in (directory or "").split("/") if component]
+    return ["/".join(components[: i + 1]) for i in range(len(components))]
+
+
+class DatasetDirectory(models.Model):
+    """A directory of a dataset, with the number and total size of the
+    DataFiles in it and in all of its subdirectories.
+
+    The index is maintained by DataFile signal handlers, so that dataset
+    directory trees can be listed without reading the directories of all of
+    the dataset's files.  A directory is in the index while it contains at
+    least one file.
+
+    :attribute dataset: the dataset the directory belongs to
+    :attribute path: the directory's path, relative to the dataset
+    :attribute name: the last component of the path
+    :attribute parent: the parent directory, None for top-level directories
+    :attribute file_count: number of files in the directory and its
+        subdirectories
+    :attribute total_size: total size of the files in the directory and its
+        subdirectories
+    """
+
+    dataset = models.ForeignKey(
+        Dataset, on_delete=models.CASCADE, related_name="directories"
+    )
+    path = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    parent = models.ForeignKey(
+        "self",
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="subdirectories",
+    )
+    file_count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+
+    class Meta:
+        app_label = "tardis_portal"
+        unique_together = ["dataset", "path"]
+        ordering = ["name"]
+
+    def __str__(self):
+        return "%s: %s" % (self.dataset_id, self.path)
+
+    @classmethod
+    def add_files(cls, dataset_id, directory, file_count, total_size):
+        """
+        Adds file_count files of total_size bytes to a directory and its
+        ancestors, creating any which aren't in the index yet, or removes
+        them if file_count is negative
+        """
+        paths = split_directory(directory)
+        if not paths or not file_count:
+            return
+        directories = cls.objects.filter(dataset_id=dataset_id, path__in=paths)
+        if file_count > 0:
+            existing = {d.path: d for d in directories}
+            parent = None
+            for dir_path in paths:
+                if dir_path not in existing:
+                    existing[dir_path], dummy_created = cls.objects.get_or_create(
+                        dataset_id=dataset_id,
+                        path=dir_path,
+                        defaults={"name": dir_path.split("/")[-1], "parent": parent},
+                    )
+                parent = existing[dir_path]
+        directories.update(
+            file_count=models.F("file_count") + file_count,
+            total_size=models.F("total_size") + total_size,
+        )
+        if file_count < 0:
+            directories.filter(file_count__lte=0).delete()
@@ -76,6 +76,14 @@ class StorageBox(models.Model):
 
     @property
     def storage_type(self):
+        if "attributes" in getattr(self, "_prefetched_objects_cache", {}):
+            # use attributes prefetched for listings of many files
+            for attribute in self.attributes.all():
+                if attribute.key == "type":
+                    return StorageBox.TYPES.get(
+                        attribute.value, StorageBox.TYPE_UNKNOWN
+                    )
+            return StorageBox.TYPE_UNKNOWN
         try:
             storage_type = self.attributes.get(key="type").value
             return StorageBox.TYPES.get(storage_type, StorageBox.TYPE_UNKNOWN)
@@ -109,6 +117,16 @@ class StorageBox(models.Model):
             )
         )
 
+    @property
+    def proxy_download_prefix(self):
+        """
+        Internal URL prefix under which the front-end web server serves the
+        files in this box, for proxied downloads (see PROXY_DOWNLOADS)
+        """
+        return getattr(
+            self.attributes.filter(key="proxy_download_prefix").first(), "value", None
+        )
+
     def get_options_as_dict(self):
         opts_dict = {}
         # using ugly for loop for python 2.6 compatibility
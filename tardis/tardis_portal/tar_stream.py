@@ -0,0 +1,553 @@
+"""
+Streaming tar archives
+
+UncachedTarStream streams DataFiles into a tar archive on the fly, optionally
+gzip-compressed, with the files read ahead and compressed on thread pools,
+and serves byte ranges of uncompressed archives for resumed downloads.
+"""
+import gzip
+import hashlib
+import io
+import logging
+import re
+import tarfile
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tarfile import TarFile
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.dateformat import format as dateformatter
+
+from tardis.analytics.tracker import IteratorTracker
+
+logger = logging.getLogger(__name__)
+
+
+class _PrefetchedFile:
+    """
+    File-like object serving the read-ahead buffer of a DataFile first and
+    then the remainder (if any) from the still open underlying file object
+    """
+
+    def __init__(self, buf, fileobj=None):
+        self.buffer = io.BytesIO(buf)
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        buf = self.buffer.read(size)
+        if self.fileobj is not None and (size < 0 or len(buf) < size):
+            rest = self.fileobj.read(size - len(buf) if size >= 0 else -1)
+            buf = b"".join([buf, rest])
+        return buf
+
+    def close(self):
+        self.buffer.close()
+        if self.fileobj is not None:
+            self.fileobj.close()
+
+
+def _read_ahead(storage, uri, length, size):
+    """
+    Opens a file in a storage backend and reads its first ``length`` bytes.
+    Runs in a DataFilePrefetcher worker thread, so it must not touch the
+    database.
+    """
+    fileobj = storage.open(uri, mode="rb")
+    try:
+        buf = fileobj.read(length) if length else b""
+    except Exception:
+        fileobj.close()
+        raise
+    if len(buf) >= size:
+        fileobj.close()
+        fileobj = None
+    return _PrefetchedFile(buf, fileobj)
+
+
+def _close_prefetched(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class DataFilePrefetcher:
+    """
+    Iterates over readable file objects for a sequence of DataFiles, opening
+    and buffering the next ``max_files`` files on a bounded thread pool while
+    the current one is being consumed.
+
+    DataFileObjects and storage instances are resolved on the iterating
+    thread, so the workers only ever do storage I/O.  At most ``max_bytes``
+    are held in read-ahead buffers; files which don't fit into the remaining
+    budget are only opened ahead and then read as they are consumed.
+    """
+
+    def __init__(self, datafiles, max_files=4, max_bytes=64 * 1024 * 1024):
+        self.datafiles = datafiles
+        self.max_files = max(int(max_files), 1)
+        self.max_bytes = max(int(max_bytes), 0)
+        self._storages = {}
+
+    def _get_storage_and_uri(self, df):
+        dfo = df.get_preferred_dfo()
+        if dfo is None:
+            raise IOError("DataFile %s has no verified DataFileObject" % df.id)
+        storage = self._storages.get(dfo.storage_box_id)
+        if storage is None:
+            storage = dfo.storage_box.get_initialised_storage_instance()
+            self._storages[dfo.storage_box_id] = storage
+        dfo._cached_storage = storage  # pylint: disable=W0212
+        return storage, dfo.uri or dfo._create_uri()  # pylint: disable=W0212
+
+    def __iter__(self):
+        datafiles = iter(self.datafiles)
+        pending = deque()
+        buffered = 0
+        executor = ThreadPoolExecutor(
+            max_workers=self.max_files, thread_name_prefix="tar-prefetch"
+        )
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.max_files:
+                    df = next(datafiles, None)
+                    if df is None:
+                        exhausted = True
+                        break
+                    size = int(df.get_size() or 0)
+                    length = min(size, max(self.max_bytes - buffered, 0))
+                    storage, uri = self._get_storage_and_uri(df)
+                    future = executor.submit(_read_ahead, storage, uri, length, size)
+                    pending.append((future, length))
+                    buffered += length
+                if not pending:
+                    break
+                future, length = pending.popleft()
+                yield future.result()
+                buffered -= length
+        finally:
+            for future, dummy_length in pending:
+                if not future.cancel():
+                    future.add_done_callback(_close_prefetched)
+            executor.shutdown(wait=False)
+
+
+def _gzip_member(buf, comp_level):
+    return gzip.compress(buf, compresslevel=comp_level, mtime=0)
+
+
+class ParallelGzipCompressor:
+    """
+    Block-parallel gzip compressor, similar to pigz.
+
+    Input is cut into blocks of ``block_size`` bytes, which are compressed
+    independently into separate gzip members on a thread pool (zlib releases
+    the GIL while compressing).  A concatenation of gzip members is a valid
+    gzip stream, so the output decompresses as a whole with gunzip, tar -z
+    or any other gzip implementation.
+
+    Data passed with ``compress=False`` is stored in blocks of its own at
+    compression level 0, which is useful for already compressed content.
+    """
+
+    def __init__(self, comp_level=6, block_size=1024 * 1024, workers=4):
+        self.comp_level = comp_level
+        self.block_size = block_size
+        self.workers = max(int(workers), 1)
+        self.executor = None
+        self.pending = deque()
+        self.block = []
+        self.block_len = 0
+        self.block_level = comp_level
+
+    def _submit_block(self):
+        if not self.block_len:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="tar-gzip"
+            )
+        self.pending.append(
+            self.executor.submit(_gzip_member, b"".join(self.block), self.block_level)
+        )
+        self.block = []
+        self.block_len = 0
+
+    def _collect(self, wait=False):
+        """
+        returns compressed members in order, waiting only for as many as
+        needed to keep at most two blocks per worker in flight
+        """
+        results = []
+        while self.pending and (
+            wait or self.pending[0].done() or len(self.pending) > 2 * self.workers
+        ):
+            results.append(self.pending.popleft().result())
+        return b"".join(results)
+
+    def compress(self, buf, compress=True):
+        comp_level = self.comp_level if compress else 0
+        if comp_level != self.block_level:
+            self._submit_block()
+            self.block_level = comp_level
+        while buf:
+            chunk = buf[: self.block_size - self.block_len]
+            buf = buf[len(chunk) :]
+            self.block.append(chunk)
+            self.block_len += len(chunk)
+            if self.block_len >= self.block_size:
+                self._submit_block()
+        return self._collect()
+
+    def flush(self):
+        self._submit_block()
+        result = self._collect(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        return result
+
+
+class UncachedTarStream(TarFile):
+    """
+    Stream files into a compressed tar stream on the fly
+    """
+
+    def __init__(
+        self,
+        mapped_file_objs,
+        filename,
+        do_gzip=False,
+        buffersize=2 * 65536,
+        comp_level=6,
+        http_buffersize=65535,
+        prefetch_files=0,
+        prefetch_max_bytes=64 * 1024 * 1024,
+        gzip_workers=0,
+        gzip_block_size=1024 * 1024,
+        uncompressed_mimetypes=(),
+    ):
+        self.errors = "strict"
+        self.pax_headers = {}
+        self.mode = "w"
+        self.closed = False
+        self.members = []
+        self._loaded = False
+        self.offset = 0
+        self.inodes = {}
+        self._loaded = True
+        self.mapped_file_objs = mapped_file_objs
+        filenum = len(mapped_file_objs)
+        self.tarinfos = [None] * filenum
+        self.tarinfo_bufs = [None] * filenum
+        self.member_offsets = [0] * (filenum + 1)
+        self.filename = filename
+        self.buffersize = buffersize
+        self.http_buffersize = http_buffersize
+        self.prefetch_files = prefetch_files
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.do_gzip = do_gzip
+        self.uncompressed_mimetypes = set(uncompressed_mimetypes)
+        self.gzip_compressor = None
+        if do_gzip and gzip_workers:
+            self.gzip_compressor = ParallelGzipCompressor(
+                comp_level, gzip_block_size, gzip_workers
+            )
+        elif do_gzip:
+            self.binary_buffer = io.BytesIO()
+            self.gzipfile = gzip.GzipFile(filename, "w", comp_level, self.binary_buffer)
+        self.tar_size = self.compute_size()
+
+    def compute_size(self):
+        total_size = 0
+        for num, fobj in enumerate(self.mapped_file_objs):
+            df, name = fobj
+            self.member_offsets[num] = total_size
+            tarinfo = self.tarinfo_for_df(df, name)
+            self.tarinfos[num] = tarinfo
+            tarinfo_buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+            self.tarinfo_bufs[num] = tarinfo_buf
+            total_size += len(tarinfo_buf)
+            size = int(tarinfo.size)
+            blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                blocks += 1
+            total_size += blocks * tarfile.BLOCKSIZE
+        self.member_offsets[-1] = total_size
+        blocks, remainder = divmod(total_size, tarfile.RECORDSIZE)
+        if remainder > 0:
+            blocks += 1
+        total_size = blocks * tarfile.RECORDSIZE
+        return total_size
+
+    def tarinfo_for_df(self, df, name):
+        tarinfo = self.tarinfo(name)
+        tarinfo.size = int(df.get_size())
+        try:
+            dj_mtime = df.modification_time or df.get_preferred_dfo().modified_time
+        except Exception as e:
+            dj_mtime = None
+            logger.debug(
+                "cannot read m_time for file id" " %d, exception %s" % (df.id, str(e))
+            )
+        if dj_mtime is not None:
+            tarinfo.mtime = float(dateformatter(dj_mtime, "U"))
+        else:
+            tarinfo.mtime = time.time()
+        return tarinfo
+
+    def compress_member(self, num):
+        """
+        whether the data of archive member num should be compressed.
+        Only the parallel gzip engine can store members uncompressed.
+        """
+        if self.gzip_compressor is None or not self.uncompressed_mimetypes:
+            return True
+        df, dummy_name = self.mapped_file_objs[num]
+        mimetype = df.get_mimetype().split(";")[0].strip()
+        return mimetype not in self.uncompressed_mimetypes
+
+    def compress(self, buf, compress=True):
+        if self.gzip_compressor is not None:
+            return self.gzip_compressor.compress(buf, compress)
+        self.gzipfile.write(buf)
+        self.gzipfile.flush()
+        self.binary_buffer.seek(0)
+        result = self.binary_buffer.read()
+        self.binary_buffer.seek(0)
+        self.binary_buffer.truncate()
+        return result
+
+    def prepare_output(self, uc_buf, remainder, compress=True):
+        if self.do_gzip:
+            result_buf = self.compress(uc_buf, compress)
+        else:
+            result_buf = uc_buf
+        if remainder is not None:
+            result_buf = b"".join([remainder, result_buf])
+        stream_buffers = []
+        while len(result_buf) >= self.http_buffersize:
+            stream_buffers.append(result_buf[: self.http_buffersize])
+            result_buf = result_buf[self.http_buffersize :]
+        return stream_buffers, result_buf
+
+    def close_gzip(self):
+        if self.gzip_compressor is not None:
+            return self.gzip_compressor.flush()
+        self.gzipfile.close()
+        self.binary_buffer.seek(0)
+        result = self.binary_buffer.read()
+        self.binary_buffer.seek(0)
+        self.binary_buffer.truncate()
+        return result
+
+    def file_objects(self):
+        """
+        file objects of the archive members in order, read ahead on a thread
+        pool if prefetch_files is set
+        """
+        datafiles = [df for df, dummy_name in self.mapped_file_objs]
+        if self.prefetch_files:
+            return iter(
+                DataFilePrefetcher(
+                    datafiles,
+                    max_files=self.prefetch_files,
+                    max_bytes=self.prefetch_max_bytes,
+                )
+            )
+        return (df.file_object for df in datafiles)
+
+    def make_tar(self):  # noqa
+        """
+        main tar generator. until python 3 needs to be in one function
+        because 'yield's don't bubble up.
+        """
+        remainder_buf = None
+        for num, fileobj in enumerate(self.file_objects()):
+            self._check("aw")
+            tarinfo = self.tarinfos[num]
+            buf = self.tarinfo_bufs[num]
+            stream_buffers, remainder_buf = self.prepare_output(buf, remainder_buf)
+            for stream_buf in stream_buffers:
+                yield stream_buf
+            self.offset += len(buf or "")
+            if tarinfo.isreg():
+                if tarinfo.size == 0:
+                    fileobj.close()
+                    continue
+                compress_data = self.compress_member(num)
+                # split into file read buffer sized chunks
+                blocks, remainder = divmod(tarinfo.size, self.buffersize)
+                for dummy_b in range(blocks):
+                    buf = fileobj.read(self.buffersize)
+                    if len(buf) < self.buffersize:
+                        raise IOError("end of file reached")
+                    # send in http_buffersize sized chunks
+                    stream_buffers, remainder_buf = self.prepare_output(
+                        buf, remainder_buf, compress_data
+                    )
+                    for stream_buf in stream_buffers:
+                        yield stream_buf
+                # in case the file has remaining read bytes
+                if remainder != 0:
+                    buf = fileobj.read(remainder)
+                    if len(buf) < remainder:
+                        raise IOError("end of file reached")
+                    # send remaining file data
+                    stream_buffers, remainder_buf = self.prepare_output(
+                        buf, remainder_buf, compress_data
+                    )
+                    for stream_buf in stream_buffers:
+                        yield stream_buf
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder > 0:
+                    buf = tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+                    stream_buffers, remainder_buf = self.prepare_output(
+                        buf, remainder_buf
+                    )
+                    for stream_buf in stream_buffers:
+                        yield stream_buf
+                    blocks += 1
+                self.offset += blocks * tarfile.BLOCKSIZE
+            fileobj.close()
+        # fill up the end with zero-blocks
+        # (like option -b20 for tar does)
+        blocks, remainder = divmod(self.offset, tarfile.RECORDSIZE)
+        if remainder > 0:
+            buf = tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+            stream_buffers, remainder_buf = self.prepare_output(buf, remainder_buf)
+            for stream_buf in stream_buffers:
+                yield stream_buf
+        if remainder_buf:
+            yield remainder_buf
+        if self.do_gzip:
+            yield self.close_gzip()
+
+    def make_tar_range(self, start, end):
+        """
+        generator for the bytes start to end (exclusive) of the uncompressed
+        tar stream. Members before start are skipped using the offset index
+        built by compute_size and the first member's file is read from the
+        required position rather than from the beginning.
+        """
+        first = max(bisect_right(self.member_offsets, start) - 1, 0)
+        for num in range(first, len(self.mapped_file_objs)):
+            offset = self.member_offsets[num]
+            if offset >= end:
+                break
+            df, dummy_name = self.mapped_file_objs[num]
+            tarinfo = self.tarinfos[num]
+            buf = self.tarinfo_bufs[num]
+            data_offset = offset + len(buf)
+            if start < data_offset:
+                yield buf[max(start - offset, 0) : end - offset]
+            data_end = data_offset + tarinfo.size
+            if tarinfo.isreg() and min(data_end, end) > max(data_offset, start):
+                position = max(start - data_offset, 0)
+                remaining = min(data_end, end) - data_offset - position
+                fileobj = df.file_object
+                try:
+                    if position:
+                        fileobj.seek(position)
+                    while remaining > 0:
+                        buf = fileobj.read(min(self.buffersize, remaining))
+                        if not buf:
+                            raise IOError("end of file reached")
+                        remaining -= len(buf)
+                        yield buf
+                finally:
+                    fileobj.close()
+            padding = min(self.member_offsets[num + 1], end) - max(data_end, start)
+            if padding > 0:
+                yield tarfile.NUL * padding
+        # zero-blocks at the end of the archive
+        padding = end - max(self.member_offsets[-1], start)
+        if padding > 0:
+            yield tarfile.NUL * padding
+
+    def get_etag(self):
+        """
+        Entity tag of the uncompressed tar stream, derived from the member
+        headers, i.e. from the names, sizes and modification times of all
+        members
+        """
+        md5 = hashlib.md5(usedforsecurity=False)
+        for buf in self.tarinfo_bufs:
+            md5.update(buf)
+        return '"%s-%d"' % (md5.hexdigest(), self.tar_size)
+
+    def get_response(self, tracker_data=None, range_header=None, if_range=None):
+        """
+        Returns a streaming response for the archive. Uncompressed archives
+        have a deterministic size and layout, so for those a single byte
+        range requested with an HTTP Range header is served as partial
+        content, e.g. to resume an interrupted download.
+        """
+        byte_range = None
+        if self.do_gzip:
+            content_type = "application/x-gzip"
+            content_length = None
+            self.filename += ".gz"
+        else:
+            content_type = "application/x-tar"
+            content_length = self.tar_size
+            etag = self.get_etag()
+            if range_header and (not if_range or if_range == etag):
+                try:
+                    byte_range = parse_range_header(range_header, self.tar_size)
+                except ValueError:
+                    response = HttpResponse(status=416)
+                    response["Content-Range"] = "bytes */%d" % self.tar_size
+                    return response
+        if byte_range is not None:
+            start, end = byte_range
+            file_iterator = IteratorTracker(
+                self.make_tar_range(start, end), tracker_data
+            )
+            response = StreamingHttpResponse(
+                file_iterator, content_type=content_type, status=206
+            )
+            response["Content-Range"] = "bytes %d-%d/%d" % (
+                start,
+                end - 1,
+                self.tar_size,
+            )
+            content_length = end - start
+        else:
+            file_iterator = IteratorTracker(self.make_tar(), tracker_data)
+            response = StreamingHttpResponse(file_iterator, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="%s"' % self.filename
+        response["X-Accel-Buffering"] = "no"
+        if content_length is not None:
+            response["Content-Length"] = content_length
+            response["Accept-Ranges"] = "bytes"
+            response["ETag"] = etag
+        return response
+
+
+def parse_range_header(range_header, size):
+    """
+    Parses an HTTP Range header for a resource of the given size.
+
+    :param str range_header: value of the Range header, e.g. "bytes=100-"
+    :param int size: size of the resource in bytes
+    :returns: (start, end) with end exclusive, or None if the header isn't
+        a single byte range, in which case the whole resource should be sent
+    :rtype: tuple
+    :raises ValueError: if the range can't be satisfied
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", range_header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # suffix range, i.e. the last N bytes
+        start = max(size - int(last), 0)
+        end = size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last != "" else size
+    if start >= size or start >= end:
+        raise ValueError("Range %s not satisfiable" % range_header)
+    return start, end
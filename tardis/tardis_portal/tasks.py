@@ -1,10 +1,16 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.db import transaction
-from django.db.models import Q
+from django.db import connections, router, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.deletion import Collector
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from tardis.celery import tardis_app
 
@@ -13,62 +19,265 @@ from .email import email_user
 logger = logging.getLogger(__name__)
 
 
-@tardis_app.task(name="tardis_portal.cleanup_dfs", ignore_result=True)
-def cleanup_dfs(**kwargs):
+def _orphan_datafiles():
     from .models import DataFile, DataFileObject
 
-    dfs = DataFile.objects.raw(
-        """
-        SELECT df.id
-        FROM tardis_portal_datafile AS df
-        LEFT JOIN tardis_portal_datafileobject AS dfo
-        ON dfo.datafile_id = df.id
-        WHERE dfo.id IS NULL
-    """
+    return DataFile.objects.filter(
+        ~Exists(DataFileObject.objects.filter(datafile_id=OuterRef("pk")))
     )
-    for df in dfs:
-        dfid = df.id
-        if DataFileObject.objects.filter(datafile_id=dfid).count() == 0:
-            DataFile.objects.get(id=dfid).delete()
 
 
-@tardis_app.task(name="tardis_portal.cleanup_dfos", ignore_result=True)
-def cleanup_dfos(**kwargs):
-    from datetime import datetime, timedelta
+def _delete_orphan_datafiles(datafile_ids):
+    """
+    Deletes those of the given DataFiles which have no DataFileObjects,
+    returns the number of deleted DataFiles
+    """
+    from .models import DataFile
 
-    from django.conf import settings
+    with transaction.atomic():
+        orphans = _orphan_datafiles().filter(id__in=datafile_ids).select_for_update()
+        return DataFile.bulk_delete(orphans)
 
-    import pytz
 
-    from .models import DataFile, DataFileObject
+@tardis_app.task(name="tardis_portal.cleanup_dfs", ignore_result=True)
+def cleanup_dfs(**kwargs):
+    """
+    Deletes DataFiles which have no DataFileObjects, in batches of
+    CLEANUP_BATCH_SIZE
+    """
+    batch_size = getattr(settings, "CLEANUP_BATCH_SIZE", 1000)
+    last_id = 0
+    deleted = 0
+    while True:
+        datafile_ids = list(
+            _orphan_datafiles()
+            .filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not datafile_ids:
+            break
+        last_id = datafile_ids[-1]
+        deleted += _delete_orphan_datafiles(datafile_ids)
+        logger.info("cleanup_dfs: deleted %d orphaned DataFiles so far", deleted)
+        if len(datafile_ids) < batch_size:
+            break
+
+
+def _delete_dfo_data(dfo):
+    """
+    Deletes the file of a DataFileObject which is being cleaned up, returns
+    whether its record can be deleted
+    """
+    try:
+        dfo.delete_data()
+    except NotImplementedError:
+        logger.info(
+            "deletion not supported on storage box %s, for dfo id %s",
+            dfo.storage_box,
+            dfo.id,
+        )
+    except OSError:
+        # the file doesn't exist
+        pass
+    except Exception:
+        logger.exception("cleanup_dfos: failed to delete the file of dfo %s", dfo.id)
+        return False
+    # the file isn't deleted again by the pre_delete handler
+    dfo._data_deleted = True  # pylint: disable=W0212
+    return True
 
-    tz = pytz.timezone(settings.TIME_ZONE)
-    wait_until = datetime.now(tz) - timedelta(hours=24 * 7)
-    dfos = DataFileObject.objects.filter(created_time__lte=wait_until, verified=False)
-    for dfo in dfos:
-        dfid = dfo.datafile_id
-        try:
-            dfo.delete()
-        except OSError:
-            # we can't delete file if it does not exist
-            dfo.uri = None
-            dfo.save(update_fields=["uri"])
-            dfo.delete()
-        finally:
-            if DataFileObject.objects.filter(datafile_id=dfid).count() == 0:
-                DataFile.objects.get(id=dfid).delete()
+
+@tardis_app.task(name="tardis_portal.cleanup_dfos", ignore_result=True)
+def cleanup_dfos(**kwargs):
+    """
+    Deletes DataFileObjects which are still unverified CLEANUP_DFO_AGE after
+    they were created, and their DataFiles if they have no other
+    DataFileObjects.
+
+    The DataFileObjects are deleted in batches of CLEANUP_BATCH_SIZE, whose
+    files are deleted from storage by CLEANUP_THREADS threads.  The records
+    of DataFileObjects whose files couldn't be deleted are kept, to be
+    cleaned up by the next run.
+    """
+    from .models import DataFileObject
+
+    batch_size = getattr(settings, "CLEANUP_BATCH_SIZE", 1000)
+    wait_until = timezone.now() - getattr(
+        settings, "CLEANUP_DFO_AGE", timedelta(days=7)
+    )
+    stale_dfos = DataFileObject.objects.filter(
+        created_time__lte=wait_until, verified=False
+    )
+    storage_boxes = {}
+    last_id = 0
+    deleted_dfos = deleted_dfs = failed = 0
+    while True:
+        dfos = list(
+            stale_dfos.filter(id__gt=last_id)
+            .select_related("storage_box")
+            .order_by("id")[:batch_size]
+        )
+        if not dfos:
+            break
+        last_id = dfos[-1].id
+        full_batch = len(dfos) == batch_size
+
+        deletable = []
+        for dfo in dfos:
+            if dfo.storage_box_id not in storage_boxes:
+                box = dfo.storage_box
+                can_delete = getattr(
+                    box.attributes.filter(key="can_delete").first(), "value", "True"
+                )
+                storage_boxes[box.id] = (
+                    box.get_initialised_storage_instance(),
+                    can_delete.lower() == "true",
+                )
+            storage, can_delete = storage_boxes[dfo.storage_box_id]
+            dfo._cached_storage = storage  # pylint: disable=W0212
+            # otherwise the pre_delete handler logs why nothing is deleted
+            if can_delete and dfo.uri:
+                deletable.append(dfo)
+        with ThreadPoolExecutor(
+            max_workers=getattr(settings, "CLEANUP_THREADS", 4)
+        ) as executor:
+            deleted_data = dict(
+                zip(
+                    (dfo.id for dfo in deletable),
+                    executor.map(_delete_dfo_data, deletable),
+                )
+            )
+        dfos = [dfo for dfo in dfos if deleted_data.get(dfo.id, True)]
+
+        # like QuerySet.delete(), but signals are sent for these instances
+        collector = Collector(using=router.db_for_write(DataFileObject))
+        collector.collect(dfos)
+        collector.delete()
+        deleted_dfos += len(dfos)
+        failed += len(deleted_data) - sum(deleted_data.values())
+        deleted_dfs += _delete_orphan_datafiles({dfo.datafile_id for dfo in dfos})
+        logger.info(
+            "cleanup_dfos: deleted %d stale DataFileObjects and %d DataFiles so "
+            "far, failed to delete %d files",
+            deleted_dfos,
+            deleted_dfs,
+            failed,
+        )
+        if not full_batch:
+            break
+
+
+def _start_batch_verification(reverify, **kwargs):
+    from .models import StorageBox
+
+    since = timezone.now()
+    if reverify:
+        since -= getattr(settings, "REVERIFY_INTERVAL", timedelta(days=7))
+    since = since.isoformat()
+    boxes = StorageBox.objects.filter(
+        id__in=StorageBox.objects.filter(file_objects__verified=reverify).values("id")
+    )
+    for box in boxes:
+        kwargs["priority"] = box.priority
+        kwargs["shadow"] = "verify_dfo_batch location:%s" % box.name
+        for dummy in range(getattr(settings, "VERIFY_BATCH_TASKS", 1)):
+            verify_dfo_batch.apply_async(args=[box.id, since, reverify], **kwargs)
 
 
 @tardis_app.task(name="tardis_portal.verify_dfos", ignore_result=True)
 def verify_dfos(**kwargs):
-    from .models import DataFileObject
+    """
+    Starts VERIFY_BATCH_TASKS chains of batch verification tasks for each
+    storage box which has unverified DataFileObjects
+    """
+    _start_batch_verification(False, **kwargs)
+
+
+@tardis_app.task(name="tardis_portal.reverify_dfos", ignore_result=True)
+def reverify_dfos(**kwargs):
+    """
+    Re-verifies the verified DataFileObjects which weren't verified within
+    REVERIFY_INTERVAL, like :py:func:`verify_dfos`.  Files are only read if
+    their fingerprint changed, or their checksums weren't computed within
+    VERIFY_AUDIT_INTERVAL.
+    """
+    _start_batch_verification(True, **kwargs)
+
+
+@tardis_app.task(name="tardis_portal.verify_dfo_batch", ignore_result=True)
+def verify_dfo_batch(storage_box_id, since, reverify=False):
+    """
+    Verifies a batch of up to VERIFY_BATCH_SIZE unverified DataFileObjects in
+    a storage box, which weren't verified since the given time, and queues
+    the next batch if there may be more.
+
+    The batch is claimed in a short transaction, which locks the
+    DataFileObjects, skipping those locked by concurrent tasks, and stamps
+    their last_verified_time, so that tasks verify separate batches.  They
+    are then verified by VERIFY_BATCH_THREADS threads outside of any
+    transaction, and the results are saved with bulk updates in a second
+    short transaction.  DataFileObjects claimed by a task which fails are
+    verified again by the next verification run.
+
+    :param int storage_box_id: id of the StorageBox
+    :param str since: ISO 8601 time at which the verification run started
+    :param bool reverify: verify verified DataFileObjects instead, using
+        their fingerprints
+    """
+    from .models import DataFileObject, StorageBox
+
+    batch_size = getattr(settings, "VERIFY_BATCH_SIZE", 1000)
+    box = StorageBox.objects.get(id=storage_box_id)
+    storage = box.get_initialised_storage_instance()
 
-    dfos_to_verify = DataFileObject.objects.filter(verified=False)
-    kwargs["transaction_lock"] = kwargs.get("transaction_lock", True)
-    for dfo in dfos_to_verify:
-        kwargs["priority"] = dfo.priority
-        kwargs["shadow"] = "dfo_verify location:%s" % dfo.storage_box.name
-        dfo_verify.apply_async(args=[dfo.id], **kwargs)
+    def check(dfo):
+        try:
+            return dfo.check(use_fingerprint=reverify)
+        finally:
+            # threads don't share the task's database connections
+            connections.close_all()
+
+    with transaction.atomic():
+        dfo_ids = list(
+            DataFileObject.objects.select_for_update(skip_locked=True)
+            .filter(storage_box=box, verified=reverify)
+            .filter(
+                Q(last_verified_time__isnull=True)
+                | Q(last_verified_time__lt=parse_datetime(since))
+            )
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        DataFileObject.objects.filter(id__in=dfo_ids).update(
+            last_verified_time=timezone.now()
+        )
+
+    dfos = list(
+        DataFileObject.objects.filter(id__in=dfo_ids).select_related("datafile")
+    )
+    for dfo in dfos:
+        dfo.storage_box = box
+        dfo._cached_storage = storage  # pylint: disable=W0212
+    with ThreadPoolExecutor(
+        max_workers=getattr(settings, "VERIFY_BATCH_THREADS", 4)
+    ) as executor:
+        results = list(zip(dfos, executor.map(check, dfos)))
+    with transaction.atomic():
+        DataFileObject.save_verifications(results)
+
+    logger.info(
+        "Verified %d of %d DataFileObjects in storage box %s",
+        sum(result for dummy, (result, dummy_update) in results),
+        len(results),
+        box.name,
+    )
+    if len(dfo_ids) == batch_size:
+        verify_dfo_batch.apply_async(
+            args=[storage_box_id, since, reverify],
+            priority=box.priority,
+            shadow="verify_dfo_batch location:%s" % box.name,
+        )
 
 
 @tardis_app.task(name="tardis_portal.ingest_received_files", ignore_result=True)
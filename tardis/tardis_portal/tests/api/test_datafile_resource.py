@@ -12,6 +12,7 @@ import tempfile
 from unittest import skipIf
 
 from django.conf import settings
+from django.test import override_settings
 from django.test.client import Client
 
 import magic
@@ -220,6 +221,152 @@ class DataFileResourceTest(MyTardisResourceTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.getvalue(), b"123test\n")
 
+    def test_bulk_create_files(self):
+        DatasetACL.objects.create(
+            dataset=self.testds, group=self.testgroup, canRead=True
+        )
+        dataset_uri = "/api/v1/dataset/%d/" % self.testds.id
+        records = [
+            {
+                "dataset": dataset_uri,
+                "filename": "file%d.txt" % idx,
+                "directory": "bulk",
+                "md5sum": "bogus",
+                "size": idx,
+                "replicas": [{"url": "bulk/file%d.txt" % idx, "location": "default"}],
+            }
+            for idx in range(3)
+        ]
+        records += [
+            # staged, with no replicas
+            {
+                "dataset": dataset_uri,
+                "filename": "staged.txt",
+                "md5sum": "bogus",
+                "size": 1,
+            },
+            # already registered
+            {
+                "dataset": dataset_uri,
+                "filename": "testfile.txt",
+                "md5sum": "bogus",
+                "size": 1,
+            },
+            # registered earlier in the request
+            dict(records[0]),
+            {"dataset": dataset_uri, "filename": "nochecksum.txt", "size": 1},
+            {"dataset": "/api/v1/dataset/0/", "filename": "a.txt", "md5sum": "a"},
+        ]
+        datafile_count = DataFile.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.django_client.post(
+                "/api/v1/dataset_file/bulk/",
+                json.dumps(records),
+                content_type="application/json",
+            )
+        self.assertHttpOK(response)
+        results = json.loads(response.content)["objects"]
+        self.assertEqual(
+            [result["status"] for result in results],
+            [201, 201, 201, 201, 409, 409, 400, 404],
+        )
+        self.assertEqual(datafile_count + 4, DataFile.objects.count())
+        staged = DataFile.objects.get(id=results[3]["id"])
+        staged_dfo = staged.file_objects.get()
+        self.assertEqual(results[3]["temp_url"], staged_dfo.get_full_path())
+        # nothing has been uploaded to the staging location yet
+        self.assertEqual(staged_dfo.stored_size, 0)
+        bulk_files = DataFile.objects.filter(directory="bulk")
+        self.assertEqual(
+            set(bulk_files.values_list("file_objects__uri", flat=True)),
+            {"bulk/file%d.txt" % idx for idx in range(3)},
+        )
+        self.assertEqual(
+            DatafileACL.objects.filter(
+                datafile__in=bulk_files, group=self.testgroup
+            ).count(),
+            3,
+        )
+        self.assertEqual(
+            self.testds.directories.filter(path="bulk")
+            .values_list("file_count", "total_size")
+            .get(),
+            (3, 3),
+        )
+
+        # JSON lines
+        response = self.django_client.post(
+            "/api/v1/dataset_file/bulk/",
+            "\n".join(
+                json.dumps(
+                    {
+                        "dataset": dataset_uri,
+                        "filename": name,
+                        "md5sum": "bogus",
+                        "size": 1,
+                    }
+                )
+                for name in ("a.txt", "b.txt")
+            ),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(
+            [result["status"] for result in json.loads(response.content)["objects"]],
+            [201, 201],
+        )
+
+    @override_settings(ONLY_EXPERIMENT_ACLS=False)
+    def test_bulk_create_public_files(self):
+        public_ds = Dataset.objects.create(
+            description="public dataset", public_access=Dataset.PUBLIC_ACCESS_FULL
+        )
+        public_ds.experiments.add(self.testexp)
+        for dataset in (self.testds, public_ds):
+            DatasetACL.objects.create(
+                dataset=dataset,
+                user=self.user,
+                canRead=True,
+                canWrite=True,
+                isOwner=True,
+                aclOwnershipType=DatasetACL.OWNER_OWNED,
+            )
+        records = [
+            {
+                "dataset": "/api/v1/dataset/%d/" % dataset.id,
+                "filename": "public%d.txt" % public_access,
+                "md5sum": "bogus",
+                "size": 1,
+                "public_access": public_access,
+                "replicas": [{"url": "public%d.txt" % public_access}],
+            }
+            for dataset, public_access in (
+                (self.testds, DataFile.PUBLIC_ACCESS_FULL),
+                (public_ds, DataFile.PUBLIC_ACCESS_NONE),
+            )
+        ]
+        response = self.django_client.post(
+            "/api/v1/dataset_file/bulk/",
+            json.dumps(records),
+            content_type="application/json",
+        )
+        results = json.loads(response.content)["objects"]
+        self.assertEqual([result["status"] for result in results], [201, 201])
+        # public access follows each file's public_access, not its dataset's
+        self.assertEqual(
+            [
+                DatafileACL.objects.filter(
+                    datafile_id=result["id"], user_id=settings.PUBLIC_USER_ID
+                ).exists()
+                for result in results
+            ],
+            [True, False],
+        )
+        self.assertTrue(
+            DatafileACL.objects.filter(datafile_id=results[1]["id"], user=self.user)
+            .filter(isOwner=True)
+            .exists()
+        )
+
 
 @skipIf(settings.ONLY_EXPERIMENT_ACLS is True, "skipping Micro ACL specific test")
 class DataFileResourceMicroTest(MyTardisResourceTestCase):
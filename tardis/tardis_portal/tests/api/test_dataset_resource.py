@@ -187,6 +187,48 @@ class DatasetResourceTest(MyTardisResourceTestCase):
 
         dataset.delete()
 
+    def test_get_root_dir_nodes_pages(self):
+        dataset = Dataset.objects.create(description="test dataset")
+        dataset.experiments.add(self.testexp)
+        DataFile.objects.bulk_create(
+            DataFile(dataset=dataset, filename="file%04d" % i, size=0, md5sum="bogus")
+            for i in range(1001)
+        )
+        uri = "/api/v1/dataset/%d/root-dir-nodes/" % dataset.id
+        response = self.api_client.get(uri, authentication=self.get_credentials())
+        returned_data = json.loads(response.content.decode())
+        self.assertEqual(len(returned_data), 1001)
+        self.assertEqual(returned_data[0]["name"], "file0000")
+        self.assertEqual(returned_data[999]["name"], "file0999")
+        marker = returned_data[-1]
+        self.assertTrue(marker["next_page"])
+        self.assertEqual(marker["next_page_num"], 1)
+
+        for query in ("page=1", "page=1&cursor=%s" % quote(marker["cursor"])):
+            response = self.api_client.get(
+                uri + "?" + query, authentication=self.get_credentials()
+            )
+            returned_data = json.loads(response.content.decode())
+            self.assertEqual(
+                [node.get("name") for node in returned_data], ["file1000", None]
+            )
+            self.assertEqual(returned_data[-1], {"next_page": False})
+
+        # the number of queries doesn't grow with the number of files
+        with self.assertNumQueries(10):
+            response = self.api_client.get(uri, authentication=self.get_credentials())
+        self.assertEqual(len(json.loads(response.content.decode())), 1001)
+
+        # out of range pages deliver the last page of results
+        response = self.api_client.get(
+            uri + "?page=9999", authentication=self.get_credentials()
+        )
+        returned_data = json.loads(response.content.decode())
+        self.assertEqual(
+            [node.get("name") for node in returned_data], ["file1000", None]
+        )
+        self.assertEqual(returned_data[-1], {"next_page": False})
+
     def test_get_child_dir_nodes(self):
         dataset = Dataset.objects.create(description="test dataset")
         dataset.experiments.add(self.testexp)
@@ -0,0 +1,165 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+
+from ...auth.acl_resolver import ACLResolver, clear_acl_cache
+from ...models import Experiment, ExperimentACL, Token
+
+
+class ACLResolverTestCase(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="resolver_user")
+        self.other = User.objects.create_user(username="resolver_other")
+        self.groups = [Group.objects.create(name="resolver%d" % i) for i in range(5)]
+        self.user.groups.add(*self.groups[:4])
+
+        def experiment(title, **acl):
+            exp = Experiment.objects.create(title=title, created_by=self.other)
+            if acl:
+                ExperimentACL.objects.create(
+                    experiment=exp, aclOwnershipType=ExperimentACL.OWNER_OWNED, **acl
+                )
+            return exp
+
+        self.owned = experiment("owned", user=self.user, isOwner=True)
+        self.group_owned = experiment(
+            "group owned", group=self.groups[2], isOwner=True, canRead=True
+        )
+        self.shared = experiment(
+            "shared", user=self.user, canRead=True, canDownload=True
+        )
+        self.group_shared = experiment(
+            "group shared", group=self.groups[3], canRead=True
+        )
+        self.not_shared = experiment("not shared", group=self.groups[4], canRead=True)
+        self.public = Experiment.objects.create(
+            title="public",
+            created_by=self.other,
+            public_access=Experiment.PUBLIC_ACCESS_FULL,
+        )
+        token = Token(user=self.other, token="resolvertoken")
+        token.save()
+        self.token_shared = experiment("token shared", token=token, canRead=True)
+
+    def assertExperiments(self, query, *expected):
+        self.assertEqual(
+            sorted(query.values_list("id", flat=True)),
+            sorted(exp.id for exp in expected),
+        )
+
+    def test_safe_manager(self):
+        self.assertExperiments(
+            Experiment.safe.owned(user=self.user), self.owned, self.group_owned
+        )
+        self.assertExperiments(
+            Experiment.safe.shared(user=self.user), self.shared, self.group_shared
+        )
+        self.assertExperiments(
+            Experiment.safe.owned_and_shared(user=self.user),
+            self.owned,
+            self.group_owned,
+            self.shared,
+            self.group_shared,
+        )
+        self.assertExperiments(Experiment.safe.public(), self.public)
+        self.assertExperiments(
+            Experiment.safe.all(user=self.user),
+            self.owned,
+            self.group_owned,
+            self.shared,
+            self.group_shared,
+            self.public,
+        )
+        self.assertExperiments(
+            Experiment.safe.shared(user=self.user, canDownload=True), self.shared
+        )
+        # owned by the user itself or a single group, not by its groups
+        self.assertExperiments(
+            Experiment.safe.owned_by_user(user=self.user), self.owned
+        )
+        self.assertExperiments(
+            Experiment.safe.owned_by_user_id(user_id=self.user.id), self.owned
+        )
+        self.assertExperiments(
+            Experiment.safe.owned_by_group(group=self.groups[2]), self.group_owned
+        )
+        self.assertExperiments(
+            Experiment.safe.owned_by_group(group_id=self.groups[3].id)
+        )
+
+    def test_group_membership_is_current(self):
+        self.assertNotIn(self.not_shared, Experiment.safe.all(user=self.user))
+        self.user.groups.add(self.groups[4])
+        self.assertIn(self.not_shared, Experiment.safe.all(user=self.user))
+
+    def test_anonymous_user_with_token(self):
+        anonymous = AnonymousUser()
+        self.assertExperiments(Experiment.safe.owned(user=anonymous))
+        self.assertExperiments(Experiment.safe.all(user=anonymous), self.public)
+        anonymous.allowed_tokens = ["resolvertoken"]
+        self.assertExperiments(
+            Experiment.safe.all(user=anonymous), self.public, self.token_shared
+        )
+
+    def test_single_acl_query(self):
+        resolver = ACLResolver.for_user(self.user)
+        self.assertIs(ACLResolver.for_user(self.user), resolver)
+        # all groups are matched in one query, however many there are
+        with self.assertNumQueries(1):
+            list(resolver.object_ids("experiment"))
+        with self.assertNumQueries(1):
+            list(Experiment.safe.all(user=self.user))
+
+
+@override_settings(
+    ACL_CACHE_TIMEOUT=300,
+    ACL_CACHE="acls",
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "acls": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    },
+)
+class CachedACLResolverTestCase(ACLResolverTestCase):
+    def test_single_acl_query(self):
+        list(Experiment.safe.all(user=self.user))
+        # only the experiments themselves are queried for a repeat visitor
+        with self.assertNumQueries(1):
+            list(Experiment.safe.all(user=self.user))
+
+    def test_acl_changes_invalidate_cache(self):
+        self.assertNotIn(self.not_shared, Experiment.safe.all(user=self.user))
+        acl = ExperimentACL.objects.create(
+            experiment=self.not_shared,
+            user=self.user,
+            canRead=True,
+            aclOwnershipType=ExperimentACL.OWNER_OWNED,
+        )
+        self.assertIn(self.not_shared, Experiment.safe.all(user=self.user))
+        acl.delete()
+        self.assertNotIn(self.not_shared, Experiment.safe.all(user=self.user))
+        self.groups[4].user_set.add(self.user)
+        self.assertIn(self.not_shared, Experiment.safe.all(user=self.user))
+        self.user.groups.clear()
+        self.assertExperiments(
+            Experiment.safe.all(user=self.user), self.owned, self.shared, self.public
+        )
+
+    def test_large_acl_sets_are_not_cached(self):
+        resolver = ACLResolver.for_user(self.user)
+        self.assertIsInstance(resolver.object_ids("experiment"), list)
+        # DataFile ACLs and principals above ACL_CACHE_MAX_ROWS use a subquery
+        self.assertIsInstance(resolver.object_ids("datafile"), QuerySet)
+        clear_acl_cache()
+        with self.settings(ACL_CACHE_MAX_ROWS=1):
+            self.assertIsInstance(resolver.object_ids("dataset"), list)
+            self.assertIsInstance(resolver.object_ids("experiment"), QuerySet)
+            self.assertExperiments(
+                Experiment.safe.owned_and_shared(user=self.user),
+                self.owned,
+                self.group_owned,
+                self.shared,
+                self.group_shared,
+            )
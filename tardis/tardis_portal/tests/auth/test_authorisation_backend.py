@@ -0,0 +1,244 @@
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+from ...auth.authorisation import ACLAwareBackend, PermissionCacheMiddleware
+from ...auth.decorators import has_download_access, has_download_access_bulk
+from ...models import (
+    DataFile,
+    DatafileACL,
+    Dataset,
+    DatasetACL,
+    Experiment,
+    ExperimentACL,
+)
+
+
+class ACLAwareBackendTestCase(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="backend_user")
+        self.other = User.objects.create_user(username="backend_other")
+        self.group = Group.objects.create(name="backend_group")
+        self.user.groups.add(self.group)
+        self.experiments = [
+            Experiment.objects.create(title="exp%d" % i, created_by=self.other)
+            for i in range(6)
+        ]
+        ExperimentACL.objects.create(
+            experiment=self.experiments[0],
+            user=self.user,
+            canRead=True,
+            canDownload=True,
+            aclOwnershipType=ExperimentACL.OWNER_OWNED,
+        )
+        ExperimentACL.objects.create(
+            experiment=self.experiments[1],
+            group=self.group,
+            canRead=True,
+            aclOwnershipType=ExperimentACL.OWNER_OWNED,
+        )
+        ExperimentACL.objects.create(
+            experiment=self.experiments[2],
+            user=self.user,
+            isOwner=True,
+            aclOwnershipType=ExperimentACL.OWNER_OWNED,
+        )
+        self.backend = ACLAwareBackend()
+
+    def test_has_perms(self):
+        view = self.backend.has_perms(
+            self.user, "tardis_acls.view_experiment", self.experiments
+        )
+        self.assertEqual(
+            view, {exp.id: exp in self.experiments[:3] for exp in self.experiments}
+        )
+        download = self.backend.has_perms(
+            self.user, "tardis_acls.download_experiment", self.experiments
+        )
+        self.assertEqual(
+            [exp.id for exp in self.experiments if download[exp.id]],
+            [self.experiments[0].id, self.experiments[2].id],
+        )
+        for exp in self.experiments:
+            self.assertEqual(
+                self.backend.has_perm(self.user, "tardis_acls.view_experiment", exp),
+                view[exp.id],
+            )
+
+    def test_has_perms_single_query(self):
+        with self.assertNumQueries(1):
+            self.backend.has_perms(
+                self.user, "tardis_acls.view_experiment", self.experiments
+            )
+
+    def test_request_cache(self):
+        checks = []
+
+        def view(request):
+            perm = "tardis_acls.view_experiment"
+            exp = self.experiments[3]
+            checks.append(self.backend.has_perm(self.user, perm, exp))
+            with self.assertNumQueries(0):
+                checks.append(self.backend.has_perm(self.user, perm, exp))
+            # changes to ACLs during the request empty the cache
+            ExperimentACL.objects.create(
+                experiment=exp,
+                user=self.user,
+                canRead=True,
+                aclOwnershipType=ExperimentACL.OWNER_OWNED,
+            )
+            checks.append(self.backend.has_perm(self.user, perm, exp))
+            return HttpResponse()
+
+        PermissionCacheMiddleware(view)(RequestFactory().get("/"))
+        self.assertEqual(checks, [False, False, True])
+
+
+@override_settings(ONLY_EXPERIMENT_ACLS=False)
+class HasAccessBulkTestCase(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="bulk_user")
+        self.superuser = User.objects.create_superuser(username="bulk_admin")
+        dataset = Dataset.objects.create(description="bulk")
+        for i in range(20):
+            datafile = DataFile.objects.create(
+                dataset=dataset, filename="file%d" % i, size=1, md5sum="bogus"
+            )
+            if i % 2:
+                DatafileACL.objects.create(
+                    datafile=datafile,
+                    user=self.user,
+                    canDownload=True,
+                    aclOwnershipType=DatafileACL.OWNER_OWNED,
+                )
+        self.factory = RequestFactory()
+
+    def request(self, user):
+        request = self.factory.get("/")
+        request.user = user
+        return request
+
+    def test_bulk_access(self):
+        datafiles = list(DataFile.objects.order_by("id"))
+        request = self.request(self.user)
+        ContentType.objects.get_for_model(DataFile)
+        # the datasets, and the ACLs of all of the files
+        with self.assertNumQueries(2):
+            access = has_download_access_bulk(request, datafiles, "datafile")
+        self.assertEqual(
+            [access[datafile.id] for datafile in datafiles],
+            [bool(i % 2) for i in range(20)],
+        )
+        for datafile in datafiles:
+            self.assertEqual(
+                access[datafile.id],
+                has_download_access(request, datafile.id, "datafile"),
+            )
+
+    def test_superuser(self):
+        datafiles = list(DataFile.objects.all())
+        request = self.request(self.superuser)
+        access = has_download_access_bulk(request, datafiles, "datafile")
+        self.assertTrue(all(access.values()))
+        self.assertTrue(has_download_access(request, datafiles[0].id, "datafile"))
+
+
+@override_settings(ONLY_EXPERIMENT_ACLS=False, DATAFILE_ACL_INHERITANCE=True)
+class DatafileACLInheritanceTestCase(TestCase):
+    def setUp(self):
+        self.PUBLIC_USER = User.objects.create_user(username="PUBLIC_USER_TEST")
+        self.assertEqual(self.PUBLIC_USER.id, settings.PUBLIC_USER_ID)
+        self.user = User.objects.create_user(username="inherit_user")
+        self.other = User.objects.create_user(username="inherit_other")
+        self.dataset = Dataset.objects.create(description="shared")
+        DatasetACL.objects.create(
+            dataset=self.dataset,
+            user=self.user,
+            canRead=True,
+            aclOwnershipType=DatasetACL.OWNER_OWNED,
+        )
+        self.datafiles = [
+            DataFile.objects.create(
+                dataset=self.dataset, filename="file%d" % i, size=1, md5sum="bogus"
+            )
+            for i in range(3)
+        ]
+        # the ACLs of a file override those of its dataset
+        DatafileACL.objects.create(
+            datafile=self.datafiles[1],
+            user=self.other,
+            canRead=True,
+            aclOwnershipType=DatafileACL.OWNER_OWNED,
+        )
+        DatafileACL.objects.create(
+            datafile=self.datafiles[2],
+            user=self.user,
+            canRead=True,
+            canDownload=True,
+            aclOwnershipType=DatafileACL.OWNER_OWNED,
+        )
+        self.datafiles.append(
+            DataFile.objects.create(
+                dataset=Dataset.objects.create(description="not shared"),
+                filename="file3",
+                size=1,
+                md5sum="bogus",
+            )
+        )
+        self.backend = ACLAwareBackend()
+
+    def test_safe_manager(self):
+        self.assertEqual(
+            set(DataFile.safe.all(user=self.user)),
+            {self.datafiles[0], self.datafiles[2]},
+        )
+        self.assertEqual(
+            set(DataFile.safe.all(user=self.user, canDownload=True)),
+            {self.datafiles[2]},
+        )
+        DatasetACL.objects.filter(dataset=self.dataset).update(isOwner=True)
+        self.assertEqual(
+            set(DataFile.safe.owned_by_user(user=self.user)), {self.datafiles[0]}
+        )
+
+    def test_has_perms(self):
+        view = self.backend.has_perms(
+            self.user, "tardis_acls.view_datafile", self.datafiles
+        )
+        self.assertEqual(
+            [view[datafile.id] for datafile in self.datafiles],
+            [True, False, True, False],
+        )
+        download = self.backend.has_perms(
+            self.user, "tardis_acls.download_datafile", self.datafiles
+        )
+        self.assertEqual(
+            [download[datafile.id] for datafile in self.datafiles],
+            [False, False, True, False],
+        )
+
+    def test_public_access_is_not_inherited(self):
+        public_dataset = Dataset.objects.create(
+            description="public", public_access=Dataset.PUBLIC_ACCESS_FULL
+        )
+        hidden = DataFile.objects.create(
+            dataset=public_dataset, filename="hidden", size=1, md5sum="bogus"
+        )
+        public = DataFile.objects.create(
+            dataset=self.dataset,
+            filename="public",
+            size=1,
+            md5sum="bogus",
+            public_access=DataFile.PUBLIC_ACCESS_FULL,
+        )
+        self.assertEqual(set(DataFile.safe.public()), {public})
+        self.assertEqual(
+            set(DataFile.safe.all(user=self.other)), {self.datafiles[1], public}
+        )
+        self.assertFalse(self.other.has_perm("tardis_acls.view_datafile", hidden))
@@ -8,12 +8,15 @@ test_dataset.py
 """
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from tardis.tardis_portal.models import (
     DataFile,
     DatafileACL,
     Dataset,
     DatasetACL,
+    DatasetDirectory,
     Experiment,
     ExperimentACL,
     Facility,
@@ -75,7 +78,6 @@ class DatasetTestCase(ModelTestCase):
         )
 
     def test_get_dir_tuples(self):
-
         exp = Experiment(
             title="test exp1", institution_name="monash", created_by=self.user
         )
@@ -241,3 +243,49 @@ class DatasetTestCase(ModelTestCase):
         self.assertEqual(
             dataset.get_dir_tuples(self.user, "dir2/subdir2"), [("..", "dir2/subdir2")]
         )
+
+    def test_directory_index(self):
+        dataset = Dataset.objects.create(description="test dataset1")
+
+        def index():
+            return sorted(
+                DatasetDirectory.objects.filter(dataset=dataset).values_list(
+                    "path", "parent__path", "file_count", "total_size"
+                )
+            )
+
+        df1 = DataFile.objects.create(
+            dataset=dataset, filename="file1", size=1, md5sum="bogus", directory="a/b"
+        )
+        DataFile.objects.create(
+            dataset=dataset, filename="file2", size=10, md5sum="bogus", directory="a"
+        )
+        DataFile.objects.create(
+            dataset=dataset, filename="file3", size=100, md5sum="bogus", directory=""
+        )
+        self.assertEqual(index(), [("a", None, 2, 11), ("a/b", "a", 1, 1)])
+        self.assertEqual(dataset.get_dir_stats(self.user, "a"), (2, 11))
+
+        df1.directory = "c"
+        df1.size = 2
+        df1.save()
+        self.assertEqual(index(), [("a", None, 1, 10), ("c", None, 1, 2)])
+
+        # saving a file which was loaded doesn't query its stored directory
+        df1 = DataFile.objects.get(id=df1.id)
+        with CaptureQueriesContext(connection) as queries:
+            df1.save()
+        self.assertFalse(
+            any(
+                query["sql"].startswith('SELECT "tardis_portal_datafile"."dataset_id"')
+                for query in queries
+            )
+        )
+        df1.directory = "/a//d/"
+        df1.save()
+        self.assertEqual(df1.directory, "a/d")
+        self.assertEqual(index(), [("a", None, 2, 12), ("a/d", "a", 1, 2)])
+
+        df1.delete()
+        self.assertEqual(index(), [("a", None, 1, 10)])
+        self.assertEqual(dataset.get_dir_stats(self.user, "c"), (0, 0))
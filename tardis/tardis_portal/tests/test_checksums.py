@@ -0,0 +1,50 @@
+import hashlib
+import os
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+from django.test import SimpleTestCase
+
+from ..checksums import ChecksumEngine
+from ..models.datafile import compute_checksums
+
+
+class ChecksumEngineTestCase(SimpleTestCase):
+    def setUp(self):
+        # several chunks, the last of which is partial
+        self.data = os.urandom(3 * 4096 + 123)
+        self.expected = {
+            "md5sum": hashlib.md5(self.data).hexdigest(),
+            "sha512sum": hashlib.sha512(self.data).hexdigest(),
+        }
+
+    def checksum(self, file_object, **kwargs):
+        engine = ChecksumEngine(["md5sum", "sha512sum"], chunk_size=4096, **kwargs)
+        engine.update_file(file_object)
+        self.assertEqual(engine.bytes_read, len(self.data))
+        return engine.hexdigests()
+
+    def test_file_objects(self):
+        self.assertEqual(self.checksum(BytesIO(self.data)), self.expected)
+        with NamedTemporaryFile() as tmp:
+            tmp.write(self.data)
+            tmp.flush()
+            for use_mmap in (True, False):
+                with open(tmp.name, "rb") as file_object:
+                    self.assertEqual(
+                        self.checksum(file_object, use_mmap=use_mmap), self.expected
+                    )
+
+    def test_compute_checksums(self):
+        file_object = BytesIO(self.data)
+        file_object.seek(100)
+        self.assertEqual(
+            compute_checksums(file_object, compute_sha512=True, close_file=False),
+            self.expected,
+        )
+        self.assertEqual(file_object.tell(), 0)
+        with NamedTemporaryFile() as empty, open(empty.name, "rb") as file_object:
+            self.assertEqual(
+                compute_checksums(file_object),
+                {"md5sum": hashlib.md5(b"").hexdigest()},
+            )
@@ -15,9 +15,10 @@ from zipfile import ZipFile, is_zipfile
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import Client
 
+from ..download import get_proxy_download_response
 from ..models.access_control import DatafileACL, DatasetACL, ExperimentACL
 from ..models.datafile import DataFile, DataFileObject
 from ..models.dataset import Dataset
@@ -809,6 +810,39 @@ class DownloadTestCase(TestCase):
             noTxt=True,
         )
 
+    def testProxyDownloadResponse(self):
+        dfo = self.datafile1.get_preferred_dfo(verified_only=False)
+        full_path = dfo.get_full_path()
+        self.assertIsNone(get_proxy_download_response(dfo, "testfile.txt"))
+
+        with override_settings(
+            PROXY_DOWNLOADS=True, PROXY_DOWNLOAD_PREFIXES={"/nowhere/": "/x/"}
+        ):
+            self.assertIsNone(get_proxy_download_response(dfo, "testfile.txt"))
+
+        store_path = dfo.storage_box.options.get(key="location").value
+        prefixes = {store_path.rstrip("/") + "/": "/protected/"}
+        with override_settings(PROXY_DOWNLOADS=True, PROXY_DOWNLOAD_PREFIXES=prefixes):
+            response = get_proxy_download_response(dfo, "testfile.txt", "inline")
+            self.assertEqual(
+                response["X-Accel-Redirect"],
+                quote("/protected/" + full_path[len(store_path) :].lstrip("/")),
+            )
+            self.assertEqual(
+                response["Content-Disposition"], 'inline; filename="testfile.txt"'
+            )
+
+            # a prefix configured for the storage box takes precedence
+            dfo.storage_box.attributes.create(
+                key="proxy_download_prefix", value="/box1/"
+            )
+            response = get_proxy_download_response(dfo, "testfile.txt")
+            self.assertEqual(response["X-Accel-Redirect"], quote("/box1/" + dfo.uri))
+
+            with override_settings(PROXY_DOWNLOAD_HEADER="X-Sendfile"):
+                response = get_proxy_download_response(dfo, "testfile.txt")
+                self.assertEqual(response["X-Sendfile"], full_path)
+
     def testDatasetFile(self):
         # check registered text file for physical file meta information
         df = DataFile.objects.get(
@@ -102,3 +102,70 @@ class FacilityOverviewTestCase(TestCase):
             [dataset["description"] for dataset in dataset_list],
             [self.dataset.description],
         )
+
+    def test_facility_overview_aggregates(self):
+        # one of the files was only partly uploaded
+        DataFileObject.objects.filter(datafile=self.datafile3).update(
+            verified=False, stored_size=100
+        )
+        DataFileObject.objects.exclude(datafile=self.datafile3).update(verified=True)
+        factory = RequestFactory()
+        request = factory.get("/facility/fetch_data/%s/0/5/" % self.facility.id)
+        request.user = self.user
+        dataset2 = Dataset.objects.create(
+            description="test dataset2", instrument=self.instrument
+        )
+        dataset2.experiments.add(self.exp)
+        self.exp.experimentacl_set.create(
+            user=self.user, isOwner=True, canRead=True, aclOwnershipType=1
+        )
+        # the permission check and one query each for the datasets, their
+        # experiments and their ACLs, however many datasets there are
+        with self.settings(FACILITY_OVERVIEW_CACHE_TIMEOUT=0), self.assertNumQueries(4):
+            response = facility_overview_experiments(
+                request, self.facility.id, "0", "5"
+            )
+        dataset_list = json.loads(response.content.decode())
+        size = self.datafile1.size
+        self.assertEqual(
+            [
+                (
+                    dataset["id"],
+                    dataset["datafile_count"],
+                    dataset["size"],
+                    dataset["verified_datafiles_count"],
+                    dataset["verified_datafiles_size"],
+                    dataset["owner"],
+                )
+                for dataset in dataset_list
+            ],
+            [
+                (dataset2.id, 0, 0, 0, 0, self.user.username),
+                (self.dataset.id, 3, 3 * size, 2, 2 * size, self.user.username),
+            ],
+        )
+
+        # the cached listing is used next time
+        response = facility_overview_experiments(request, self.facility.id, "0", "5")
+        with self.assertNumQueries(2):
+            cached_response = facility_overview_experiments(
+                request, self.facility.id, "0", "5"
+            )
+        self.assertEqual(cached_response.content, response.content)
+
+        self.assertEqual(
+            [
+                file_dict["verified"]
+                for file_dict in facility_overview_datafile_list(self.dataset)
+            ],
+            ["Yes", "Yes", "No (100 of %s bytes uploaded)" % "{:,}".format(size)],
+        )
+
+    def test_unknown_upload_progress(self):
+        # files stored before their size was recorded
+        DataFileObject.objects.filter(datafile=self.datafile3).update(
+            verified=False, stored_size=None
+        )
+        with self.settings(FACILITY_OVERVIEW_CACHE_TIMEOUT=0):
+            datafile_list = facility_overview_datafile_list(self.dataset)
+        self.assertEqual(datafile_list[2]["verified"], "No")
@@ -1,3 +1,4 @@
+import gzip
 import hashlib
 import os
 from io import BytesIO
@@ -11,9 +12,11 @@ from django.contrib.auth.models import User
 from django.test import Client, TestCase
 from django.urls import reverse
 
+from ..download import _get_datafile_details_for_archive, classic_mapper
 from ..models.datafile import DataFile
 from ..models.dataset import Dataset
 from ..models.experiment import Experiment
+from ..tar_stream import UncachedTarStream, parse_range_header
 
 
 class TarDownloadTestCase(TestCase):
@@ -159,3 +162,89 @@ class TarDownloadTestCase(TestCase):
                             os.stat(os.path.join("/tmp", full_path)).st_size,
                             int(df.size),
                         )
+
+    def test_tar_stream_prefetch(self):
+        files = _get_datafile_details_for_archive(classic_mapper("prefetch"), self.dfs)
+        expected = b"".join(
+            UncachedTarStream(files, filename="prefetch.tar").make_tar()
+        )
+        # read-ahead budgets which fit all, some and none of the files
+        for max_bytes in (10 * 1024 * 1024, 20000, 0):
+            tfs = UncachedTarStream(
+                files,
+                filename="prefetch.tar",
+                prefetch_files=4,
+                prefetch_max_bytes=max_bytes,
+            )
+            content = b"".join(tfs.make_tar())
+            self.assertEqual(len(content), tfs.tar_size)
+            self.assertEqual(content, expected)
+        with TarFile(fileobj=BytesIO(expected)) as tf:
+            self.assertEqual(len(tf.getmembers()), len(self.dfs))
+
+    def test_tgz_stream(self):
+        files = _get_datafile_details_for_archive(classic_mapper("tgz"), self.dfs)
+        expected = b"".join(UncachedTarStream(files, filename="tgz.tar").make_tar())
+        content = b"".join(
+            UncachedTarStream(files, filename="tgz.tar", do_gzip=True).make_tar()
+        )
+        self.assertEqual(gzip.decompress(content), expected)
+
+        # parallel block compression, with and without stored members
+        for uncompressed_mimetypes in ((), ("text/plain",)):
+            tfs = UncachedTarStream(
+                files,
+                filename="tgz.tar",
+                do_gzip=True,
+                gzip_workers=4,
+                gzip_block_size=4096,
+                uncompressed_mimetypes=uncompressed_mimetypes,
+            )
+            content = b"".join(tfs.make_tar())
+            self.assertEqual(gzip.decompress(content), expected)
+            with TarFile.open(fileobj=BytesIO(content), mode="r:gz") as tf:
+                self.assertEqual(len(tf.getmembers()), len(self.dfs))
+
+    def test_tar_stream_range(self):
+        files = _get_datafile_details_for_archive(classic_mapper("range"), self.dfs)
+        tfs = UncachedTarStream(files, filename="range.tar")
+        expected = b"".join(tfs.make_tar())
+        header_size = len(tfs.tarinfo_bufs[3])
+        for start, end in (
+            (0, tfs.tar_size),
+            (100, 200),  # inside the first header
+            (tfs.member_offsets[3], tfs.member_offsets[5]),  # whole members
+            (tfs.member_offsets[3] + header_size + 10, tfs.member_offsets[4] - 5),
+            (tfs.member_offsets[-1] - 3, tfs.tar_size),  # trailing zero-blocks
+        ):
+            content = b"".join(tfs.make_tar_range(start, end))
+            self.assertEqual(content, expected[start:end])
+
+        response = tfs.get_response(range_header="bytes=1000-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(
+            response["Content-Range"],
+            "bytes 1000-%d/%d" % (len(expected) - 1, len(expected)),
+        )
+        self.assertEqual(int(response["Content-Length"]), len(expected) - 1000)
+        self.assertEqual(b"".join(response.streaming_content), expected[1000:])
+
+        # a stale If-Range validator results in the full archive
+        response = tfs.get_response(range_header="bytes=1000-", if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], tfs.get_etag())
+
+        response = tfs.get_response(range_header="bytes=%d-" % len(expected))
+        self.assertEqual(response.status_code, 416)
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header("bytes=0-99", 1000), (0, 100))
+        self.assertEqual(parse_range_header("bytes=500-", 1000), (500, 1000))
+        self.assertEqual(parse_range_header("bytes=900-2000", 1000), (900, 1000))
+        self.assertEqual(parse_range_header("bytes=-100", 1000), (900, 1000))
+        self.assertIsNone(parse_range_header("bytes=0-1,5-6", 1000))
+        self.assertIsNone(parse_range_header("items=0-1", 1000))
+        with self.assertRaises(ValueError):
+            parse_range_header("bytes=1000-", 1000)
+        with self.assertRaises(ValueError):
+            parse_range_header("bytes=20-10", 1000)
@@ -1,12 +1,26 @@
 import hashlib
+import os
+from datetime import timedelta
 from os import urandom
+from unittest.mock import patch
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from ..models import DataFile, Dataset, Experiment, User
-from ..tasks import verify_dfos
+from ..models import (
+    DataFile,
+    DataFileObject,
+    Dataset,
+    DatasetDirectory,
+    Experiment,
+    User,
+)
+from ..tasks import cleanup_dfos, cleanup_dfs, reverify_dfos, verify_dfos
 
 
 class BackgroundTaskTestCase(TestCase):
@@ -68,3 +82,149 @@ class BackgroundTaskTestCase(TestCase):
         # verify explicitly to catch Exceptions hidden by celery
         datafile.verify()
         self.assertFalse(datafile.file_objects.get().verified)
+
+    @override_settings(VERIFY_BATCH_SIZE=2)
+    def test_batch_verification(self):
+        datafiles = []
+        for idx in range(5):
+            content = urandom(1024)
+            datafile = DataFile(dataset=self.dataset)
+            datafile.filename = "batch_testfile%d" % idx
+            datafile.size = len(content)
+            # one file doesn't match its checksum
+            datafile.md5sum = hashlib.md5(content if idx else b"").hexdigest()
+            datafile.save()
+            datafile.file_object = ContentFile(content, datafile.filename)
+            datafiles.append(datafile)
+        DataFileObject.objects.update(verified=False)
+
+        # each batch re-queues the next, until all files were checked once
+        verify_dfos()
+        self.assertEqual(
+            [datafile.verified for datafile in datafiles],
+            [False, True, True, True, True],
+        )
+        self.assertIsNotNone(datafiles[0].file_objects.get().last_verified_time)
+
+    def test_failed_batch_verification(self):
+        content = urandom(1024)
+        datafile = DataFile(dataset=self.dataset)
+        datafile.filename = "failed_batch_testfile"
+        datafile.size = len(content)
+        datafile.md5sum = hashlib.md5(content).hexdigest()
+        datafile.save()
+        datafile.file_object = ContentFile(content, datafile.filename)
+        DataFileObject.objects.update(verified=False)
+
+        # the batch is claimed before the files are checked
+        with patch.object(DataFileObject, "check", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                verify_dfos()
+        dfo = datafile.file_objects.get()
+        self.assertFalse(dfo.verified)
+        self.assertIsNotNone(dfo.last_verified_time)
+
+        # and checked again by the next run
+        verify_dfos()
+        self.assertTrue(datafile.verified)
+
+    @override_settings(REVERIFY_INTERVAL=timedelta(0))
+    def test_fingerprint_reverification(self):
+        content = urandom(1024)
+        datafile = DataFile(dataset=self.dataset)
+        datafile.filename = "fingerprint_testfile"
+        datafile.size = len(content)
+        datafile.md5sum = hashlib.md5(content).hexdigest()
+        datafile.save()
+        datafile.file_object = ContentFile(content, datafile.filename)
+        dfo = datafile.file_objects.get()
+        self.assertTrue(dfo.verify())
+        self.assertIsNotNone(dfo.fingerprint)
+
+        # recently verified files aren't checked again
+        with self.settings(REVERIFY_INTERVAL=timedelta(days=7)), patch.object(
+            DataFileObject, "check"
+        ) as check:
+            reverify_dfos()
+            check.assert_not_called()
+
+        # unchanged files aren't read again
+        with patch.object(DataFileObject, "calculate_checksums") as checksums:
+            reverify_dfos()
+            checksums.assert_not_called()
+        self.assertTrue(datafile.verified)
+
+        # until the audit interval elapses
+        with override_settings(VERIFY_AUDIT_INTERVAL=timedelta(0)), patch.object(
+            DataFileObject,
+            "calculate_checksums",
+            return_value={"md5sum": datafile.md5sum},
+        ) as checksums:
+            reverify_dfos()
+            checksums.assert_called_once()
+
+        # modified files are read and fail verification
+        with open(dfo.get_full_path(), "wb") as stored:
+            stored.write(urandom(1024))
+        reverify_dfos()
+        self.assertFalse(datafile.verified)
+
+    @override_settings(CLEANUP_BATCH_SIZE=2)
+    def test_cleanup(self):
+        datafiles = []
+        for idx in range(5):
+            content = urandom(1024)
+            datafile = DataFile(dataset=self.dataset)
+            datafile.filename = "cleanup_testfile%d" % idx
+            datafile.size = len(content)
+            datafile.md5sum = hashlib.md5(content).hexdigest()
+            datafile.save()
+            datafile.file_object = ContentFile(content, datafile.filename)
+            datafiles.append(datafile)
+        paths = [df.file_objects.get().get_full_path() for df in datafiles]
+        # two files were never verified, one of which was deleted already
+        DataFileObject.objects.filter(datafile__in=datafiles[:2]).update(
+            verified=False, created_time=timezone.now() - timedelta(days=8)
+        )
+        os.remove(paths[1])
+        # and one file never had a DataFileObject
+        DataFileObject.objects.filter(datafile=datafiles[2]).delete()
+
+        cleanup_dfos()
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(
+            set(DataFile.objects.values_list("id", flat=True)),
+            {datafile.id for datafile in datafiles[2:]},
+        )
+        cleanup_dfs()
+        self.assertEqual(
+            set(DataFile.objects.values_list("id", flat=True)),
+            {datafile.id for datafile in datafiles[3:]},
+        )
+        self.assertTrue(all(os.path.exists(path) for path in paths[3:]))
+
+    def test_cleanup_queries(self):
+        def cleanup(count):
+            for idx in range(count):
+                DataFile.objects.create(
+                    dataset=self.dataset,
+                    directory="dir%d/sub" % (idx % 2),
+                    filename="orphan%d" % idx,
+                    size=10,
+                    md5sum="bogus",
+                )
+            self.assertEqual(
+                DatasetDirectory.objects.get(
+                    dataset=self.dataset, path="dir0"
+                ).file_count,
+                (count + 1) // 2,
+            )
+            with CaptureQueriesContext(connection) as queries:
+                cleanup_dfs()
+            self.assertFalse(DataFile.objects.exists())
+            self.assertFalse(DatasetDirectory.objects.exists())
+            return len(queries)
+
+        ContentType.objects.get_for_model(DataFile)
+        # the directory index is updated once per directory, not per file
+        self.assertEqual(cleanup(10), cleanup(2))
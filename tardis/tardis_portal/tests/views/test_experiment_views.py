@@ -18,7 +18,7 @@ from django.test import TestCase
 from django.test.client import Client
 from django.urls import resolve, reverse
 
-from ...models import Dataset, Experiment, ExperimentACL
+from ...models import DataFile, Dataset, Experiment, ExperimentACL
 
 
 class ExperimentTestCase(TestCase):
@@ -259,3 +259,54 @@ class ExperimentTestCase(TestCase):
             # Check it no longer exists
             response = client.get(json_url + str(item["id"]))
             self.assertEqual(response.status_code, 404)
+
+    def test_checksum_manifests(self):
+        experiment = Experiment.objects.create(title="Manifest", created_by=self.user)
+        ExperimentACL.objects.create(
+            user=self.user,
+            experiment=experiment,
+            canRead=True,
+            canDownload=True,
+            isOwner=True,
+            aclOwnershipType=ExperimentACL.OWNER_OWNED,
+        )
+        dataset = Dataset.objects.create(description="Data set", directory="raw")
+        dataset.experiments.add(experiment)
+        DataFile.objects.create(
+            dataset=dataset, filename="a.txt", size=1, md5sum="a" * 32
+        )
+        DataFile.objects.create(
+            dataset=dataset, filename="b.txt", directory="sub", size=1, md5sum="b" * 32
+        )
+        client = Client()
+        self.assertTrue(client.login(username=self.username, password=self.password))
+
+        url = reverse("tardis_portal.dataset_checksums", args=[dataset.id])
+        response = client.get(url)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            "%s  a.txt\n%s  sub/b.txt\n\n" % ("a" * 32, "b" * 32),
+        )
+        response = client.get(url, {"format": "json"})
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {
+                "checksums": [
+                    {"checksum": "a" * 32, "file": "a.txt", "type": "md5"},
+                    {"checksum": "b" * 32, "file": "sub/b.txt", "type": "md5"},
+                ]
+            },
+        )
+
+        response = client.get(
+            reverse("tardis_portal.experiment_checksums", args=[experiment.id])
+        )
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="Manifest-manifest-md5.txt"',
+        )
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            "%s  data/raw/Data%%20set/a.txt\n%s  data/raw/Data%%20set/sub/b.txt\n\n"
+            % ("a" * 32, "b" * 32),
+        )
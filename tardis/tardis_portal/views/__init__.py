@@ -12,6 +12,7 @@ from .authorisation import *
 from .facilities import *
 from .images import *
 from .machine import *
+from .manifests import *
 from .pages import *
 from .parameters import *
 from .upload import *
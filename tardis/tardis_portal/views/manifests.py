@@ -0,0 +1,152 @@
+"""
+views for checksum manifests of datasets and experiments
+"""
+
+import json
+from os import path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from ..auth import decorators as authz
+from ..models import DataFile, Dataset, Experiment
+from ..shortcuts import return_response_not_found
+from ..util import (
+    get_filesystem_safe_dataset_name,
+    get_filesystem_safe_experiment_name,
+)
+
+
+def _checksum_attr(type):
+    valid_types = ["md5", "sha512"]
+    if type not in valid_types:
+        raise ValueError(
+            "Invalid checksum type (%s). Valid values are %s"
+            % (type, ", ".join(valid_types))
+        )
+    return type + "sum"
+
+
+def _get_dataset_checksums(request, dataset, type="md5"):
+    """
+    Returns an iterator of the (checksum, path) tuples of the files in a
+    dataset, which are read from the database in chunks
+    """
+    hash_attr = _checksum_attr(type)
+    rows = (
+        dataset.get_datafiles(request.user)
+        .order_by("id")
+        .values_list(hash_attr, "directory", "filename")
+        .iterator()
+    )
+    return (
+        (checksum, path.join(directory or "", filename))
+        for checksum, directory, filename in rows
+    )
+
+
+def _get_experiment_checksums(request, experiment, type="md5"):
+    """
+    Returns an iterator of the (checksum, path) tuples of the files in an
+    experiment, with paths in the payload directory of a BagIt bag, laid out
+    like the experiment's deep-storage archive
+    """
+    hash_attr = _checksum_attr(type)
+    if settings.ONLY_EXPERIMENT_ACLS:
+        datafiles = DataFile.objects.all()
+    else:
+        datafiles = DataFile.safe.all(user=request.user)
+    rows = (
+        datafiles.filter(dataset__experiments=experiment)
+        .order_by("id")
+        .values_list(
+            hash_attr,
+            "dataset__directory",
+            "dataset__description",
+            "directory",
+            "filename",
+        )
+        .iterator()
+    )
+    safe = settings.SAFE_FILESYSTEM_CHARACTERS
+    return (
+        (
+            checksum,
+            path.join(
+                "data",
+                dataset_directory or "",
+                quote(description, safe=safe),
+                directory or "",
+                filename,
+            ),
+        )
+        for checksum, dataset_directory, description, directory, filename in rows
+    )
+
+
+def _stream_manifest(checksums):
+    for checksum in checksums:
+        yield "%s  %s\n" % checksum
+    yield "\n"
+
+
+def _stream_json_manifest(checksums, type):
+    yield '{"checksums": ['
+    for idx, (checksum, filename) in enumerate(checksums):
+        item = {"checksum": checksum, "file": filename, "type": type}
+        yield (", " if idx else "") + json.dumps(item, cls=DjangoJSONEncoder)
+    yield "]}"
+
+
+@authz.dataset_download_required  # too complex # noqa
+def checksums_download(request, dataset_id, **kwargs):
+    """
+    Returns a manifest of the checksums of the files in a dataset, streamed
+    as text in the format of md5sum or sha512sum, or as JSON
+    """
+    dataset = Dataset.objects.get(id=dataset_id)
+    if not dataset:
+        return return_response_not_found(request)
+
+    type = request.GET.get("type", "md5")
+    format = request.GET.get("format", "text")
+
+    checksums = _get_dataset_checksums(request, dataset, type)
+    if format == "text":
+        response = StreamingHttpResponse(
+            _stream_manifest(checksums), content_type="text/plain"
+        )
+        response["Content-Disposition"] = '%s; filename="%s-manifest-md5.txt"' % (
+            "attachment",
+            get_filesystem_safe_dataset_name(dataset),
+        )
+        return response
+
+    if format == "json":
+        # streamed, rather than built in memory by JsonResponse
+        return StreamingHttpResponse(  # pylint: disable=R5102
+            _stream_json_manifest(checksums, type), content_type="application/json"
+        )
+
+    raise ValueError("Invalid format. Valid formats are 'text' or 'json'")
+
+
+@authz.experiment_download_required
+def experiment_checksums_download(request, experiment_id, **kwargs):
+    """
+    Streams a BagIt payload manifest, manifest-md5.txt or
+    manifest-sha512.txt, of the files in an experiment
+    """
+    experiment = Experiment.objects.get(id=experiment_id)
+    type = request.GET.get("type", "md5")
+    response = StreamingHttpResponse(
+        _stream_manifest(_get_experiment_checksums(request, experiment, type)),
+        content_type="text/plain",
+    )
+    response["Content-Disposition"] = 'attachment; filename="%s-manifest-%s.txt"' % (
+        get_filesystem_safe_experiment_name(experiment),
+        type,
+    )
+    return response
@@ -6,7 +6,6 @@ import inspect
 import logging
 import re
 import types
-from os import path
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
@@ -15,7 +14,7 @@ from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ImproperlyConfigured, PermissionDenied
 from django.core.paginator import EmptyPage, InvalidPage, Paginator
 from django.db import connection
-from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.urls import reverse
 from django.views.decorators.cache import cache_page
 from django.views.generic.base import TemplateView, View
@@ -30,7 +29,6 @@ from ..shortcuts import (
     return_response_error,
     return_response_not_found,
 )
-from ..util import get_filesystem_safe_dataset_name
 from ..views.utils import (
     HttpResponseSeeAlso,
     _add_protocols_and_organizations,
@@ -308,10 +306,10 @@ class DatasetView(TemplateView):
             datafile_count = (
                 DataFile.safe.all(user=request.user).filter(dataset=dataset).count()
             )
-            # probably too inefficient for lots of Datafiles
             display_preview = any(
-                authz.has_download_access(request, df.id, "datafile")
-                for df in dataset.get_images()
+                authz.has_download_access_bulk(
+                    request, dataset.get_images(), "datafile"
+                ).values()
             )
 
         c.update(
@@ -878,48 +876,3 @@ def edit_dataset(request, dataset_id):
 
     c = {"form": form, "dataset": dataset}
     return render_response_index(request, "tardis_portal/add_or_edit_dataset.html", c)
-
-
-def _get_dataset_checksums(request, dataset, type="md5"):
-    valid_types = ["md5", "sha512"]
-    if type not in valid_types:
-        raise ValueError(
-            "Invalid checksum type (%s). Valid values are %s"
-            % (type, ", ".join(valid_types))
-        )
-    hash_attr = type + "sum"
-    checksums = [
-        (getattr(df, hash_attr), path.join(df.directory or "", df.filename))
-        for df in dataset.get_datafiles(request.user)
-    ]
-    return checksums
-
-
-@authz.dataset_download_required  # too complex # noqa
-def checksums_download(request, dataset_id, **kwargs):
-    dataset = Dataset.objects.get(id=dataset_id)
-    if not dataset:
-        return return_response_not_found(request)
-
-    type = request.GET.get("type", "md5")
-    format = request.GET.get("format", "text")
-
-    checksums = _get_dataset_checksums(request, dataset, type)
-    if format == "text":
-        checksum_doc = "".join(["%s  %s\n" % c for c in checksums])
-        checksum_doc += "\n"
-        response = HttpResponse(checksum_doc, content_type="text/plain")
-        response["Content-Disposition"] = '%s; filename="%s-manifest-md5.txt"' % (
-            "attachment",
-            get_filesystem_safe_dataset_name(dataset),
-        )
-        return response
-
-    if format == "json":
-        jdict = {"checksums": []}
-        for c in checksums:
-            jdict["checksums"].append({"checksum": c[0], "file": c[1], "type": type})
-
-        return JsonResponse(jdict)
-
-    raise ValueError("Invalid format. Valid formats are 'text' or 'json'")
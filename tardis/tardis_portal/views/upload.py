@@ -9,6 +9,7 @@ from django.http import HttpResponse
 from django.shortcuts import render
 
 from ..auth import decorators as authz
+from ..auth.acl_resolver import datafile_acls_inherited
 from ..models import DataFile, DatafileACL, Dataset
 
 logger = logging.getLogger(__name__)
@@ -68,7 +69,7 @@ def upload(request, dataset_id):
             datafile.file_object = uploaded_file_post
             logger.debug("saved datafile")
 
-            if not settings.ONLY_EXPERIMENT_ACLS:
+            if not settings.ONLY_EXPERIMENT_ACLS and not datafile_acls_inherited():
                 # add default ACL
                 acl = DatafileACL(
                     datafile=datafile,
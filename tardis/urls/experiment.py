@@ -14,6 +14,7 @@ from tardis.tardis_portal.views import (
     create_token,
     create_user,
     edit_experiment,
+    experiment_checksums_download,
     remove_experiment_access_group,
     remove_experiment_access_user,
     retrieve_access_list_external,
@@ -38,6 +39,11 @@ experiment_urls = [
         edit_experiment,
         name="tardis.tardis_portal.views.edit_experiment",
     ),
+    re_path(
+        r"^checksums/(?P<experiment_id>\d+)/$",
+        experiment_checksums_download,
+        name="tardis_portal.experiment_checksums",
+    ),
     re_path(
         r"^control_panel/(?P<experiment_id>\d+)/access_list/add/user/"
         "(?P<username>%s)/$" % user_pattern,